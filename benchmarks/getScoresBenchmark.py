@@ -0,0 +1,73 @@
+"""
+Leaderboard response benchmark.
+
+Compares building a getscores response the old way (formatting every dict
+row with `format_score` on each request) with a cache hit on the
+pre-rendered `LbCacheResult`, and makes sure both return the same data.
+
+From the repo root:
+    python3 -m benchmarks.getScoresBenchmark [-n iterations] [-s scores]
+"""
+import argparse
+import timeit
+
+from handlers.getScoresHandler import format_score
+from helpers.cache import LbCacheResult
+
+KEYS = (
+    'id', 'score', 'max_combo', '50_count', '100_count', '300_count',
+    'misses_count', 'katus_count', 'gekis_count', 'full_combo', 'mods',
+    'time', 'username', 'a.id', 'pp', 'country', 'sort',
+)
+
+HEADER = '2|false|75|1|{count}\n0\nDJ Okawari - Flower Dance [Normal]\n10.0'
+PERSONAL_BEST = '1234|cmyui|1000000|500|0|0|300|0|0|0|1|0|1001|1|1600000000|1'
+
+
+def make_rows(count: int) -> list:
+    return [dict(zip(KEYS, (
+        100_000 + i, 1_000_000 - i, 500, 1, 2, 300, 0, 3, 4, 1, 64,
+        1_600_000_000 + i, f'player{i}', 1000 + i, 300.0 - i / 10, 'US', 1_000_000 - i,
+    ))) for i in range(count)]
+
+
+def old_response(rows: list, limit: int) -> bytes:
+    return '\n'.join([
+        HEADER.format(count=len(rows)),
+        PERSONAL_BEST,
+        *[format_score(tuple(s.values()), idx + 1) for idx, s in enumerate(rows[:limit])]
+    ]).encode()
+
+
+def cached_response(lb: LbCacheResult, limit: int) -> bytes:
+    return b'\n'.join([
+        HEADER.format(count=lb.count).encode(),
+        PERSONAL_BEST.encode(),
+        lb.encoded(limit),
+    ])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark getscores responses.')
+    parser.add_argument('-n', '--iterations', type=int, default=2000)
+    parser.add_argument('-s', '--scores', type=int, default=500)
+    args = parser.parse_args()
+
+    rows = make_rows(args.scores)
+    lb = LbCacheResult(len(rows), [tuple(row.values()) for row in rows])
+
+    for limit in (150, 250, 500):
+        assert old_response(rows, limit) == cached_response(lb, limit)
+
+        results = {}
+        for name, func, board in (('format_score', old_response, rows),
+                                  ('pre-rendered', cached_response, lb)):
+            t = timeit.timeit(lambda: func(board, limit), number=args.iterations)
+            results[name] = t / args.iterations * 1e6
+            print(f'{name:>14} (limit {limit}): {results[name]:10.2f}us per request')
+
+        print(f'{"speedup":>14} (limit {limit}): {results["format_score"] / results["pre-rendered"]:10.1f}x')
+
+
+if __name__ == '__main__':
+    main()
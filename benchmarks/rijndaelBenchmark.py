@@ -0,0 +1,56 @@
+"""
+Score submission decryption benchmark.
+
+Compares the pure python `aeshelper.decryptRinjdael` with the compiled
+`rijndaelHelper.decryptRinjdael` on a score-sized payload and makes sure
+both return the same data.
+
+Build the pyx modules first (./full_build.sh), then from the repo root:
+    python3 -m benchmarks.rijndaelBenchmark [-n iterations]
+"""
+import argparse
+import os
+import timeit
+from base64 import b64encode
+
+from helpers import aeshelper, rijndaelHelper
+
+KEY = 'osu!-scoreburgr---------20210520'
+
+# md5:username:checksum:300:100:50:geki:katu:miss:score:combo:fc:rank:mods:pass:mode:date:version
+SCORE_DATA = ':'.join((
+    'a5b99395a42bd55bc5eb1d2411cbdf8b', 'cmyui ', '5c1bd1bc0a0b3a6a2a6f8c1b5b1a1c3d',
+    '1024', '12', '0', '231', '9', '1', '72938492', '1337', 'False', 'S', '72',
+    'True', '0', '210101000000', '20210520', ' ' * 4,
+))
+
+
+def encrypt(key: str, iv: str, data: str) -> str:
+    return aeshelper.cbc(aeshelper.zeropad(32), aeshelper.rijndael(key, 32), iv).encrypt(data)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark score data decryption.')
+    parser.add_argument('-n', '--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    iv = os.urandom(32)
+    data = encrypt(KEY, iv.decode('latin_1'), SCORE_DATA).encode('latin_1')
+    ivB64, dataB64 = b64encode(iv), b64encode(data)
+
+    expected = aeshelper.decryptRinjdael(KEY, ivB64, dataB64, True)
+    assert expected == SCORE_DATA
+    assert rijndaelHelper.decryptRinjdael(KEY, ivB64, dataB64, True) == expected
+
+    results = {}
+    for name, func in (('aeshelper', aeshelper.decryptRinjdael),
+                       ('rijndaelHelper', rijndaelHelper.decryptRinjdael)):
+        t = timeit.timeit(lambda: func(KEY, ivB64, dataB64, True), number=args.iterations)
+        results[name] = t / args.iterations * 1e6
+        print(f'{name:>16}: {results[name]:10.2f}us per score ({args.iterations} iterations)')
+
+    print(f'{"speedup":>16}: {results["aeshelper"] / results["rijndaelHelper"]:10.1f}x')
+
+
+if __name__ == '__main__':
+    main()
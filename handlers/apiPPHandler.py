@@ -86,10 +86,9 @@ class handler(requestsManager.asyncRequestHandler):
                 beatmapMd5 = osuapiData["file_md5"]
                 beatmapSetID = osuapiData["beatmapset_id"]
             else:
-                dbResult = glob.db.fetch(
-                    "SELECT beatmap_md5, beatmapset_id FROM beatmaps WHERE beatmap_id = %s",
-                    (beatmapID,),
-                )
+                dbResult = beatmap.getBeatmapRowByID(beatmapID)
+                if dbResult is None:
+                    raise exceptions.invalidBeatmapException(MODULE_NAME)
                 beatmapMd5 = dbResult["beatmap_md5"]
                 beatmapSetID = dbResult["beatmapset_id"]
 
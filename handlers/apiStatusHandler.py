@@ -3,6 +3,8 @@ import tornado.web
 
 import orjson
 from common.web import requestsManager
+from helpers import submissionPipeline
+from objects import glob
 
 
 class handler(requestsManager.asyncRequestHandler):
@@ -12,4 +14,21 @@ class handler(requestsManager.asyncRequestHandler):
     @tornado.web.asynchronous
     @tornado.gen.engine
     def asyncGet(self) -> None:
-        self.write(orjson.dumps({"status": 200, "server_status": 1}))
+        self.write(orjson.dumps({
+            "status": 200,
+            "server_status": 1,
+            "caches": {
+                "leaderboards": glob.lb_cache.stats,
+                "beatmaps": glob.beatmap_cache.stats,
+                "personal_bests": glob.pb_records.stats,
+                "parsed_beatmaps": glob.parsed_bmap_cache.stats,
+                "ignored_maps": glob.ignoreMapsCache.stats,
+            },
+            "submissions": dict(glob.submissionStats),
+            "submission_stages": submissionPipeline.stats(),
+            "playcounts": glob.playcounts.stats,
+            "replay_spool": glob.replaySpool.stats if glob.replaySpool is not None else None,
+            "osu_api": glob.osuapi.stats if glob.osuapi is not None else None,
+            "checksum_filter": glob.checksums.stats if glob.checksums is not None else None,
+            "redis_purge": glob.keyPurge.stats if glob.keyPurge is not None else None,
+        }))
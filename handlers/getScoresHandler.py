@@ -9,9 +9,10 @@ from common.constants import mods, privileges
 from common.log import logUtils as log
 from common.ripple import userUtils
 from common.web import requestsManager
-from constants import exceptions, rankedStatuses
-from helpers.cache import LbCacheResult
-from objects import beatmap, glob, scoreboard
+from constants import exceptions
+from helpers import leaderboardHelper
+from helpers.cache import DEF_LB_SIZE, LB_ROW_SORT, LbCacheResult, render_lb_row
+from objects import beatmap, glob
 
 BASE_QUERY = """
 SELECT
@@ -29,58 +30,26 @@ SELECT
     s.time,
     a.username,
     a.id,
-    s.pp
+    s.pp,
+    st.country AS country,
+    s.{order} AS sort_value
 FROM
     {table} s
 INNER JOIN
     users a on s.userid = a.id
+INNER JOIN
+    users_stats st on st.id = a.id
 WHERE
     {where_clauses}
-ORDER BY {order} DESC
+ORDER BY sort_value DESC
 LIMIT {limit}
 """
 
-COUNT_QUERY = ("SELECT COUNT(*) FROM {table} s INNER JOIN users a on "
-               "s.userid = a.id WHERE {where_clauses}")
-
-PB_BASE_QUERY = """
-SELECT
-    s.id,
-    s.{scoring},
-    s.max_combo,
-    s.50_count,
-    s.100_count,
-    s.300_count,
-    s.misses_count,
-    s.katus_count,
-    s.gekis_count,
-    s.full_combo,
-    s.mods,
-    s.time,
-    a.username,
-    a.id,
-    s.pp
-FROM
-    {table} s
-INNER JOIN
-    users a on s.userid = a.id
-WHERE
-    {where_clauses}
-ORDER BY {order} DESC
-LIMIT 1
-"""
+COUNT_QUERY = ("SELECT COUNT(*) AS count FROM {table} s INNER JOIN users a on "
+               "s.userid = a.id INNER JOIN users_stats st on st.id = a.id "
+               "WHERE {where_clauses}")
 
-PB_COUNT_QUERY = """
-SELECT
-    COUNT(*) + 1
-FROM
-    {table} s
-INNER JOIN
-    users a on s.userid = a.id
-WHERE
-    {where_clauses}
-ORDER BY {order} DESC
-"""
+FRIENDS_QUERY = "SELECT user2 FROM users_relationships WHERE user1 = %s"
 
 class LeaderboardTypes(IntEnum):
     """osu! in-game leaderboards"""
@@ -103,49 +72,114 @@ def format_score(score: tuple, place: int) -> str:
     """Formats a Database score tuple into a string format understood by the
     client."""
 
-    return (f"{score[0]}|{score[12]}|{round(score[1])}|{score[2]}|{score[3]}|"
-            f"{score[4]}|{score[5]}|{score[6]}|{score[7]}|{score[8]}|"
-            f"{score[9]}|{score[10]}|{score[13]}|{place}|{score[11]}|1")
+    prefix, suffix = render_lb_row(score)
+    return f"{prefix}{place}{suffix}"
 
 def glob_lb_from_cache(mode: int, rx: bool, bmap_md5: str) -> Optional[LbCacheResult]:
     """Attempts to fetch global leaderboards from cache"""
 
-    lb = glob.lb_cache.get_lb_cache(mode, rx)
-    return lb.get((bmap_md5, 'g'))
+    return glob.lb_cache.get(mode, rx, (bmap_md5, 'g'))
 
 def mod_lb_from_cache(mode: int, rx: bool, bmap_md5: str, mods: int) -> Optional[LbCacheResult]:
     """Attempts to fetch mod-selected leaderboards from cache"""
 
-    lb = glob.lb_cache.get_lb_cache(mode, rx)
-    return lb.get((bmap_md5, 'm', mods,)) # strings to differentiate potential int overlaps
+    return glob.lb_cache.get(mode, rx, (bmap_md5, 'm', mods,)) # strings to differentiate potential int overlaps
 
 def friend_lb_from_cache(mode: int, rx: bool, bmap_md5: str, user_id: int) -> Optional[LbCacheResult]:
-    """Attempts to fetch a user's friend leaderboards from cache"""
+    """Attempts to fetch a user's friend leaderboards from cache, filtering
+    the global leaderboards if they're complete."""
 
-    lb = glob.lb_cache.get_lb_cache(mode, rx)
-    return lb.get((bmap_md5, 'f', user_id,)) # strings to differentiate potential int overlaps
+    _lb = glob.lb_cache.get(mode, rx, (bmap_md5, 'f', user_id,)) # strings to differentiate potential int overlaps
+    if _lb: return _lb
+
+    _lb = glob_lb_from_cache(mode, rx, bmap_md5)
+    if _lb and _lb.complete: return _lb.filter_users(get_friends(user_id))
 
 def country_lb_from_cache(mode: int, rx: bool, bmap_md5: str, country: str) -> Optional[LbCacheResult]:
-    """Attempts to fetch a country's leaderboards from cache"""
+    """Attempts to fetch a country's leaderboards from cache, filtering the
+    global leaderboards if they're complete."""
+
+    _lb = glob.lb_cache.get(mode, rx, (bmap_md5, 'c', country,))
+    if _lb: return _lb
 
-    lb = glob.lb_cache.get_lb_cache(mode, rx)
-    return lb.get((bmap_md5, 'c', country,))
+    _lb = glob_lb_from_cache(mode, rx, bmap_md5)
+    if _lb and _lb.complete: return _lb.filter_country(country)
 
 def glob_lb_add(mode: int, rx: bool, bmap_md5: str, _lb: LbCacheResult) -> None:
-    lb = glob.lb_cache.get_lb_cache(mode, rx)
-    lb.cache((bmap_md5, 'g',), _lb)
+    glob.lb_cache.add(mode, rx, (bmap_md5, 'g',), _lb)
 
 def mod_lb_add(mode: int, rx: bool, bmap_md5: str, mods: int, _lb: LbCacheResult) -> None:
-    lb = glob.lb_cache.get_lb_cache(mode, rx)
-    lb.cache((bmap_md5, 'm', mods,), _lb)
+    glob.lb_cache.add(mode, rx, (bmap_md5, 'm', mods,), _lb)
 
 def friend_lb_add(mode: int, rx: bool, bmap_md5: str, user_id: int, _lb: LbCacheResult) -> None:
-    lb = glob.lb_cache.get_lb_cache(mode, rx)
-    lb.cache((bmap_md5, 'f', user_id,), _lb)
+    glob.lb_cache.add(mode, rx, (bmap_md5, 'f', user_id,), _lb)
 
 def country_lb_add(mode: int, rx: bool, bmap_md5, country: str, _lb: LbCacheResult) -> None:
-    lb = glob.lb_cache.get_lb_cache(mode, rx)
-    lb.cache((bmap_md5, 'c', country,), _lb)
+    glob.lb_cache.add(mode, rx, (bmap_md5, 'c', country,), _lb)
+
+def get_friends(user_id: int) -> frozenset:
+    """Returns the user ids of a user's friends (and the user themselves)."""
+
+    friends = glob.lb_cache.friends.get(user_id)
+    if friends is None:
+        friends = frozenset((
+            user_id,
+            *(row['user2'] for row in glob.db.fetchAll(FRIENDS_QUERY, [user_id]) or ()),
+        ))
+        glob.lb_cache.friends.cache(user_id, friends)
+
+    return friends
+
+def fetch_lb(mode: int, rx: bool, bmap: beatmap.beatmap, mods: Optional[int] = None,
+             country: Optional[str] = None, user_id: Optional[int] = None) -> LbCacheResult:
+    """Fetches leaderboards from the database. Pass `mods`, `country` or
+    `user_id` (for their friends) to get that leaderboard."""
+
+    where_clauses = [
+        f'a.privileges & {privileges.USER_PUBLIC}',
+        's.beatmap_md5 = %s',
+        's.play_mode = %s',
+        's.completed = 3',
+    ]
+    where_vals = [
+        bmap.fileMD5,
+        mode,
+    ]
+
+    if mods is not None:
+        where_clauses.append('s.mods = %s')
+        where_vals.append(mods)
+
+    if country is not None:
+        where_clauses.append('st.country = %s')
+        where_vals.append(country)
+
+    if user_id is not None:
+        where_clauses.append(f'(s.userid IN ({FRIENDS_QUERY}) OR s.userid = %s)')
+        where_vals.extend((user_id, user_id))
+
+    table = 'scores_relax' if rx else 'scores'
+    query_str = " AND ".join(where_clauses)
+    query = BASE_QUERY.format(
+        scoring='pp' if rx else 'score',
+        table=table,
+        where_clauses=query_str,
+        limit=DEF_LB_SIZE,
+        order='pp' if bmap.sort_by_pp else 'score'
+    )
+
+    scores_db = [tuple(row.values()) for row in glob.db.fetchAll(query, where_vals) or ()]
+
+    count = len(scores_db)
+    if count == DEF_LB_SIZE:
+        count = glob.db.fetch(
+            COUNT_QUERY.format(
+                table=table,
+                where_clauses=query_str
+            ), where_vals
+        )['count']
+
+    return LbCacheResult(count, scores_db)
 
 LB_MAINTENENCE_RES = "999|Leaderboard Maintenence|0|0|0|0|0|0|0|0|0|0|999|0|0|1"
 MODULE_NAME = "get_scores"
@@ -173,9 +207,9 @@ class handler(requestsManager.asyncRequestHandler):
 
             md5 = self.get_argument('c')
 
-            if md5 in glob.ignoreMapsCache:
+            status = glob.ignoreMapsCache.get(md5)
+            if status is not None:
                 # we already know this map can be ignored
-                status = glob.ignoreMapsCache[md5]
                 self.write(f'{status}|false|0|0|0\n0\n\n10.0\n'.encode())
                 return
 
@@ -206,10 +240,8 @@ class handler(requestsManager.asyncRequestHandler):
             glob.redis.publish('peppy:update_cached_stats', user_id)
 
             if bmap.rankedStatus in (-1, 1):
-                # we can ignore this md5 in the future
-                # TODO: PERHAPS these could be cached on disk? even with
-                # a timeout it might be worth the reduced api requests
-                glob.ignoreMapsCache[md5] = bmap.rankedStatus
+                # we can ignore this md5 in the future (or until it expires)
+                glob.ignoreMapsCache.cache(md5, bmap.rankedStatus)
                 self.write(beatmap_header(bmap, False).encode())
 
                 time_taken_ms = (time.perf_counter() - start_time) * 1000
@@ -217,97 +249,62 @@ class handler(requestsManager.asyncRequestHandler):
                 return
 
             cache_hit = False
+            cache_enabled = glob.conf.config['cache']['enable']
             limit = 500 if privs & privileges.USER_PREMIUM else 250 if privs & privileges.USER_DONOR else 150
             rx = score_mods & mods.RELAX > 0 and mode != 3
 
             lb = None
 
             if lb_type == LeaderboardTypes.TOP:
+                lb_from_cache_func = glob_lb_from_cache
                 lb_add_func = glob_lb_add
                 _args = (mode, rx, md5,)
+                _kwargs = {}
             elif lb_type == LeaderboardTypes.MOD:
+                lb_from_cache_func = mod_lb_from_cache
                 lb_add_func = mod_lb_add
                 _args = (mode, rx, md5, score_mods,)
+                _kwargs = {'mods': score_mods}
             elif lb_type == LeaderboardTypes.FRIENDS:
+                lb_from_cache_func = friend_lb_from_cache
                 lb_add_func = friend_lb_add
                 _args = (mode, rx, md5, user_id,)
+                _kwargs = {'user_id': user_id}
             elif lb_type == LeaderboardTypes.COUNTRY:
+                lb_from_cache_func = country_lb_from_cache
                 lb_add_func = country_lb_add
-                _args = (mode, rx, md5, userUtils.getCountry(user_id),)
-
-            if (
-                glob.conf.config['cache']['enable'] and not
-                lb_type in (LeaderboardTypes.COUNTRY, LeaderboardTypes.FRIENDS)
-            ): # oh boy
-                if lb_type == LeaderboardTypes.TOP:
-                    lb = glob_lb_from_cache(mode, rx, md5)
-                elif lb_type == LeaderboardTypes.MOD:
-                    lb = mod_lb_from_cache(mode, rx, md5, score_mods)
+                country = userUtils.getCountry(user_id)
+                _args = (mode, rx, md5, country,)
+                _kwargs = {'country': country}
 
+            if cache_enabled:
+                lb = lb_from_cache_func(*_args)
                 if lb: cache_hit = True
 
-                if not lb: # construct cache ourself
-                    where_clauses = [
-                        f'a.privileges & {privileges.USER_PUBLIC}',
-                        's.beatmap_md5 = %s',
-                        's.play_mode = %s',
-                        's.completed = 3',
-                    ]
-
-                    if lb_type == LeaderboardTypes.MOD: where_clauses.append('s.mods = %s')
-
-                    where_vals = [
-                        md5,
-                        mode,
-                    ]
-
-                    if lb_type == LeaderboardTypes.MOD: where_vals.append(score_mods)
-
-                    query_str = " AND ".join(where_clauses)
-                    query = BASE_QUERY.format(
-                        scoring='pp' if rx else 'score',
-                        table='scores_relax' if rx else 'scores',
-                        where_clauses=query_str,
-                        limit=500,
-                        order='pp' if bmap.rankedStatus in (rankedStatuses.RANKED, rankedStatuses.APPROVED) else 'score'
-                    )
-
-                    scores_db = glob.db.fetchAll(query, where_vals)
-
-                    count = len(scores_db)
-                    if count == 500:
-                        count = glob.db.fetch(
-                            COUNT_QUERY.format(
-                                table='scores_relax' if rx else 'scores',
-                                where_clauses=query_str
-                            ), where_vals
-                        )
-
-                    lb = LbCacheResult(count, scores_db)
-                    lb_add_func(*_args, lb)
-            else:
-                sboard: scoreboard = scoreboard.scoreboard(
-                    username, mode, bmap,
-                    setScores = True, country = lb_type == LeaderboardTypes.COUNTRY,
-                    friends = lb_type == LeaderboardTypes.FRIENDS, mods = score_mods,
-                    relax = rx
-                )
-
-                lb = LbCacheResult(sboard.totalScores, sboard.score_rows)
-                lb_add_func(*_args, lb)
-
-            personal_best = glob.pb_cache.get_user_pb(mode, user_id, md5, rx)
-            if not personal_best:
-                # first attempt to get our scores from pre-existing score list
-
-                for idx, _score in enumerate(lb.scores):
-                    score = tuple(_score.values())
-                    if score[13] == user_id:
-                        personal_best = format_score(score, idx + 1)
-
-                if len(lb.scores) < 500 and not personal_best:
-                    personal_best = None
-                elif not personal_best:
+            if not lb and cache_enabled and _kwargs.keys() & {'country', 'user_id'}:
+                # Friends and country leaderboards are filtered out of the
+                # global ones, if they hold every score on the map.
+                glob_lb = glob_lb_from_cache(mode, rx, md5)
+                if not glob_lb:
+                    glob_lb = fetch_lb(mode, rx, bmap)
+                    glob_lb_add(mode, rx, md5, glob_lb)
+
+                if glob_lb.complete:
+                    lb = lb_from_cache_func(*_args)
+
+            if not lb: # construct cache ourself
+                lb = fetch_lb(mode, rx, bmap, **_kwargs)
+                if cache_enabled: lb_add_func(*_args, lb)
+
+            # first attempt to get our scores from pre-existing score list
+            personal_best = None
+            idx = lb.find_user(user_id)
+            if idx != -1:
+                personal_best = lb.format_row(idx, idx + 1)
+            elif not lb.complete:
+                # Our score is past the cached ones, only its rank changes.
+                personal_row = glob.pb_cache.get_user_pb(mode, user_id, md5, rx)
+                if not personal_row:
                     where_clauses = (
                         f'a.privileges & {privileges.USER_PUBLIC}',
                         's.beatmap_md5 = %s',
@@ -323,44 +320,30 @@ class handler(requestsManager.asyncRequestHandler):
                     )
 
                     query_str = " AND ".join(where_clauses)
-                    query = PB_BASE_QUERY.format(
+                    query = BASE_QUERY.format(
                         scoring='pp' if rx else 'score',
                         table='scores_relax' if rx else 'scores',
                         where_clauses=query_str,
-                        order='pp' if bmap.rankedStatus in (rankedStatuses.RANKED, rankedStatuses.APPROVED) else 'score'
+                        limit=1,
+                        order='pp' if bmap.sort_by_pp else 'score'
                     )
 
-                    personal_best = glob.db.fetch(query, where_vals)
-
-                    if personal_best:
-                        personal_vals = tuple(personal_best.values())
-                        place_clauses = (
-                            f"a.privileges & {privileges.USER_PUBLIC}",
-                            "s.beatmap_md5 = %s",
-                            "s.play_mode = %s",
-                            f"s.pp > {personal_vals[14]}",
-                            f"s.completed = 3",
-                        )
-
-                        query_str = " AND ".join(place_clauses)
-                        query = PB_COUNT_QUERY.format(
-                            table='scores_relax' if rx else 'scores',
-                            where_clauses=query_str,
-                            order='pp' if bmap.rankedStatus in (rankedStatuses.RANKED, rankedStatuses.APPROVED) else 'score'
-                        )
-
-                        where_vals = where_vals[:2]
-                        personal_place = glob.db.fetch(query, where_vals)
+                    personal_row = glob.db.fetch(query, where_vals)
+                    if personal_row:
+                        personal_row = tuple(personal_row.values())
+                        glob.pb_cache.set_user_pb(mode, user_id, md5, personal_row, rx)
 
-                        personal_best = format_score(personal_vals, personal_place)
-                        glob.pb_cache.set_user_pb(mode, user_id, md5, personal_best, rx)
+                if personal_row:
+                    personal_place = leaderboardHelper.getScoreRank(mode, rx, bmap, personal_row[LB_ROW_SORT])
+                    personal_best = format_score(personal_row, personal_place)
 
             # Now we do the actual fetching.
-            res = "\n".join([
-                beatmap_header(bmap, True, lb.count),
-                personal_best or "",
-                *[format_score(tuple(s.values()), idx + 1) for idx, s in enumerate(lb.scores[:limit])]
-            ])
+            res = [
+                beatmap_header(bmap, True, lb.count).encode(),
+                personal_best.encode() if personal_best else b"",
+            ]
+            if lb.size: res.append(lb.encoded(limit))
+            res = b"\n".join(res)
 
             # Datadog stats
             glob.dog.increment(f'{glob.DATADOG_PREFIX}.served_leaderboards')
@@ -368,7 +351,7 @@ class handler(requestsManager.asyncRequestHandler):
             time_taken_ms = (time.perf_counter() - start_time) * 1000
             hit_or_miss = f'\x1b[0;9{2 if cache_hit else 1}mCache\x1b[0m' # i guess they never miss huh
             log.info(f'[{hit_or_miss}; {time_taken_ms:.2f}ms] "{username}" requested {lb_type!r} lb for "{bmap.songName}".')
-            self.write(res.encode())
+            self.write(res)
         except exceptions.invalidArgumentsException:
             self.write("error: meme")
         except exceptions.userBannedException:
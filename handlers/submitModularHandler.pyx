@@ -1,4 +1,4 @@
-import io
+import os
 import requests
 import datetime
 import time
@@ -27,17 +27,19 @@ from common.web import requestsManager
 from constants import exceptions
 from constants import rankedStatuses
 from constants.exceptions import ppCalcException
-from helpers import aeshelper
 from helpers import leaderboardHelper
+from helpers import rijndaelHelper
+from helpers import submissionPipeline
 from objects import beatmap
 from objects import glob
 from objects import score
-from objects import scoreboard
+from helpers.cache import PB_RECORDS_CHANNEL
 from helpers.generalHelper import zingonify
 from objects.charts import BeatmapChart, OverallChart
 from common import generalUtils
 
 MODULE_NAME = 'submit_modular'
+
 class handler(requestsManager.asyncRequestHandler):
     '''
     Handler for /web/osu-submit-modular.php
@@ -84,7 +86,7 @@ class handler(requestsManager.asyncRequestHandler):
 
             # Get score data
             log.debug('Decrypting score data...')
-            scoreData: List[str] = aeshelper.decryptRinjdael(aeskey, iv, scoreDataEnc, True).split(':')
+            scoreData: List[str] = rijndaelHelper.decryptRinjdael(aeskey, iv, scoreDataEnc, True).split(':')
 
             username = scoreData[1].strip()
 
@@ -112,9 +114,27 @@ class handler(requestsManager.asyncRequestHandler):
 
             restricted = userUtils.isRestricted(userID)
 
-            # Create score object and set its data
+            # Get beatmap info, shared by the whole submission
+            beatmapInfo = beatmap.beatmap(scoreData[0], 0)
+            glob.submissionStats['beatmap_lookups'] += 1
+
+            # Make sure the beatmap is submitted and updated
+            if beatmapInfo.rankedStatus in (rankedStatuses.NOT_SUBMITTED,
+                                            rankedStatuses.NEED_UPDATE,
+                                            rankedStatuses.UNKNOWN):
+                log.debug(f'Beatmap {beatmapInfo.beatmapID} is not submitted/outdated/unknown. Score submission aborted.')
+                self.write('error: no')
+                return
+
+            # Create score object and set its data (pp and completed status too).
+            # Exceptions in pp calculation are intercepted and re-raised after
+            # saving the score, we want to save scores even in case pp calc
+            # fails due to some rippoppai bugs.
             s = score.score()
-            s.setDataFromScoreData(scoreData)
+            s.playerUserID = userID
+            midPPCalcException = submissionPipeline.ppCalc.run(s.setDataFromScoreData, scoreData, beatmapInfo)
+            if midPPCalcException is not None:
+                log.error('Caught an exception in pp calculation, re-raising after saving score in db.')
 
             if s.completed == -1:
                 log.warning(f'Duplicated score detected, this is normal right after restarting the server [{username} ({userID})].')
@@ -124,18 +144,6 @@ class handler(requestsManager.asyncRequestHandler):
             # Set score stuff missing in score data
             s.playerUserID = userID
 
-            # Get beatmap info
-            beatmapInfo = beatmap.beatmap()
-            beatmapInfo.setDataFromDB(s.fileMd5)
-
-            # Make sure the beatmap is submitted and updated
-            if beatmapInfo.rankedStatus in (rankedStatuses.NOT_SUBMITTED,
-                                            rankedStatuses.NEED_UPDATE,
-                                            rankedStatuses.UNKNOWN):
-                log.debug(f'Beatmap {beatmapInfo.beatmapID} is not submitted/outdated/unknown. Score submission aborted.')
-                self.write('error: no')
-                return
-
             # Increment user playtime.
             length = 0
             if s.passed:
@@ -163,48 +171,57 @@ class handler(requestsManager.asyncRequestHandler):
             elif s.mods & (mods.DOUBLETIME | mods.NIGHTCORE):
                 length /= 1.5
 
-            userUtils.incrementPlaytime(userID, s.gameMode, length)
-
-            # Calculate PP
-            midPPCalcException = None
-            try:
-                s.calculatePP()
-            except Exception as e:
-                # Intercept ALL exceptions and bypass them.
-                # We want to save scores even in case PP calc fails
-                # due to some rippoppai bugs.
-                # I know this is bad, but who cares since I'll rewrite
-                # the scores server again.
-                log.error('Caught an exception in pp calculation, re-raising after saving score in db.')
-                s.pp = 0
-                midPPCalcException = e
-
-            oldPersonalBestRank = 0
-            oldPersonalBest = None
+            # The score and the stats writes go in one db transaction each, and
+            # redis writes in one pipeline, sent once they're committed
+            redisPipe = glob.redis.pipeline(transaction=False)
+            with glob.db.batch() as dbBatch:
+                userUtils.incrementPlaytime(userID, s.gameMode, length)
+
+                oldPersonalBestRank = 0
+                oldPersonalBest = None
+
+                if s.passed:
+                    # Right before submitting the score, get the personal best score object (we need it for charts)
+                    # setCompletedStatus already looked it up
+                    if s.oldPersonalBest > 0:
+                        oldPersonalBest = score.score(relax = s.mods & mods.RELAX > 0)
+                        oldPersonalBest.setDataFromDict(s.getPersonalBest(), username=username)
+                        oldPersonalBestRank = leaderboardHelper.getScoreRank(
+                            s.gameMode, s.mods & mods.RELAX > 0, beatmapInfo,
+                            oldPersonalBest.pp if beatmapInfo.sort_by_pp else oldPersonalBest.score
+                        )
+                        oldPersonalBest.setRank(oldPersonalBestRank)
+
+                # Save score in db
+                s.saveScoreInDB()
+
+                # some useful stuff - not always used but used enough that i'll add it here
+                relax = s.mods & mods.RELAX > 0
+                pp_limit = scoreUtils.getPPLimit(s.gameMode, s.mods)
+                whitelisted = userUtils.checkWhitelist(
+                    userID, akatsuki.RELAX if relax else akatsuki.VANILLA
+                )
+
+                # Increment per-user beatmap playcount
+                userUtils.updateBeatmapPlaycount(userID, s.fileMd5, s.gameMode, relax)
+
+            dbStatements = dbBatch.statements
 
-            if s.passed:
-                # Right before submitting the score, get the personal best score object (we need it for charts)
-                if s.oldPersonalBest > 0:
-                    oldPersonalBestRank = glob.personalBestCache.get(userID, s.fileMd5)
-                    if oldPersonalBestRank == 0:
-                        oldScoreboard = scoreboard.scoreboard(username, s.gameMode, beatmapInfo, False)
-                        oldScoreboard.setPersonalBestRank()
-                        oldPersonalBestRank = max(oldScoreboard.personalBestRank, 0)
-                    oldPersonalBest = score.score(s.oldPersonalBest, oldPersonalBestRank)
-
-            # Save score in db
-            s.saveScoreInDB()
-
-            # some useful stuff - not always used but used enough that i'll add it here
-            relax = s.mods & mods.RELAX > 0
-            pp_limit = scoreUtils.getPPLimit(s.gameMode, s.mods)
-            whitelisted = userUtils.checkWhitelist(
-                userID, akatsuki.RELAX if relax else akatsuki.VANILLA
-            )
-
-            # Increment per-user beatmap playcount
-            userUtils.updateBeatmapPlaycount(userID, s.fileMd5, s.gameMode, relax)
+            if s.completed == 3:
+                # Committed, it's the personal best the next submissions compare
+                # against. Tell the other processes now, whatever fails later on
+                glob.pb_records.replace(userID, s.fileMd5, s.gameMode, relax, s.oldPersonalBest, s.getRecord())
+                glob.redis.publish(PB_RECORDS_CHANNEL, orjson.dumps({
+                    'origin': os.getpid(),
+                    'user_id': userID,
+                    'md5': s.fileMd5,
+                    'mode': s.gameMode,
+                    'rx': relax
+                }))
 
+            # Anticheat side effects (restrictions, bans, notes) and the replay
+            # don't go in a transaction: a later failure mustn't roll them
+            # back, nor can they roll back the saved score
             if not restricted:
                 if endpoint != '-selector':
                     _cc_flags |= _cc_invalid_url
@@ -277,23 +294,9 @@ class handler(requestsManager.asyncRequestHandler):
 
                     rawReplay = self.request.files['score'][0]['body']
 
-                    if generalUtils.stringToBool(glob.conf.config['ftp']['enable']):
-                        t0 = time.perf_counter()
-                        try:
-                            with io.BytesIO(rawReplay) as data:
-                                with glob.ftp_lock:
-                                    glob.ftp.storbinary(f'STOR /replays/replay_{s.scoreID}.osr', data)
-                        except Exception as e:
-                            log.warning(f'submitModularHandler ({e})\n\n{traceback.format_exc()}')
-
-                            # in the event of ftp fail, save to disk
-                            # (we don't want to lose any replays)
-                            with open(f'.data/replays/replay_{s.scoreID}.osr', 'wb') as f:
-                                f.write(rawReplay)
-
-                        time_taken_ftp = time.perf_counter() - t0
-                        if time_taken_ftp > 2:
-                            log.warning(f'FTP replay submission took {time_taken_ftp:.2f}s!')
+                    if glob.replaySpool is not None:
+                        # On disk once this returns, uploaded in the background
+                        glob.replaySpool.add(s.scoreID, rawReplay)
                     else:
                         with open(f'.data/replays/replay_{s.scoreID}.osr', 'wb') as f:
                             f.write(rawReplay)
@@ -305,49 +308,58 @@ class handler(requestsManager.asyncRequestHandler):
                     userUtils.appendNotes(userID, f'Restricted due to missing replay while submitting a score ({s.scoreID}).')
                     log.warning(f'**{username}** {userID} has been restricted due to not submitting a replay on {beatmap.songName} ({beatmap.BeatmapID}).', discord='ac_general')
 
-            # Update beatmap playcount (and passcount)
-            beatmap.incrementPlaycount(s.fileMd5, s.passed)
-
-            # Let the api know of this score
-            if s.scoreID and not restricted:
-                glob.redis.publish('api:score_submission', f'{s.scoreID},{relax}')
+            with glob.db.batch() as dbBatch:
+                # Update beatmap playcount (and passcount)
+                beatmap.incrementPlaycount(s.fileMd5, s.passed)
+
+                # Let the api know of this score
+                if s.scoreID and not restricted:
+                    redisPipe.publish('api:score_submission', f'{s.scoreID},{relax}')
+
+                # If there was no exception, update stats (the exception is re-raised once committed)
+                if not midPPCalcException:
+                    # Get "before" stats for ranking panel (only if passed)
+                    if s.passed:
+                        # Get stats and rank
+                        oldUserData = glob.userStatsCache.get(userID, s.gameMode, relax)
+                        oldRank = userUtils.getGameRank(userID, s.gameMode, relax)
+
+                    # Always update users stats (total/ranked score, playcount, level, acc and pp)
+                    # even if not passed
+
+                    log.debug(f"[{'R' if relax else 'V'}] Updating {username}'s stats...")
+                    userUtils.updateStats(userID, s)
+
+                    # Get "after" stats for ranking panel
+                    # and to determine if we should update the leaderboard
+                    # (only if we passed that song)
+                    if s.passed:
+                        # Get new stats
+                        maxCombo = 0 if relax else userUtils.getMaxCombo(userID, s.gameMode)
+                        newUserData = userUtils.getUserStats(userID, s.gameMode, relax)
+                        glob.userStatsCache.update(userID, s.gameMode, relax, newUserData, pipe=redisPipe)
+
+                        # Update leaderboard (global and country) if score/pp has changed
+                        if s.completed == 3 and newUserData['pp'] != oldUserData['pp']:
+                            leaderboardHelper.update(userID, newUserData['pp'], s.gameMode, relax, pipe=redisPipe)
+                            leaderboardHelper.updateCountry(userID, newUserData['pp'], s.gameMode, relax, pipe=redisPipe)
+
+                    # TODO: Update total hits and max combo
+                    userUtils.updateLatestActivity(userID)
+                    userUtils.IPLog(userID, ip)
+
+                    if beatmapInfo and s.passed:
+                        redisPipe.publish('peppy:update_cached_stats', userID)
+
+            glob.submissionStats['db_statements'] += dbStatements + dbBatch.statements
+            glob.submissionStats['redis_commands'] += len(redisPipe.command_stack)
+            redisPipe.execute()
 
             # Re-raise pp calc exception after saving score, cake, replay etc
             # so Sentry can track it without breaking score submission
             if midPPCalcException:
                 raise ppCalcException(midPPCalcException)
 
-            # If there was no exception, update stats and build score submitted panel
-            # Get "before" stats for ranking panel (only if passed)
-            if s.passed:
-                # Get stats and rank
-                oldUserData = glob.userStatsCache.get(userID, s.gameMode, relax)
-                oldRank = userUtils.getGameRank(userID, s.gameMode, relax)
-
-            # Always update users stats (total/ranked score, playcount, level, acc and pp)
-            # even if not passed
-
-            log.debug(f"[{'R' if relax else 'V'}] Updating {username}'s stats...")
-            userUtils.updateStats(userID, s)
-
-            # Get "after" stats for ranking panel
-            # and to determine if we should update the leaderboard
-            # (only if we passed that song)
-            if s.passed:
-                # Get new stats
-                maxCombo = 0 if relax else userUtils.getMaxCombo(userID, s.gameMode)
-                newUserData = userUtils.getUserStats(userID, s.gameMode, relax)
-                glob.userStatsCache.update(userID, s.gameMode, relax, newUserData)
-
-                # Update leaderboard (global and country) if score/pp has changed
-                if s.completed == 3 and newUserData['pp'] != oldUserData['pp']:
-                    leaderboardHelper.update(userID, newUserData['pp'], s.gameMode, relax)
-                    leaderboardHelper.updateCountry(userID, newUserData['pp'], s.gameMode, relax)
-
-            # TODO: Update total hits and max combo
-            userUtils.updateLatestActivity(userID)
-            userUtils.IPLog(userID, ip)
-
             log.debug('Score submission and user stats update done!')
 
             # Score has been submitted, do not retry sending the score if
@@ -363,12 +375,18 @@ class handler(requestsManager.asyncRequestHandler):
             if beatmapInfo and s.passed:
                 log.debug('Started building ranking panel.')
 
-                glob.redis.publish('peppy:update_cached_stats', userID)
-                newScoreboard = scoreboard.scoreboard(username, s.gameMode, beatmapInfo, False, relax = relax)
-                newScoreboard.setPersonalBestRank()
-                personalBestID = newScoreboard.getPersonalBestID()
-                assert personalBestID is not None
-                currentPersonalBest = score.score(personalBestID, newScoreboard.personalBestRank)
+                # This score or the one it didn't beat, already looked up by setCompletedStatus
+                personalBest = s.getRecord() if s.completed == 3 else s.getPersonalBest()
+                assert personalBest is not None
+                currentPersonalBest = score.score(relax = relax)
+                currentPersonalBest.setDataFromDict(personalBest, username=username)
+
+                # Rank it against the map's rank index rather than counting scores in the db
+                personalBestRank = leaderboardHelper.getScoreRank(
+                    s.gameMode, relax, beatmapInfo,
+                    currentPersonalBest.pp if beatmapInfo.sort_by_pp else currentPersonalBest.score
+                )
+                currentPersonalBest.setRank(personalBestRank)
 
                 # Get rank info (current rank, pp/score to next rank, user who is 1 rank above us)
                 rankInfo = leaderboardHelper.getRankInfo(userID, s.gameMode, relax)
@@ -394,7 +412,7 @@ class handler(requestsManager.asyncRequestHandler):
                 """ Globally announcing plays. """
                 if s.completed == 3 and not restricted and beatmapInfo.rankedStatus >= rankedStatuses.RANKED:
                     annmsg: Optional[str] = None
-                    if newScoreboard.personalBestRank == 1:
+                    if personalBestRank == 1:
                         scoreUtils.newFirst(s.scoreID, userID, s.fileMd5, s.gameMode, relax)
 
                         profile_embed = userUtils.getProfileEmbed(userID, clan=True)
@@ -422,7 +440,9 @@ class handler(requestsManager.asyncRequestHandler):
                             'to': '#announce',
                             'msg': annmsg
                         })
-                        requests.get(f'{glob.conf.config["server"]["banchourl"]}/api/v1/fokabotMessage?{params}', timeout= 2)
+                        submissionPipeline.announcements.background(
+                            requests.get, f'{glob.conf.config["server"]["banchourl"]}/api/v1/fokabotMessage?{params}', timeout= 2
+                        )
 
                 # Write message to client
                 self.write(output)
@@ -444,10 +464,17 @@ class handler(requestsManager.asyncRequestHandler):
 
             # Datadog stats
             glob.dog.increment(f'{glob.DATADOG_PREFIX}.submitted_scores')
+            glob.submissionStats['scores'] += 1
 
             if s.completed == 3:
-                lb_cache = glob.lb_cache.get_lb_cache(s.gameMode, relax)
-                glob.lb_cache.clear_lb_cache(lb_cache, beatmapInfo.fileMD5)
+                # mania has no relax leaderboards
+                if not restricted and not (relax and s.gameMode == gameModes.MANIA):
+                    # Patch cached leaderboards with the new personal best
+                    glob.lb_cache.update_user_score(
+                        s.gameMode, relax, beatmapInfo.fileMD5, userID,
+                        s.getLeaderboardRow(userUtils.getCountry(userID), beatmapInfo.sort_by_pp),
+                        s.mods, s.oldPersonalBest > 0
+                    )
 
                 glob.pb_cache.del_user_pb(s.gameMode, userID, beatmapInfo.fileMD5, relax)
 
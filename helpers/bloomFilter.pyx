@@ -0,0 +1,91 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+Compiled Bloom filter of hex digests (eg. score checksums).
+
+Digests are already uniformly distributed, so the two halves of their 128
+bits are used as the two hashes of Kirsch-Mitzenmacher double hashing,
+without hashing them again. Anything that isn't 32 hex digits is hashed
+with blake2b first.
+"""
+import mmap
+from hashlib import blake2b
+from math import ceil, exp, log
+
+from libc.stdint cimport uint8_t, uint64_t
+
+
+cdef int hexValue(Py_UCS4 c):
+    if '0' <= c <= '9':
+        return <int>c - 48
+    if 'a' <= c <= 'f':
+        return <int>c - 87
+    if 'A' <= c <= 'F':
+        return <int>c - 55
+    return -1
+
+
+cdef class BloomFilter:
+    cdef uint8_t[::1] bits
+    cdef readonly uint64_t size # bits
+    cdef readonly int hashes
+    cdef readonly uint64_t count # digests added
+
+    def __init__(self, uint64_t capacity, double errorRate = 0.01, bint shared = False):
+        """
+        :param capacity: number of digests it's sized for
+        :param errorRate: false positive rate once `capacity` digests are added
+        :param shared: if True, the bits are in shared memory: processes forked
+                       afterwards all use (and add to) the same filter
+        """
+        capacity = max(capacity, 1)
+        self.size = max(<uint64_t>ceil(-<double>capacity * log(errorRate) / log(2) ** 2), 8)
+        self.hashes = max(1, round(<double>self.size / capacity * log(2)))
+        # Anonymous mmaps are MAP_SHARED, and zeroed
+        self.bits = mmap.mmap(-1, (self.size + 7) // 8) if shared else bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    cdef void _hashes(self, str digest, uint64_t *h1, uint64_t *h2) except *:
+        cdef int i, v
+        cdef uint64_t a = 0, b = 0
+        if len(digest) == 32:
+            for i in range(32):
+                v = hexValue(digest[i])
+                if v < 0:
+                    break
+                if i < 16:
+                    a = (a << 4) | v
+                else:
+                    b = (b << 4) | v
+            else:
+                h1[0] = a
+                h2[0] = b | 1 # never 0, every hash would be the same
+                return
+
+        raw = blake2b(digest.encode(), digest_size=16).digest()
+        h1[0] = int.from_bytes(raw[:8], 'little')
+        h2[0] = int.from_bytes(raw[8:], 'little') | 1
+
+    cpdef void add(self, str digest) except *:
+        cdef uint64_t h1, h2, bit
+        cdef int i
+        self._hashes(digest, &h1, &h2)
+        for i in range(self.hashes):
+            bit = (h1 + i * h2) % self.size
+            self.bits[bit >> 3] |= 1 << (bit & 7)
+        self.count += 1
+
+    cpdef bint mightContain(self, str digest):
+        """False if `digest` was never added, True if it probably was"""
+        cdef uint64_t h1, h2, bit
+        cdef int i
+        self._hashes(digest, &h1, &h2)
+        for i in range(self.hashes):
+            bit = (h1 + i * h2) % self.size
+            if not self.bits[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    @property
+    def errorRate(self) -> float:
+        """Expected false positive rate, with what's been added so far"""
+        return (1 - exp(-<double>self.hashes * self.count / self.size)) ** self.hashes
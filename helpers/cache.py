@@ -1,12 +1,32 @@
 # Really generalised LRU cache class that I use frequently. Feel free to modify
 # as it may not be too good. THis is like 2 year old code dont judge.
+import os
+import sys
+import threading
 import time
-from typing import Dict, Optional, Tuple, Union
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import (TYPE_CHECKING, Any, Dict, Iterable, Iterator, List,
+                    Optional, Tuple, Union)
+from uuid import uuid4
+
+import orjson
+from redis.exceptions import WatchError
+
+from common.log import logUtils as log
+
+if TYPE_CHECKING:
+    from redis import Redis
 
 
 # The basic cache class.
 class Cache:
-    """Cache of objects with IDs."""
+    """LRU cache of objects with IDs, with lazily expired entries.
+
+    Tuple IDs are also indexed by their first element (eg. a beatmap md5),
+    so all of them can be removed at once with `remove_all_elements`.
+    Changes are made under a lock, handlers use it from the pool threads."""
 
     def __init__(self, cache_length : int = 5, cache_limit : int = 500):
         """Establishes a cache and configures the limits.
@@ -16,9 +36,17 @@ class Cache:
             cache_limit (int): A limit to how many objects can be max cached
                 before other objects start being removed.
         """
-        self._cache = {} # The main cache object.
+        # The main cache object, ordered from least to most recently used.
+        # Values are (expire, object) tuples.
+        self._cache: 'OrderedDict[Any, Tuple[float, object]]' = OrderedDict()
+        self._index: Dict[Any, set] = {} # First element of tuple ids -> ids.
+        self._lock = threading.RLock()
         self.length = cache_length * 60 # Multipled by 60 to get the length in seconds rather than minutes.
         self._cache_limit = cache_limit
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
     
     @property
     def cached_items(self) -> int:
@@ -26,24 +54,35 @@ class Cache:
 
         return len(self._cache)
     
-    def __len__(self): return self.cached_items()
+    def __len__(self): return self.cached_items
     
-    def cache(self, cache_id : Union[int, str, tuple], cache_obj : object) -> None:
-        """Adds an object to the cache."""
-        self._cache[cache_id] = {
-            "id" : cache_id,
-            "expire" : int(time.time()) + self.length,
-            "object" : cache_obj
-        }
-        self.run_checks()
+    def cache(self, cache_id : Union[int, str, tuple], cache_obj : object, expire : Optional[float] = None) -> None:
+        """Adds an object to the cache, expiring `self.length` seconds from
+        now unless an `expire` timestamp is passed."""
+
+        if expire is None:
+            expire = time.time() + self.length
+
+        with self._lock:
+            if cache_id in self._cache:
+                self._cache.move_to_end(cache_id)
+            elif isinstance(cache_id, tuple):
+                self._index.setdefault(cache_id[0], set()).add(cache_id)
+
+            self._cache[cache_id] = (expire, cache_obj)
+            self.run_checks()
     
     def remove_cache(self, cache_id : Union[int, str, tuple]) -> None:
         """Removes an object from cache."""
-        try:
-            del self._cache[cache_id]
-        except KeyError:
-            # It doesnt matter if it fails. All that matters is that no such object exist and if it doesnt exist in the first place, that's already objective complete.
-            pass
+        with self._lock:
+            try:
+                del self._cache[cache_id]
+            except KeyError:
+                # It doesnt matter if it fails. All that matters is that no such object exist and if it doesnt exist in the first place, that's already objective complete.
+                return
+
+            if isinstance(cache_id, tuple):
+                self._unindex(cache_id)
     
     def get(self, cache_id : Union[int, str, tuple]) -> object:
         """Retrieves a cached object from cache."""
@@ -51,69 +90,125 @@ class Cache:
         # Try to get it from cache.
         curr_obj = self._cache.get(cache_id)
         if curr_obj is None:
+            self.misses += 1
+            return None
+
+        expire, obj = curr_obj
+        if expire < time.time():
+            # Expired, nobody looked it up since it was cached.
+            self.remove_cache(cache_id)
+            self.misses += 1
             return None
-        return curr_obj["object"]
+
+        self.hits += 1
+        with self._lock:
+            try: self._cache.move_to_end(cache_id)
+            except KeyError: pass # Removed by another thread meanwhile.
+        return obj
+
+    def clear(self) -> None:
+        """Removes every object from cache."""
+
+        with self._lock:
+            self._cache.clear()
+            self._index.clear()
 
     def remove_all_elements(self, pattern: str) -> None:
         # remove all tuple entries with this as a starter
 
-        for key in self._get_cached_ids():
-            if isinstance(key, tuple) and key[0] == pattern:
-                self.remove_cache(key)
-    
-    def _get_cached_ids(self) -> list:
-        """Returns a list of all cache IDs currently cached."""
-        return tuple(self._cache)
-    
-    def _get_expired_cache(self) -> list:
-        """Returns a list of expired cache IDs."""
-        current_timestamp = int(time.time())
-        expired = []
-        for cache_id in self._get_cached_ids():
-            # We dont want to use get as that  will soon have the ability to make its own objects, slowing this down.
-            if self._cache[cache_id]["expire"] < current_timestamp:
-                # This cache is expired.
-                expired.append(cache_id)
-        return expired
+        with self._lock:
+            for key in self._index.pop(pattern, ()):
+                self._cache.pop(key, None)
+    
+    def _unindex(self, cache_id: tuple) -> None:
+        """Removes a tuple ID from the secondary index."""
+
+        keys = self._index.get(cache_id[0])
+        if keys is None:
+            return
+
+        keys.discard(cache_id)
+        if not keys:
+            self._index.pop(cache_id[0], None)
+    
+    def _get_cached_ids(self) -> tuple:
+        """Returns a tuple of all cache IDs currently cached."""
+        with self._lock:
+            return tuple(self._cache)
+    
+    def _pop_oldest(self) -> Optional[Tuple[Any, Tuple[float, object]]]:
+        """Removes the least recently used object, returning it along with its
+        ID. Returns `None` if the cache is empty."""
+
+        try: cache_id, curr_obj = self._cache.popitem(last=False)
+        except KeyError: return None
+
+        if isinstance(cache_id, tuple):
+            self._unindex(cache_id)
+        return cache_id, curr_obj
     
     def _remove_expired_cache(self) -> None:
-        """Removes all of the expired cache."""
-        for cache_id in self._get_expired_cache():
-            self.remove_cache(cache_id)
+        """Removes expired objects from the least recently used end, stopping
+        at the first one still valid. The rest expire lazily on `get`."""
+        current_timestamp = time.time()
+        while self._cache:
+            if next(iter(self._cache.values()))[0] >= current_timestamp:
+                break
+            self._pop_oldest()
     
     def _remove_limit_cache(self) -> None:
-        """Removes all objects past limit if cache reached its limit."""
-        
-        # Calculate how much objects we have to throw away.
-        throw_away_count = len(self._get_cached_ids()) - self._cache_limit
-
-        if not throw_away_count:
-            # No levels to throw away
-            return
+        """Removes the least recently used objects if cache reached its limit."""
         
-        # Get x oldest ids to remove.
-        throw_away_ids = self._get_cached_ids()[:throw_away_count]
-        for cache_id in throw_away_ids:
-            self.remove_cache(cache_id)
+        while len(self._cache) > self._cache_limit:
+            if self._pop_oldest() is None:
+                break
+            self.evictions += 1
     
     def run_checks(self) -> None:
         """Runs checks on the cache."""
-        self._remove_expired_cache()
-        self._remove_limit_cache()
+        with self._lock:
+            self._remove_expired_cache()
+            self._remove_limit_cache()
     
     def get_all_items(self):
         """Generator that lists all of the objects currently cached."""
 
-        # return [obj["object"] for _, obj in self._cache.items()]
-
         # Make it a generator for performance.
-        for obj in self._cache.values(): yield obj["object"]
+        current_timestamp = time.time()
+        with self._lock:
+            items = tuple(self._cache.values())
+        for expire, obj in items:
+            if expire >= current_timestamp: yield obj
     
     def get_all_keys(self):
         """Generator that returns all keys of the keys to the cache."""
 
         return self._get_cached_ids()
 
+    def get_keys(self, pattern: str) -> tuple:
+        """Returns all tuple keys starting with `pattern`."""
+
+        with self._lock:
+            return tuple(self._index.get(pattern, ()))
+
+    def peek(self, cache_id : Union[int, str, tuple]) -> object:
+        """Retrieves a cached object without counting it as a hit or
+        marking it as recently used."""
+
+        curr_obj = self._cache.get(cache_id)
+        if curr_obj is None or curr_obj[0] < time.time():
+            return None
+        return curr_obj[1]
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
 # Commonly used cache structures.
 # ---- Personal Best Cache ----
 class PersonalBestCache:
@@ -121,7 +216,7 @@ class PersonalBestCache:
 
     def __init__(self) -> None:
         # A dict indexed by mode, beatmap_md5, user_id
-        self._cache: Tuple[int, Dict[str, Dict[int, tuple]]] = ({},) * 7
+        self._cache: Tuple[Dict[str, Dict[int, tuple]], ...] = tuple({} for _ in range(7))
     
     def get_user_pb(self, mode: int, user_id: int, bmap_md5: str, rx: bool) -> Optional[tuple]:
         """Fetches a personal best score for a user. Returns `None` if not found."""
@@ -132,15 +227,16 @@ class PersonalBestCache:
 
         return bmap_cache.get(user_id)
     
-    def set_user_pb(self, mode: int, user_id: int, bmap_md5: str, score_str: str, rx: bool):
-        """Caches a user's personal best score."""
+    def set_user_pb(self, mode: int, user_id: int, bmap_md5: str, score_row: tuple, rx: bool):
+        """Caches a user's personal best score (its leaderboard row, the rank
+        is worked out on each request)."""
 
         if rx: mode += 4
 
         if not self._cache[mode].get(bmap_md5):
             self._cache[mode][bmap_md5] = {}
         
-        self._cache[mode][bmap_md5][user_id] = score_str
+        self._cache[mode][bmap_md5][user_id] = score_row
     
     def del_user_pb(self, mode: int, user_id: int, bmap_md5: str, rx: bool):
         """Deletes a user's personal best from a beatmap. Does NOT raise an
@@ -160,13 +256,323 @@ class PersonalBestCache:
         try: del self._cache[mode][bmap_md5]
         except KeyError: pass
 
+# ---- Personal Best Record Cache ----
+DEF_PB_RECORD_LEN = 10 # Scores from the same user on the same map come in bursts.
+DEF_PB_RECORD_COUNT = 20_000
+PB_RECORDS_CHANNEL = "lets:pb_records_invalidate" # New personal bests, from any LETS process.
+# Scores changed outside of LETS (pp recalculations, wipes): {"md5": ...} for
+# a beatmap's personal bests, {} for all of them.
+PB_RECORDS_NUKE_CHANNEL = "lets:pb_records_nuke"
+
+class PersonalBestRecordCache:
+    """Users' personal best rows (as in the scores tables), by beatmap md5,
+    user, mode and relax, shared by every step of score submission.
+
+    Unlike `PersonalBestCache`, restricted users' scores are in there too,
+    and users without a personal best are cached as an empty dict."""
+
+    def __init__(self, cache_length: int = DEF_PB_RECORD_LEN,
+                 cache_limit: int = DEF_PB_RECORD_COUNT) -> None:
+        self._cache = Cache(cache_length, cache_limit)
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int, bmap_md5: str, mode: int, rx: bool) -> Optional[dict]:
+        """Fetches a user's personal best row, an empty dict if they don't
+        have one. Returns `None` if not cached."""
+
+        return self._cache.get((bmap_md5, user_id, mode, rx))
+
+    def set(self, user_id: int, bmap_md5: str, mode: int, rx: bool, row: Optional[dict]) -> None:
+        """Caches a user's personal best row (`None` if they don't have one)."""
+
+        self._cache.cache((bmap_md5, user_id, mode, rx), row or {})
+
+    def replace(self, user_id: int, bmap_md5: str, mode: int, rx: bool,
+                old_id: int, row: dict) -> None:
+        """Caches a new personal best, if the cached one is still the score
+        it beat (`old_id`, 0 if none). Dropped otherwise, it changed meanwhile."""
+
+        key = (bmap_md5, user_id, mode, rx)
+        with self._lock:
+            current = self._cache.peek(key)
+            if current is None or current.get("id", 0) == old_id:
+                self._cache.cache(key, row)
+            else:
+                self._cache.remove_cache(key)
+
+    def remove(self, user_id: int, bmap_md5: str, mode: int, rx: bool) -> None:
+        """Removes a user's personal best. Doesn't matter if it isn't cached."""
+
+        self._cache.remove_cache((bmap_md5, user_id, mode, rx))
+
+    def nuke_bmap(self, bmap_md5: str) -> None:
+        """Removes every personal best on a beatmap."""
+
+        self._cache.remove_all_elements(bmap_md5)
+
+    def nuke(self) -> None:
+        """Removes every personal best."""
+
+        self._cache.clear()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return self._cache.stats
+
+# ---- Parsed Beatmap Cache ----
+class ParsedBeatmap:
+    """A verified .osu file and whatever the pp calculators parsed from it."""
+
+    __slots__ = ("md5", "data", "parsed")
+
+    def __init__(self, md5: str, data: bytes) -> None:
+        self.md5 = md5
+        self.data = data
+
+        # Calculator specific objects, keyed by whatever they need
+        # (eg. game mode and mods) as they may differ per score.
+        self.parsed: Dict[tuple, Any] = {}
+
+class ParsedBeatmapCache:
+    """LRU cache of `ParsedBeatmap`s indexed by beatmap md5, shared by all
+    the pp calculators (from the pool threads, changes are made under a
+    lock)."""
+
+    def __init__(self, cache_limit: int = 256) -> None:
+        self._cache: 'OrderedDict[str, ParsedBeatmap]' = OrderedDict()
+        self._cache_limit = cache_limit
+        self._lock = threading.Lock()
+        self._loading: Dict[Any, List] = {} # key -> [lock, threads using it]
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int: return len(self._cache)
+
+    def get(self, bmap_md5: str) -> Optional[ParsedBeatmap]:
+        """Fetches a parsed beatmap, marking it as recently used.
+        Returns `None` if not found."""
+
+        bmap = self._cache.get(bmap_md5)
+        if bmap is None:
+            self.misses += 1
+            return
+
+        self.hits += 1
+        with self._lock:
+            try: self._cache.move_to_end(bmap_md5)
+            except KeyError: pass # Evicted by another thread meanwhile.
+        return bmap
+
+    def peek(self, bmap_md5: str) -> Optional[ParsedBeatmap]:
+        """Fetches a parsed beatmap without counting it as a hit or marking
+        it as recently used. Returns `None` if not found."""
+
+        return self._cache.get(bmap_md5)
+
+    @contextmanager
+    def loading(self, key: Any) -> Iterator[None]:
+        """Held while a beatmap (md5 key) or something parsed from it ((md5,
+        parsed key) key) is loaded. Other threads missing the same one wait
+        for it, then find it cached instead of loading it again."""
+
+        with self._lock:
+            entry = self._loading.get(key)
+            if entry is None:
+                entry = self._loading[key] = [threading.Lock(), 0]
+            entry[1] += 1
+
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._loading[key]
+
+    def add(self, bmap_md5: str, data: bytes) -> ParsedBeatmap:
+        """Caches a verified .osu file, evicting the least recently used
+        beatmaps if we're over the limit."""
+
+        bmap = ParsedBeatmap(bmap_md5, data)
+        with self._lock:
+            self._cache[bmap_md5] = bmap
+
+            while len(self._cache) > self._cache_limit:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+
+        return bmap
+
+    def remove(self, bmap_md5: str) -> None:
+        """Drops a beatmap from the cache. Does NOT raise an exception if it
+        was not present in the first place."""
+
+        with self._lock:
+            self._cache.pop(bmap_md5, None)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+# ---- Ignored Maps Cache ----
+DEF_IGNORED_MAPS_LEN = 1_440 # 1 day, maps get submitted or updated eventually.
+DEF_IGNORED_MAPS_COUNT = 50_000
+
+class IgnoredMapsCache(Cache):
+    """Ranked statuses of maps getscores doesn't serve leaderboards for (not
+    submitted or needing an update), by md5.
+
+    Saved to a file and loaded back on startup, so a restart doesn't send
+    every request for those maps to the osu!api again."""
+
+    def __init__(self, path: str, cache_length: int = DEF_IGNORED_MAPS_LEN,
+                 cache_limit: int = DEF_IGNORED_MAPS_COUNT) -> None:
+        super().__init__(cache_length, cache_limit)
+        self.path = path
+        self._dirty = False
+
+    def cache(self, cache_id: str, cache_obj: int, expire: Optional[float] = None) -> None:
+        super().cache(cache_id, cache_obj, expire)
+        self._dirty = True
+
+    def remove_cache(self, cache_id: str) -> None:
+        if cache_id in self._cache:
+            super().remove_cache(cache_id)
+            self._dirty = True
+
+    def load(self) -> int:
+        """Loads the maps saved by `save`, skipping expired ones.
+        Returns how many maps were loaded."""
+
+        try:
+            with open(self.path, "rb") as f:
+                entries = orjson.loads(f.read())
+        except FileNotFoundError:
+            return 0
+
+        current_timestamp = time.time()
+        # Oldest first, expired entries are removed from the LRU end.
+        for md5, (expire, status) in sorted(entries.items(), key=lambda e: e[1][0]):
+            if expire >= current_timestamp:
+                super().cache(md5, status, expire)
+
+        return len(self._cache)
+
+    def save(self) -> None:
+        """Saves the cached maps to `self.path`, if anything was added."""
+
+        if not self._dirty:
+            return
+
+        self._dirty = False
+        current_timestamp = time.time()
+        entries = {
+            md5: entry for md5, entry in tuple(self._cache.items())
+            if entry[0] >= current_timestamp
+        }
+
+        # Write to a temporary file first, a crash mid-write mustn't
+        # leave us with a truncated one (per process, they all save it).
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(entries))
+        os.replace(tmp_path, self.path)
+
+# ---- Beatmap Cache ----
+DEF_BEATMAP_CACHE_LEN = 10 # Only guards against writes nobody tells us about.
+DEF_BEATMAP_CACHE_COUNT = 20_000
+
+class BeatmapCache:
+    """Rows of the beatmaps table, by md5 and by beatmap id.
+
+    Rows are cached as they are in the db, so `beatmap.setDataFromDB` still
+    applies its expiry (`latest_update`) and frozen status rules to them.
+    They are shared between lookups, don't mutate them outside of here."""
+
+    def __init__(self, cache_length: int = DEF_BEATMAP_CACHE_LEN,
+                 cache_limit: int = DEF_BEATMAP_CACHE_COUNT) -> None:
+        self._by_md5 = Cache(cache_length, cache_limit)
+        self._by_id = Cache(cache_length, cache_limit)
+
+    def get(self, bmap_md5: str) -> Optional[dict]:
+        """Fetches a beatmap's row by md5. Returns `None` if not cached."""
+
+        return self._by_md5.get(bmap_md5)
+
+    def get_by_id(self, beatmap_id: int) -> Optional[dict]:
+        """Fetches a beatmap's row by beatmap id. Returns `None` if not cached."""
+
+        return self._by_id.get(beatmap_id)
+
+    def add(self, row: dict) -> None:
+        """Caches a beatmap's row."""
+
+        # An updated difficulty keeps its id, but its old md5 is gone from the db.
+        old_row = self._by_id.peek(row["beatmap_id"])
+        if old_row is not None and old_row["beatmap_md5"] != row["beatmap_md5"]:
+            self._by_md5.remove_cache(old_row["beatmap_md5"])
+
+        self._by_md5.cache(row["beatmap_md5"], row)
+        self._by_id.cache(row["beatmap_id"], row)
+
+    def remove(self, bmap_md5: Optional[str] = None, beatmap_id: Optional[int] = None) -> None:
+        """Removes a beatmap by md5 and/or beatmap id, along with the row's
+        other key. Doesn't matter if it isn't cached."""
+
+        for row in (self._by_md5.peek(bmap_md5), self._by_id.peek(beatmap_id)):
+            if row is not None:
+                self._by_md5.remove_cache(row["beatmap_md5"])
+                self._by_id.remove_cache(row["beatmap_id"])
+
+        self._by_md5.remove_cache(bmap_md5)
+        self._by_id.remove_cache(beatmap_id)
+
+    def increment_playcount(self, bmap_md5: str, passed: bool) -> None:
+        """Mirrors `beatmap.incrementPlaycount` on the cached row, if any,
+        without waiting for the playcount buffer to be flushed."""
+
+        row = self._by_md5.peek(bmap_md5)
+        if row is None:
+            return
+
+        # In place, re-caching it would push its expiry back.
+        row["playcount"] += 1
+        if passed:
+            row["passcount"] += 1
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {"md5": self._by_md5.stats, "id": self._by_id.stats}
+
 DEF_CACHE_LEN = 120 # 2hrs
 DEF_CACHE_COUNT = 1_000
+DEF_FRIENDS_CACHE_LEN = 5 # Friends are added in-game, keep it short.
+DEF_LB_SIZE = 500 # Max scores fetched for a leaderboard.
+DEF_RANK_INDEX_COUNT = 200 # Maps with a rank index (hot maps, > DEF_LB_SIZE scores).
+
+# Leaderboard rows are getscores BASE_QUERY tuples, with these extra columns.
+# They're aliased in the query: a column selected twice under the same
+# DictCursor key (s.pp when sorting relax boards by pp) would shorten the rows.
+LB_ROW_USER_ID = 13
+LB_ROW_COUNTRY = 15
+LB_ROW_SORT = 16 # The column the leaderboard is sorted by (pp or score).
 
 _mode_to_text = (
     "std", "taiko", "catch", "mania"
 )
 
+# Shared (redis) leaderboard cache tier.
+LB_REDIS_KEY = "lets:lb_cache:{prefix}:{mode}:{bmap_md5}" # Hash of boards.
+LB_INVALIDATE_CHANNEL = "lets:lb_cache_invalidate"
+
 # Maybe should've used smth similar to above.
 class LeaderboardCache:
     """A class for managing the entirety of the leaderboard caching.
@@ -204,6 +610,28 @@ class LeaderboardCache:
             cache_limit= DEF_CACHE_COUNT,
         )
         # RX has no mania
+
+        # Friend user ids of each user (including themselves), used to
+        # build friends leaderboards out of the global ones.
+        self.friends = Cache(
+            cache_length= DEF_FRIENDS_CACHE_LEN,
+            cache_limit= DEF_CACHE_COUNT,
+        )
+    
+        # Sorted (sort value, user id) of every score on hot maps, indexed by
+        # (md5, mode, rx), so ranks past the cached leaderboards are a bisect.
+        self.rank_index = Cache(
+            cache_length= DEF_CACHE_LEN,
+            cache_limit= DEF_RANK_INDEX_COUNT,
+        )
+
+        # Optional shared tier. When set, boards are also stored in redis so
+        # every LETS process can use them, and invalidations are broadcast.
+        self.redis: 'Optional[Redis]' = None
+        self._origin = uuid4().hex # Tells our own broadcasts apart.
+
+        self.shared_hits = 0
+        self.shared_misses = 0
     
     def get_lb_cache(self, mode: int, rx: bool) -> Cache:
         """Returns a `Cache` object corresponding to the `mode` + `rx` combo."""
@@ -213,16 +641,430 @@ class LeaderboardCache:
 
         return self.__getattribute__(f"{prefix}_{suffix}")
 
+    def get(self, mode: int, rx: bool, cache_id: tuple) -> Optional['LbCacheResult']:
+        """Fetches a leaderboard, from the shared tier if it's not cached in
+        this process. Returns `None` if not found."""
+
+        lb_cache = self.get_lb_cache(mode, rx)
+        _lb = lb_cache.get(cache_id)
+        if _lb is not None or self.redis is None:
+            return _lb
+
+        data = self.redis.hget(_redis_key(mode, rx, cache_id[0]), _redis_field(cache_id))
+        if data is None:
+            self.shared_misses += 1
+            return
+
+        self.shared_hits += 1
+        _lb = LbCacheResult.deserialize(data)
+        lb_cache.cache(cache_id, _lb)
+        return _lb
+
+    def add(self, mode: int, rx: bool, cache_id: tuple, _lb: 'LbCacheResult') -> None:
+        """Caches a leaderboard, in the shared tier too."""
+
+        self.get_lb_cache(mode, rx).cache(cache_id, _lb)
+
+        if self.redis is not None:
+            key = _redis_key(mode, rx, cache_id[0])
+            pipe = self.redis.pipeline()
+            pipe.hset(key, _redis_field(cache_id), _lb.serialize())
+            pipe.expire(key, DEF_CACHE_LEN * 60)
+            pipe.execute()
+
     def clear_lb_cache(self, lb_cache: Cache, bmap_md5: str) -> None:
         """Clears given leaderboard cache object"""
 
         lb_cache.remove_all_elements(bmap_md5) # cool idea james!
 
+    def clear_bmap(self, mode: int, rx: bool, bmap_md5: str) -> None:
+        """Clears a beatmap's leaderboards, in the shared tier too. Every
+        process gets beatmap updates, so this isn't broadcast."""
+
+        self.clear_lb_cache(self.get_lb_cache(mode, rx), bmap_md5)
+        self.rank_index.remove_cache((bmap_md5, mode, rx))
+
+        if self.redis is not None:
+            self.redis.delete(_redis_key(mode, rx, bmap_md5))
+
+    def update_user_score(self, mode: int, rx: bool, bmap_md5: str, user_id: int,
+                          row: tuple, mods: int, had_score: bool) -> None:
+        """Patches the cached leaderboards of a beatmap with a user's new
+        personal best, instead of clearing them.
+
+        `row` is the new score's leaderboard row, `had_score` whether the user
+        already had a personal best on the map. Boards that can't be patched
+        exactly are cleared, friends and country ones are rebuilt from the
+        global board. Other processes drop their copies, and fetch the
+        patched ones from the shared tier."""
+
+        lb_cache = self.get_lb_cache(mode, rx)
+        for key in lb_cache.get_keys(bmap_md5):
+            _lb = lb_cache.peek(key)
+            if _lb is None: continue
+
+            if not _patch_lb(key, _lb, user_id, row, mods, had_score):
+                lb_cache.remove_cache(key)
+
+        self._patch_rank_index(mode, rx, bmap_md5, user_id, row[LB_ROW_SORT])
+
+        if self.redis is None:
+            return
+
+        redis_key = _redis_key(mode, rx, bmap_md5)
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(redis_key)
+                boards = pipe.hgetall(redis_key)
+
+                patched, dropped = {}, []
+                for field, data in boards.items():
+                    field = field.decode()
+                    _lb = LbCacheResult.deserialize(data)
+                    if _patch_lb(_redis_cache_id(bmap_md5, field), _lb, user_id, row, mods, had_score):
+                        patched[field] = _lb.serialize()
+                    else:
+                        dropped.append(field)
+
+                pipe.multi()
+                if patched: pipe.hmset(redis_key, patched)
+                if dropped: pipe.hdel(redis_key, *dropped)
+                pipe.execute()
+            except WatchError:
+                # Patched by another process meanwhile, start over.
+                self.redis.delete(redis_key)
+            except Exception as e:
+                # The score is already saved, don't fail its submission
+                # over the cache. Drop the boards, they may be stale.
+                log.error(f"Failed to patch cached leaderboards of {bmap_md5} ({e})")
+                self.redis.delete(redis_key)
+
+        self.redis.publish(LB_INVALIDATE_CHANNEL, orjson.dumps({
+            "origin": self._origin,
+            "md5": bmap_md5,
+            "mode": mode,
+            "rx": rx,
+            "user_id": user_id,
+            "sort": row[LB_ROW_SORT],
+        }))
+
+    def handle_invalidation(self, data: dict) -> bool:
+        """Drops a beatmap's leaderboards updated by another process. Returns
+        `False` if they were updated by this one."""
+
+        if data["origin"] == self._origin:
+            return False
+
+        self.clear_lb_cache(self.get_lb_cache(data["mode"], data["rx"]), data["md5"])
+        self._patch_rank_index(data["mode"], data["rx"], data["md5"], data["user_id"], data["sort"])
+        return True
+
+    def _patch_rank_index(self, mode: int, rx: bool, bmap_md5: str, user_id: int, value: float) -> None:
+        index = self.rank_index.peek((bmap_md5, mode, rx))
+        if index is not None:
+            index.replace_user_score(user_id, value)
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """Hit/miss/eviction stats of every leaderboard cache."""
+
+        stats = {
+            f"{prefix}_{suffix}": self.__getattribute__(f"{prefix}_{suffix}").stats
+            for prefix in ("vn", "rx")
+            for suffix in _mode_to_text
+            if hasattr(self, f"{prefix}_{suffix}")
+        }
+        stats["shared"] = {
+            "enabled": self.redis is not None,
+            "hits": self.shared_hits,
+            "misses": self.shared_misses,
+        }
+        return stats
+
+def _redis_key(mode: int, rx: bool, bmap_md5: str) -> str:
+    return LB_REDIS_KEY.format(prefix="rx" if rx else "vn", mode=mode, bmap_md5=bmap_md5)
+
+def _redis_field(cache_id: tuple) -> str:
+    """(md5, 'm', 64) -> 'm:64'"""
+    return ":".join(str(x) for x in cache_id[1:])
+
+def _redis_cache_id(bmap_md5: str, field: str) -> tuple:
+    """'m:64' -> (md5, 'm', 64)"""
+    kind, _, arg = field.partition(":")
+    if kind in ("m", "f"): return (bmap_md5, kind, int(arg))
+    if kind == "c": return (bmap_md5, kind, arg)
+    return (bmap_md5, kind)
+
+def _patch_lb(cache_id: tuple, _lb: 'LbCacheResult', user_id: int, row: tuple,
+              mods: int, had_score: bool) -> bool:
+    """Patches a cached leaderboard with a user's new personal best. Returns
+    `False` if it can't be patched exactly."""
+
+    if cache_id[1] == 'g':
+        return _lb.replace_user_score(user_id, row, had_score)
+    if cache_id[1] == 'm' and cache_id[2] == mods:
+        # The old personal best may have been set with other mods.
+        return _lb.replace_user_score(user_id, row, None if had_score else False)
+    if cache_id[1] == 'm':
+        return not had_score or _lb.replace_user_score(user_id, None, None)
+    return False
+
+def _count_greater(values: array, value: float) -> int:
+    """Returns how many of the (descending) `values` are greater than `value`,
+    ie. the index of its first occurrence."""
+
+    lo, hi = 0, len(values)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if values[mid] > value: lo = mid + 1
+        else: hi = mid
+    return lo
+
+def _count_not_less(values: array, value: float) -> int:
+    """Returns how many of the (descending) `values` are greater than or
+    equal to `value`, ie. where it goes after the older equal ones."""
+
+    lo, hi = 0, len(values)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if values[mid] >= value: lo = mid + 1
+        else: hi = mid
+    return lo
+
+class LbRankIndex:
+    """Sort values and user ids of every score on a leaderboard, in
+    descending order. Swapped, never mutated, like `LbCacheResult`."""
+
+    __slots__ = ("_columns",)
+
+    def __init__(self, scores: Iterable[tuple] = ()) -> None:
+        """`scores` are (user id, sort value) tuples, in descending order."""
+
+        user_ids, sort = array("q"), array("d")
+        for user_id, value in scores:
+            user_ids.append(user_id)
+            sort.append(value)
+        self._columns = (user_ids, sort)
+
+    @property
+    def count(self) -> int:
+        return len(self._columns[0])
+
+    def rank_of(self, value: float) -> int:
+        """Returns the rank of a score with sort value `value`."""
+
+        return _count_greater(self._columns[1], value) + 1
+
+    def replace_user_score(self, user_id: int, value: Optional[float]) -> None:
+        """Removes a user's score and inserts their new one (if passed)."""
+
+        user_ids, sort = (c[:] for c in self._columns)
+        try:
+            idx = user_ids.index(user_id)
+        except ValueError:
+            pass
+        else:
+            del user_ids[idx]
+            del sort[idx]
+
+        if value is not None:
+            idx = _count_not_less(sort, value)
+            user_ids.insert(idx, user_id)
+            sort.insert(idx, value)
+
+        self._columns = (user_ids, sort)
+
+def render_lb_row(row: tuple) -> Tuple[str, str]:
+    """Renders a leaderboard row in the format understood by the client, split
+    around the rank (which depends on where the row is shown)."""
+
+    return (f"{row[0]}|{row[12]}|{round(row[1])}|{row[2]}|{row[3]}|"
+            f"{row[4]}|{row[5]}|{row[6]}|{row[7]}|{row[8]}|"
+            f"{row[9]}|{row[10]}|{row[13]}|", f"|{row[11]}|1")
+
 class LbCacheResult:
-    """Simple lb cache result, storing cached information."""
+    """Simple lb cache result, storing cached information.
+
+    Scores are stored by column: user ids and sort values in arrays, country
+    codes interned, and each row pre-rendered for the client minus its rank.
+    Columns are swapped all at once, never mutated, so readers never see a
+    half-patched leaderboard."""
+
+    __slots__ = ("count", "_columns", "_countries", "_rendered")
+
+    def __init__(self, count: int, scores: Iterable[tuple] = ()) -> None:
+        user_ids, sort, countries, prefixes, suffixes = (
+            array("q"), array("d"), [], [], []
+        )
+        for row in scores:
+            user_ids.append(row[LB_ROW_USER_ID])
+            sort.append(row[LB_ROW_SORT])
+            countries.append(sys.intern(row[LB_ROW_COUNTRY]))
+            prefix, suffix = render_lb_row(row)
+            prefixes.append(prefix)
+            suffixes.append(suffix)
+
+        self.count = count
+        self._columns = (user_ids, sort, countries, prefixes, suffixes)
+        # Built lazily, along with the columns they were built from.
+        self._countries: Optional[Tuple[tuple, Dict[str, list]]] = None
+        self._rendered: Optional[Tuple[tuple, Dict[int, bytes]]] = None
+
+    @classmethod
+    def _from_columns(cls, count: int, columns: tuple) -> 'LbCacheResult':
+        _lb = cls(count)
+        _lb._columns = columns
+        return _lb
+
+    @property
+    def size(self) -> int:
+        """Number of cached scores (up to `DEF_LB_SIZE`)."""
+
+        return len(self._columns[0])
+
+    @property
+    def user_ids(self) -> array:
+        return self._columns[0]
+
+    def find_user(self, user_id: int) -> int:
+        """Returns the index of a user's score, -1 if not cached."""
+
+        try: return self._columns[0].index(user_id)
+        except ValueError: return -1
+
+    def rank_of(self, value: float) -> int:
+        """Returns the rank of a score with sort value `value`. Only exact if
+        the leaderboard is `complete` or the score would be among the
+        cached ones."""
 
-    __slots__ = ("count", "scores")
+        return _count_greater(self._columns[1], value) + 1
 
-    def __init__(self, count: int, scores: tuple) -> None:
+    def format_row(self, idx: int, place: int) -> str:
+        """Returns the client line of the `idx`th score, with rank `place`."""
+
+        return f"{self._columns[3][idx]}{place}{self._columns[4][idx]}"
+
+    def render(self, limit: int) -> str:
+        """Renders the top `limit` scores for the client."""
+
+        _, _, _, prefixes, suffixes = self._columns
+        return "\n".join([
+            f"{prefix}{place}{suffix}" for place, prefix, suffix in
+            zip(range(1, limit + 1), prefixes, suffixes)
+        ])
+
+    def encoded(self, limit: int) -> bytes:
+        """Returns the encoded top `limit` scores, rendered once per limit
+        (150/250/500 depending on the user's privileges)."""
+
+        columns = self._columns
+        if self._rendered is None or self._rendered[0] is not columns:
+            self._rendered = (columns, {})
+
+        rendered = self._rendered[1]
+        body = rendered.get(limit)
+        if body is None:
+            body = rendered[limit] = self.render(limit).encode()
+        return body
+
+    def serialize(self) -> bytes:
+        """Compact representation for the shared cache tier, columns are
+        stored as plain arrays."""
+
+        user_ids, sort, countries, prefixes, suffixes = self._columns
+        return orjson.dumps((
+            self.count, user_ids.tolist(), sort.tolist(), countries, prefixes, suffixes
+        ))
+
+    @classmethod
+    def deserialize(cls, data: bytes) -> 'LbCacheResult':
+        count, user_ids, sort, countries, prefixes, suffixes = orjson.loads(data)
+        return cls._from_columns(count, (
+            array("q", user_ids), array("d", sort),
+            [sys.intern(c) for c in countries], prefixes, suffixes
+        ))
+
+    @property
+    def complete(self) -> bool:
+        """Whether the cached scores are every score of the leaderboard, so
+        boards filtered out of it are exact."""
+
+        return self.size >= self.count
+
+    def replace_user_score(self, user_id: int, row: Optional[tuple],
+                           had_score: Optional[bool]) -> bool:
+        """Removes a user's score from the leaderboard and inserts `row` (if
+        passed) in order, adjusting `count`.
+
+        had_score -- whether the user had a score on this leaderboard. Only
+            used if it's not among the cached scores, `None` if not known.
+        return -- `False` if the leaderboard can't be patched exactly.
+        """
+
+        columns = tuple(c[:] for c in self._columns)
+        user_ids, sort, countries, prefixes, suffixes = columns
+
+        idx = self.find_user(user_id)
+        if idx != -1:
+            had_score = True
+            for column in columns: del column[idx]
+        elif self.complete:
+            had_score = False
+        elif had_score is None:
+            return False
+
+        count = self.count - had_score
+        complete = len(user_ids) >= count
+
+        if row is not None:
+            count += 1
+
+            # Sorted in descending order, ties go after the older scores.
+            value = row[LB_ROW_SORT]
+            idx = _count_not_less(sort, value)
+
+            # If some scores are missing, only insert it if it's before them.
+            if complete or idx < len(user_ids):
+                prefix, suffix = render_lb_row(row)
+                user_ids.insert(idx, user_id)
+                sort.insert(idx, value)
+                countries.insert(idx, sys.intern(row[LB_ROW_COUNTRY]))
+                prefixes.insert(idx, prefix)
+                suffixes.insert(idx, suffix)
+                for column in columns: del column[DEF_LB_SIZE:]
+
+        self._columns = columns
         self.count = count
-        self.scores = scores
+        return True
+
+    def _take(self, indexes: list) -> 'LbCacheResult':
+        """Returns a leaderboard made of the scores at `indexes`."""
+
+        user_ids, sort, countries, prefixes, suffixes = self._columns
+        return LbCacheResult._from_columns(len(indexes), (
+            array("q", [user_ids[i] for i in indexes]),
+            array("d", [sort[i] for i in indexes]),
+            [countries[i] for i in indexes],
+            [prefixes[i] for i in indexes],
+            [suffixes[i] for i in indexes],
+        ))
+
+    def filter_country(self, country: str) -> 'LbCacheResult':
+        """Returns the leaderboard of players from `country`, using a
+        per-country index of the scores."""
+
+        columns = self._columns
+        if self._countries is None or self._countries[0] is not columns:
+            countries = {}
+            for idx, _country in enumerate(columns[2]):
+                countries.setdefault(_country, []).append(idx)
+            self._countries = (columns, countries)
+
+        return self._take(self._countries[1].get(country, []))
+
+    def filter_users(self, user_ids: Union[set, frozenset]) -> 'LbCacheResult':
+        """Returns the leaderboard of players in `user_ids` (eg. friends)."""
+
+        return self._take([
+            idx for idx, user_id in enumerate(self._columns[0]) if user_id in user_ids
+        ])
@@ -0,0 +1,156 @@
+"""
+Checksums of the scores in db, for the duplicate score check.
+
+Almost every submitted score is new, yet each passed one used to probe the
+checksum index of its scores table. A Bloom filter per table, built from the
+table at startup and added to on every insert, tells most of them apart
+without the query; it only runs when the filter says the checksum might
+already be there.
+
+Other LETS processes insert scores too, their checksums come through
+`lets:score_checksums`. Processes forked by the same server share one set of
+filters, built before forking in shared memory: the table is scanned once,
+and kept in memory once.
+"""
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Sequence
+
+import orjson
+
+from common.log import logUtils as log
+from helpers.bloomFilter import BloomFilter
+from objects import glob
+
+TABLES = ('scores', 'scores_relax')
+CHANNEL = 'lets:score_checksums'
+LOAD_BATCH_SIZE = 100_000 # rows per query while loading
+HEADROOM = 1.5 # when sized from a table, room for the scores to come
+
+FetchAll = Callable[[str, Sequence[Any]], Sequence[Dict[str, Any]]]
+
+
+class ChecksumFilter:
+    """A `BloomFilter` of score checksums per scores table."""
+
+    def __init__(self, capacity: int = 0, errorRate: float = 0.01) -> None:
+        """
+        :param capacity: checksums each filter is sized for, 0 to size them from their table
+        :param errorRate: false positive rate once that many checksums are added
+        """
+        self.capacity = capacity
+        self.errorRate = errorRate
+        self.filters: Dict[str, BloomFilter] = {}
+        self.ready = False # until loaded, every check runs the query
+        self.loadTime = 0.0
+
+        self.lookups = 0
+        self.possibleHits = 0
+        self.falsePositives = 0
+
+    def start(self, fetchAll: Optional[FetchAll] = None) -> None:
+        """
+        Create the filters and fill them from the db
+
+        :param fetchAll: `glob.db.fetchAll`-like function to fill them with right away,
+                         in shared memory, before forking processes. If not passed,
+                         they're filled from `glob.db` in a daemon thread.
+        """
+        shared = fetchAll is not None
+        if fetchAll is None:
+            fetchAll = glob.db.fetchAll
+
+        for table in TABLES:
+            capacity = self.capacity
+            if not capacity:
+                # Cheaper than COUNT(*), and never less
+                rows = fetchAll(f'SELECT MAX(id) - MIN(id) + 1 AS count FROM {table}', ())
+                capacity = int((rows[0]['count'] or 0) * HEADROOM) if rows else 0
+            self.filters[table] = BloomFilter(capacity, self.errorRate, shared)
+
+        if shared:
+            self._load(fetchAll)
+        else:
+            threading.Thread(target=self._load, args=(fetchAll,), name='checksum-filter', daemon=True).start()
+
+    def _load(self, fetchAll: FetchAll) -> None:
+        t0 = time.perf_counter()
+        try:
+            for table, bloom in self.filters.items():
+                lastID = 0
+                while True:
+                    rows = fetchAll(
+                        f'SELECT id, checksum FROM {table} WHERE id > %s ORDER BY id LIMIT %s',
+                        [lastID, LOAD_BATCH_SIZE]
+                    )
+                    if not rows:
+                        break
+
+                    for row in rows:
+                        if row['checksum']:
+                            bloom.add(row['checksum'])
+                    lastID = rows[-1]['id']
+        except Exception as e:
+            log.error(f'Could not load score checksums, duplicate checks will keep using the db ({e})')
+            return
+
+        self.loadTime = time.perf_counter() - t0
+        self.ready = True
+        log.info(f'Loaded score checksums in {self.loadTime:.2f}s')
+
+    def add(self, table: str, checksum: str, publish: bool = True) -> None:
+        """
+        Add the checksum of a score inserted in `table`
+
+        :param publish: if True, tell the other LETS processes about it too
+        """
+        bloom = self.filters.get(table)
+        if bloom is None or not checksum:
+            return
+
+        bloom.add(checksum)
+        if publish:
+            glob.redis.publish(CHANNEL, orjson.dumps({'table': table, 'checksum': checksum}))
+
+    def exists(self, table: str, checksum: str, query: Callable[[], bool]) -> bool:
+        """
+        Whether a score with this checksum is already in `table`
+
+        :param query: checks the db, only called if the filter can't tell
+        :return: True if there's one
+        """
+        bloom = self.filters.get(table)
+        if not self.ready or bloom is None:
+            return query()
+
+        self.lookups += 1
+        if not bloom.mightContain(checksum):
+            return False
+
+        self.possibleHits += 1
+        duplicate = query()
+        if not duplicate:
+            self.falsePositives += 1
+        return duplicate
+
+    @property
+    def stats(self) -> Dict[str, object]:
+        # lookups the filter should have answered on its own
+        new = self.lookups - (self.possibleHits - self.falsePositives)
+        return {
+            'ready': self.ready,
+            'load_s': round(self.loadTime, 2),
+            'lookups': self.lookups,
+            'queries': self.possibleHits,
+            'false_positives': self.falsePositives,
+            'false_positive_rate': round(self.falsePositives / new, 6) if new else 0,
+            'tables': {
+                table: {
+                    'checksums': bloom.count,
+                    'size_mb': round(bloom.size / 8 / 1024 ** 2, 2),
+                    'hashes': bloom.hashes,
+                    'expected_false_positive_rate': round(bloom.errorRate, 6),
+                }
+                for table, bloom in self.filters.items()
+            },
+        }
@@ -122,6 +122,7 @@ class config:
         self.config.set('ftp', 'host', 'localhost')
         self.config.set('ftp', 'username', '')
         self.config.set('ftp', 'password', '')
+        self.config.set('ftp', 'connections', '4')
 
         self.config.add_section('redis')
         self.config.set('redis', 'host', 'localhost')
@@ -137,11 +138,16 @@ class config:
         self.config.set('server', 'serverurl', 'http://127.0.0.1:5002')
         self.config.set('server', 'banchourl', 'http://127.0.0.1:5001')
         self.config.set('server', 'threads', '16')
+        self.config.set('server', 'processes', '1') # 0 = one per CPU
         self.config.set('server', 'apikey', 'changeme')
 
         self.config.add_section('cache')
         self.config.set('cache', 'enable', 'False')
         self.config.set('cache', 'port', '5000')
+        self.config.set('cache', 'shared', 'False')
+        self.config.set('cache', 'checksumfilter', 'True')
+        self.config.set('cache', 'checksumcapacity', '0') # per scores table, 0 = sized from the table
+        self.config.set('cache', 'checksumerrorrate', '0.01')
 
         self.config.add_section('sentry')
         self.config.set('sentry', 'enable', 'False')
@@ -156,6 +162,7 @@ class config:
         self.config.set('osuapi', 'enable', 'True')
         self.config.set('osuapi', 'apiurl', 'https://osu.ppy.sh')
         self.config.set('osuapi', 'apikey', 'YOUR_OSU_API_KEY_HERE')
+        self.config.set('osuapi', 'ratelimit', '1200') # requests per minute, per key
 
         self.config.add_section('mirror')
         self.config.set('mirror', 'apiurl', 'http://pisstau.be/api')
@@ -0,0 +1,119 @@
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import MySQLdb.cursors
+
+from objects import glob
+
+
+@contextmanager
+def transaction() -> Iterator['MySQLdb.cursors.DictCursor']:
+    """
+    Run several queries on a single db worker, in one transaction.
+    Committed if the block succeeds, rolled back if it raises.
+
+    :return: a DictCursor on the worker's connection
+    """
+    db_worker = glob.db.pool.getWorker()
+    if db_worker is None:
+        raise RuntimeError('No database worker available')
+
+    cursor = None
+    try:
+        cursor = db_worker.connection.cursor(MySQLdb.cursors.DictCursor)
+        cursor.execute('START TRANSACTION')
+        try:
+            yield cursor
+        except:
+            db_worker.connection.rollback()
+            raise
+        db_worker.connection.commit()
+    finally:
+        if cursor is not None:
+            cursor.close()
+        glob.db.pool.putWorker(db_worker)
+
+
+def placeholders(count: int) -> str:
+    """
+    Placeholders for an IN (...) clause
+
+    :param count: number of values
+    :return: '%s, %s, ...'
+    """
+    return ', '.join(('%s',) * count)
+
+
+class Batch:
+    """Transaction of a `BatchingDb.batch()` block"""
+
+    def __init__(self, cursor: 'MySQLdb.cursors.DictCursor') -> None:
+        self.cursor = cursor
+        self.statements = 0
+
+
+class BatchingDb:
+    """
+    `glob.db` wrapper able to run every query of a block in one transaction.
+
+    Inside `batch()`, `execute`/`fetch`/`fetchAll` made from the same thread,
+    including the ones from common, use the batch's connection instead of
+    taking a worker and autocommitting each of them. Anything else is passed
+    through to the wrapped `dbConnector.db`.
+    """
+
+    def __init__(self, db) -> None:
+        self._db = db
+        self._local = threading.local()
+
+    def __getattr__(self, name: str):
+        return getattr(self._db, name)
+
+    def _cursor(self) -> Optional['MySQLdb.cursors.DictCursor']:
+        batch = getattr(self._local, 'batch', None)
+        if batch is None:
+            return None
+
+        batch.statements += 1
+        return batch.cursor
+
+    def execute(self, query: str, params=()):
+        cursor = self._cursor()
+        if cursor is None:
+            return self._db.execute(query, params)
+
+        cursor.execute(query, params)
+        return cursor.lastrowid
+
+    def fetch(self, query: str, params=(), _all: bool = False):
+        cursor = self._cursor()
+        if cursor is None:
+            return self._db.fetch(query, params, _all)
+
+        cursor.execute(query, params)
+        return cursor.fetchall() if _all else cursor.fetchone()
+
+    def fetchAll(self, query: str, params=()):
+        return self.fetch(query, params, True)
+
+    @contextmanager
+    def batch(self) -> Iterator[Batch]:
+        """
+        Run this thread's queries in one transaction until the block ends.
+        Committed if the block succeeds, rolled back if it raises.
+        Nested batches are part of the outer one.
+
+        :return: the `Batch`, counting its statements
+        """
+        batch = getattr(self._local, 'batch', None)
+        if batch is not None:
+            yield batch
+            return
+
+        with transaction() as cursor:
+            self._local.batch = batch = Batch(cursor)
+            try:
+                yield batch
+            finally:
+                self._local.batch = None
@@ -1,8 +1,68 @@
-from common.constants import gameModes
+from common.constants import gameModes, privileges
 from common.log import logUtils as log
 from common.ripple import userUtils
+from helpers.cache import LbRankIndex
 from objects import glob
 
+RANK_INDEX_QUERY = (
+    "SELECT s.userid, s.{order} FROM {table} s "
+    "INNER JOIN users a ON s.userid = a.id "
+    "WHERE a.privileges & {public} AND s.beatmap_md5 = %s "
+    "AND s.play_mode = %s AND s.completed = 3 "
+    "ORDER BY s.{order} DESC"
+)
+RANK_COUNT_QUERY = (
+    "SELECT COUNT(*) AS count FROM {table} s "
+    "INNER JOIN users a ON s.userid = a.id "
+    "WHERE a.privileges & {public} AND s.beatmap_md5 = %s "
+    "AND s.play_mode = %s AND s.completed = 3 AND s.{order} > %s"
+)
+RANK_INDEX_MAX_SCORES = 100_000 # Bigger boards are counted in db, not held in memory.
+
+def getScoreRank(gameMode: int, relax: bool, beatmap, sortValue: float) -> int:
+    """
+    Get the rank a score would have on a beatmap's global leaderboard,
+    from the cached leaderboard, the map's rank index or the db.
+    Rank indexes are only built for maps with a cached leaderboard
+    (hot maps), up to `RANK_INDEX_MAX_SCORES` scores.
+
+    :param gameMode: gameMode number
+    :param relax: whether to use rx or regular leaderboards
+    :param beatmap: beatmap object
+    :param sortValue: score's pp or score, depending on `beatmap.sort_by_pp`
+    :return: rank
+    """
+    rx = relax and gameMode != gameModes.MANIA
+    lb = glob.lb_cache.get_lb_cache(gameMode, rx).peek((beatmap.fileMD5, 'g'))
+    if lb is not None and (lb.complete or lb.rank_of(sortValue) <= lb.size):
+        return lb.rank_of(sortValue)
+
+    key = (beatmap.fileMD5, gameMode, rx)
+    index = glob.lb_cache.rank_index.get(key)
+    if index is not None:
+        return index.rank_of(sortValue)
+
+    order = 'pp' if beatmap.sort_by_pp else 'score'
+    table = 'scores_relax' if rx else 'scores'
+    if lb is None or lb.count > RANK_INDEX_MAX_SCORES:
+        # Cold or huge map, a single count is cheaper
+        return glob.db.fetch(RANK_COUNT_QUERY.format(
+            order=order,
+            table=table,
+            public=privileges.USER_PUBLIC,
+        ), [beatmap.fileMD5, gameMode, sortValue])['count'] + 1
+
+    log.debug(f'Building rank index for {beatmap.fileMD5}')
+    index = LbRankIndex(
+        tuple(row.values()) for row in glob.db.fetchAll(RANK_INDEX_QUERY.format(
+            order=order,
+            table=table,
+            public=privileges.USER_PUBLIC,
+        ), [beatmap.fileMD5, gameMode]) or ()
+    )
+    glob.lb_cache.rank_index.cache(key, index)
+    return index.rank_of(sortValue)
+
 
 def getRankInfo(userID: int, gameMode: int, relax: bool):
     """
@@ -39,7 +99,7 @@ def getRankInfo(userID: int, gameMode: int, relax: bool):
     data["currentRank"] = position + 1
     return data
 
-def update(userID: int, newScore: int, gameMode: int, relax: bool):
+def update(userID: int, newScore: int, gameMode: int, relax: bool, pipe = None):
     """
     Update gamemode's leaderboard.
     Doesn't do anything if userID is banned/restricted.
@@ -48,16 +108,17 @@ def update(userID: int, newScore: int, gameMode: int, relax: bool):
     :param newScore: new score or pp
     :param gameMode: gameMode number
     :param relax: whether to update rx or regular board
+    :param pipe: redis pipeline to queue the update on. Optional. If not passed, sent right away
     """
     if userUtils.isAllowed(userID):
         log.debug('Updating leaderboard...')
 
         board = 'relaxboard' if relax else 'leaderboard'
-        glob.redis.zadd(f'ripple:{board}:{gameModes.getGameModeForDB(gameMode)}', str(userID), str(newScore))
+        (pipe if pipe is not None else glob.redis).zadd(f'ripple:{board}:{gameModes.getGameModeForDB(gameMode)}', str(userID), str(newScore))
     else:
         log.debug(f'Leaderboard update for user {userID} skipped (not allowed)')
 
-def updateCountry(userID, newScore: int, gameMode: int, relax: bool):
+def updateCountry(userID, newScore: int, gameMode: int, relax: bool, pipe = None):
     """
     Update gamemode's country leaderboard.
     Doesn't do anything if userID is banned/restricted.
@@ -66,6 +127,7 @@ def updateCountry(userID, newScore: int, gameMode: int, relax: bool):
     :param newScore: new score or pp
     :param gameMode: gameMode number
     :param relax: whether to update rx or regular board
+    :param pipe: redis pipeline to queue the update on. Optional. If not passed, sent right away
     :return:
     """
     if userUtils.isAllowed(userID):
@@ -75,6 +137,6 @@ def updateCountry(userID, newScore: int, gameMode: int, relax: bool):
 
             board = 'relaxboard' if relax else 'leaderboard'
             k = f'ripple:{board}:{gameModes.getGameModeForDB(gameMode)}:{country}'
-            glob.redis.zadd(k, str(userID), str(newScore))
+            (pipe if pipe is not None else glob.redis).zadd(k, str(userID), str(newScore))
     else:
         log.debug(f'Country leaderboard update for user {userID} skipped (not allowed)')
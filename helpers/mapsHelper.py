@@ -1,9 +1,10 @@
+from hashlib import md5
 from os import path, remove
 
 from common import generalUtils
 from common.log import logUtils as log
 from constants import exceptions
-from helpers import osuapiHelper
+from helpers import cache, osuapiHelper
 from objects import glob
 
 
@@ -55,5 +56,70 @@ def cacheMap(mapFile, _beatmap):
         # Map file is already in folder
         log.debug("maps ~> Beatmap found in cache!")
 
+def getParsedMap(mapFile, _beatmap):
+    """
+    Get a verified .osu file from the parsed beatmaps cache, reading
+    (and downloading, if needed) it only on cache misses.
+
+    mapFile -- .osu file path
+    _beatmap -- beatmap object
+    return -- helpers.cache.ParsedBeatmap
+    """
+    parsedMap = glob.parsed_bmap_cache.get(_beatmap.fileMD5)
+    if parsedMap is not None:
+        return parsedMap
+
+    # One thread reads each map, the others missing it meanwhile wait for it
+    with glob.parsed_bmap_cache.loading(_beatmap.fileMD5):
+        parsedMap = glob.parsed_bmap_cache.peek(_beatmap.fileMD5)
+        if parsedMap is not None:
+            return parsedMap
+
+        fileContent = None
+        if path.isfile(mapFile):
+            with open(mapFile, "rb") as f:
+                fileContent = f.read()
+
+        # Custom beatmaps are never downloaded
+        if _beatmap.beatmapID < glob.BEATMAPS_START_INDEX and (
+            fileContent is None or
+            md5(fileContent).hexdigest() != _beatmap.fileMD5 or
+            not isBeatmap(content=fileContent)
+        ):
+            cacheMap(mapFile, _beatmap)
+            with open(mapFile, "rb") as f:
+                fileContent = f.read()
+
+        if fileContent is None:
+            raise exceptions.osuApiFailException("maps")
+
+        # Don't cache what osu! servers returned if it's not the map we asked for,
+        # the next request will try downloading it again.
+        if md5(fileContent).hexdigest() != _beatmap.fileMD5:
+            log.warning(f"maps ~> {_beatmap.beatmapID} osu file md5 mismatch, not caching it")
+            return cache.ParsedBeatmap(_beatmap.fileMD5, fileContent)
+
+        return glob.parsed_bmap_cache.add(_beatmap.fileMD5, fileContent)
+
+def getParsed(parsedMap, key, parse):
+    """
+    Get something parsed from a beatmap (eg. a pp calculator), parsing it
+    only if it's not cached, once even if several threads miss it
+
+    parsedMap -- helpers.cache.ParsedBeatmap
+    key -- key in `parsedMap.parsed` (eg. calculator and mods)
+    parse -- function parsing it
+    return -- whatever `parse` returned
+    """
+    parsed = parsedMap.parsed.get(key)
+    if parsed is not None:
+        return parsed
+
+    with glob.parsed_bmap_cache.loading((parsedMap.md5, key)):
+        parsed = parsedMap.parsed.get(key)
+        if parsed is None:
+            parsed = parsedMap.parsed[key] = parse()
+        return parsed
+
 def cachedMapPath(beatmap_id):
     return f".data/beatmaps/{beatmap_id}.osu" if beatmap_id < glob.BEATMAPS_START_INDEX else f"{glob.BEATMAPS_PATH}/osu/{beatmap_id}.osu"
@@ -1,13 +1,180 @@
 import random
+import threading
 import time
+from concurrent.futures import Future as ConcurrentFuture
+from typing import Dict, List, Optional, Tuple
 
 import requests
+import tornado.gen
+import tornado.ioloop
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient
 
 import orjson
 from common import generalUtils
 from common.log import logUtils as log
 from objects import glob
 
+API_TIMEOUT = 5 # seconds
+OSU_FILE_TIMEOUT = 10
+DEFAULT_RATE_LIMIT = 1200 # requests per minute, per key
+
+# Used when the async client isn't running (before startup, scripts)
+session = requests.Session()
+
+
+class KeyRateLimiter:
+    """Token bucket per osu!api key, spreading requests across all of them."""
+
+    def __init__(self, keys: List[str], perMinute: int = DEFAULT_RATE_LIMIT) -> None:
+        self.rate = perMinute / 60
+        self.burst = max(self.rate, 1.0) # one second worth of requests
+        self._buckets = {key: [self.burst, time.monotonic()] for key in keys}
+        self._lock = threading.Lock()
+
+    def acquire(self) -> Tuple[Optional[str], float]:
+        """
+        Take a token from the key with the most left
+
+        :return: (key, 0) if one had a token, otherwise (None, seconds until one will)
+        """
+        with self._lock:
+            now = time.monotonic()
+            bestKey, bestTokens = None, -1.0
+            for key, bucket in self._buckets.items():
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+                if bucket[0] > bestTokens:
+                    bestKey, bestTokens = key, bucket[0]
+
+            if bestKey is None:
+                raise ValueError('No osu!api keys configured')
+
+            if bestTokens < 1:
+                return None, (1 - bestTokens) / self.rate
+
+            self._buckets[bestKey][0] -= 1
+            return bestKey, 0
+
+
+class OsuApiClient:
+    """
+    Non blocking osu!api client, running on the IOLoop.
+
+    Identical requests in flight at the same time share a single one,
+    and api keys are rate limited by a `KeyRateLimiter`.
+    """
+
+    def __init__(self, keys: List[str], perMinute: int = DEFAULT_RATE_LIMIT, ioLoop=None) -> None:
+        self.ioLoop = ioLoop or tornado.ioloop.IOLoop.current()
+        self.http = AsyncHTTPClient()
+        self.limiter = KeyRateLimiter(keys, perMinute)
+        self._inFlight: Dict[Tuple[str, bool], Future] = {}
+
+        self.requests = 0
+        self.coalesced = 0
+        self.errors = 0
+
+    def fetch(self, url: str, authed: bool = True, timeout: float = API_TIMEOUT) -> Future:
+        """
+        Request `url` (without api key), sharing identical requests in flight.
+        Must be called from the IOLoop.
+
+        :param url: full url, without api key
+        :param authed: if True, append an api key to the url
+        :param timeout: request timeout, in seconds
+        :return: future resolving to the response body, None if the request failed
+        """
+        future = self._inFlight.get((url, authed))
+        if future is not None:
+            self.coalesced += 1
+            return future
+
+        future = self._fetch(url, authed, timeout)
+        if not future.done():
+            self._inFlight[(url, authed)] = future
+            future.add_done_callback(lambda _: self._inFlight.pop((url, authed), None))
+        return future
+
+    @tornado.gen.coroutine
+    def _fetch(self, url: str, authed: bool, timeout: float):
+        if authed:
+            while True:
+                key, wait = self.limiter.acquire()
+                if key is not None:
+                    break
+                yield tornado.gen.sleep(wait)
+            url = f"{url}{'&' if '?' in url else '?'}k={key}"
+
+        t = time.time()
+        response = yield self.http.fetch(url, request_timeout=timeout, raise_error=False)
+        self.requests += 1
+        if authed:
+            glob.dog.increment(f"{glob.DATADOG_PREFIX}.osu_api.requests")
+        log.debug(f"osu!api request took {(time.time() - t) * 1000:.2f}ms")
+
+        if response.error:
+            self.errors += 1
+            log.warning(f"osu!api request failed ({response.error})")
+            return None
+        return response.body
+
+    def request(self, url: str, authed: bool = True, timeout: float = API_TIMEOUT) -> Optional[bytes]:
+        """
+        Blocking version of `fetch`, for the request handlers' threads.
+
+        :return: response body, None if the request failed
+        """
+        if tornado.ioloop.IOLoop.current(instance=False) is self.ioLoop:
+            raise RuntimeError('OsuApiClient.request would block the IOLoop, use fetch')
+
+        result = ConcurrentFuture()
+
+        def done(future):
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                result.set_result(future.result())
+
+        self.ioLoop.add_callback(lambda: self.fetch(url, authed, timeout).add_done_callback(done))
+        # rate limiting may hold it for a while, but not forever
+        return result.result(timeout=timeout * 6)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "requests": self.requests,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "in_flight": len(self._inFlight),
+        }
+
+
+def _get(url: str, authed: bool = True, timeout: float = API_TIMEOUT) -> Optional[bytes]:
+    """Request `url` through the async client if it's running, else on our own session"""
+    if glob.osuapi is not None:
+        return glob.osuapi.request(url, authed, timeout)
+
+    if authed:
+        api_key = random.choice(glob.conf.config["osuapi"]["apikeys"].split(","))
+        url = f"{url}{'&' if '?' in url else '?'}k={api_key}"
+        glob.dog.increment(f"{glob.DATADOG_PREFIX}.osu_api.requests")
+
+    return session.get(url, timeout=timeout).content
+
+
+def _parse(resp, getFirst):
+    data = orjson.loads(resp)
+
+    if data and isinstance(data, str):
+        data = None
+
+    if getFirst:
+        if len(data) >= 1:
+            return data[0]
+        return None
+    return data
+
 
 def osuApiRequest(request, params, getFirst=True):
     """
@@ -26,29 +193,13 @@ def osuApiRequest(request, params, getFirst=True):
     resp = None
     try:
         api_base = glob.conf.config["osuapi"]["apiurl"]
-        api_key = random.choice(glob.conf.config["osuapi"]["apikeys"].split(","))
 
-        final_url = f"{api_base}/api/{request}?k={api_key}&{params}"
+        final_url = f"{api_base}/api/{request}?{params}"
         log.debug(final_url)
 
-        t = time.time()
-        resp = requests.get(final_url, timeout=5).text
-        data = orjson.loads(resp)
-
-        if data and isinstance(data, str):
-            data = None
-
-        print(f"osu!api request to {final_url} took {(time.time() - t) * 1000}")
-
-        if getFirst:
-            if len(data) >= 1:
-                resp = data[0]
-            else:
-                resp = None
-        else:
-            resp = data
+        data = _get(final_url)
+        resp = _parse(data, getFirst)
     finally:
-        glob.dog.increment(f"{glob.DATADOG_PREFIX}.osu_api.requests")
         log.debug(resp)
         return resp
 
@@ -57,25 +208,12 @@ def osuApiMapRequest(params, getFirst=True):
     # Api request
     resp = None
     try:
-        api_key = random.choice(glob.conf.config["osuapi"]["apikeys"].split(","))
-        final_url = f"https://old.ppy.sh/api/get_beatmaps{params}&k={api_key}"
+        final_url = f"https://old.ppy.sh/api/get_beatmaps{params}"
         log.debug(final_url)
 
-        t = time.time()
-        resp = requests.get(final_url, timeout=5).text
-        data = orjson.loads(resp)
-
-        print(f"osu!api request to {final_url} took {(time.time() - t) * 1000}")
-
-        if getFirst:
-            if len(data) >= 1:
-                resp = data[0]
-            else:
-                resp = None
-        else:
-            resp = data
+        data = _get(final_url)
+        resp = _parse(data, getFirst)
     finally:
-        glob.dog.increment(f"{glob.DATADOG_PREFIX}.osu_api.requests")
         log.debug(resp)
         return resp
 
@@ -95,7 +233,7 @@ def getOsuFileFromID(beatmapID):
     response = None
     try:
         url = f'{glob.conf.config["osuapi"]["apiurl"]}/osu/{beatmapID}'
-        response = requests.get(url, timeout=10).content
+        response = _get(url, authed=False, timeout=OSU_FILE_TIMEOUT)
     finally:
         glob.dog.increment(glob.DATADOG_PREFIX + ".osu_api.osu_file_requests")
         return response
@@ -0,0 +1,123 @@
+"""
+Write-behind beatmap playcount/passcount counters.
+
+Every submitted score used to run its own `UPDATE beatmaps SET playcount =
+playcount + 1`, queueing up on the row lock of popular maps. Deltas are
+added up in memory per md5 instead, and written a few seconds later in a
+handful of statements, one row per map whatever its number of plays.
+"""
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from common.log import logUtils as log
+from objects import glob
+
+FLUSH_INTERVAL = 5 # seconds
+FLUSH_BATCH_SIZE = 500 # maps per statement
+
+# Only updates maps that are in the table: a map replaced by a beatmap
+# update in the meantime would otherwise be inserted back, without its data.
+FLUSH_QUERY = (
+    "UPDATE beatmaps JOIN ({deltas}) AS deltas ON beatmaps.beatmap_md5 = deltas.md5 "
+    "SET beatmaps.playcount = beatmaps.playcount + deltas.plays, "
+    "beatmaps.passcount = beatmaps.passcount + deltas.passes"
+)
+DELTA_ROW = "SELECT %s AS md5, %s AS plays, %s AS passes"
+
+
+class PlaycountBuffer:
+    """Playcount/passcount deltas per beatmap md5, flushed to db in bulk."""
+
+    def __init__(self) -> None:
+        self._deltas: Dict[str, List[int]] = {} # md5: [plays, passes]
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()
+
+        self.added = 0
+        self.flushes = 0
+        self.flushedMaps = 0
+        self.flushTime = 0.0 # seconds spent flushing, in total
+        self.errors = 0
+
+    def add(self, md5: str, passed: bool) -> None:
+        """
+        Count a play (and a pass) on a beatmap
+
+        :param md5: beatmap md5
+        :param passed: if True, count a pass too
+        """
+        with self._lock:
+            delta = self._deltas.get(md5)
+            if delta is None:
+                self._deltas[md5] = [1, int(passed)]
+            else:
+                delta[0] += 1
+                delta[1] += passed
+            self.added += 1
+
+    def start(self) -> None:
+        """Flush every `FLUSH_INTERVAL` seconds from a daemon thread"""
+        threading.Thread(target=self._run, name='playcount-flush', daemon=True).start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                log.error(f'Playcount flush failed ({e})')
+
+    def flush(self) -> int:
+        """
+        Write the pending deltas to db, in one transaction.
+        They're kept for the next flush if it fails.
+
+        :return: number of maps updated
+        """
+        with self._flushLock:
+            with self._lock:
+                deltas, self._deltas = self._deltas, {}
+            if not deltas:
+                return 0
+
+            t0 = time.perf_counter()
+            # Always in the same order, so concurrent flushes (other processes) can't deadlock
+            rows: List[Tuple[str, int, int]] = sorted((md5, plays, passes) for md5, (plays, passes) in deltas.items())
+            try:
+                with glob.db.batch():
+                    for i in range(0, len(rows), FLUSH_BATCH_SIZE):
+                        batch = rows[i:i + FLUSH_BATCH_SIZE]
+                        glob.db.execute(
+                            FLUSH_QUERY.format(deltas=' UNION ALL '.join((DELTA_ROW,) * len(batch))),
+                            [value for row in batch for value in row]
+                        )
+            except:
+                self.errors += 1
+                self._restore(deltas)
+                raise
+
+            self.flushes += 1
+            self.flushedMaps += len(rows)
+            self.flushTime += time.perf_counter() - t0
+            return len(rows)
+
+    def _restore(self, deltas: Dict[str, List[int]]) -> None:
+        with self._lock:
+            for md5, (plays, passes) in deltas.items():
+                delta = self._deltas.setdefault(md5, [0, 0])
+                delta[0] += plays
+                delta[1] += passes
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            pending = len(self._deltas)
+        return {
+            'pending_maps': pending,
+            'plays': self.added,
+            'flushes': self.flushes,
+            'flushed_maps': self.flushedMaps,
+            'errors': self.errors,
+            'avg_flush_ms': round(self.flushTime / self.flushes * 1000, 2) if self.flushes else 0,
+        }
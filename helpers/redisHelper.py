@@ -0,0 +1,91 @@
+"""
+Incremental redis key purge.
+
+KEYS blocks redis (shared with bancho) for as long as it takes to walk every
+key, so stale keys are found with SCAN and removed with UNLINK in small
+batches from a background thread instead.
+"""
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+import redis
+
+from common.log import logUtils as log
+
+SCAN_COUNT = 1000 # keys looked at per SCAN call
+REPORT_INTERVAL = 10 # seconds between progress messages
+BATCH_DELAY = 0.01 # seconds between batches, leaving redis to everyone else
+
+
+class KeyPurge:
+    """Remove every key matching a pattern, a SCAN batch at a time."""
+
+    def __init__(self, r: redis.Redis, pattern: str, keep: Iterable[str] = ()) -> None:
+        """
+        :param r: redis connection
+        :param pattern: SCAN MATCH pattern of the keys to remove
+        :param keep: keys matching the pattern to keep anyway
+        """
+        self.redis = r
+        self.pattern = pattern
+        self.keep = {key.encode() for key in keep}
+
+        self.scanned = 0
+        self.removed = 0
+        self.startTime: Optional[float] = None
+        self.endTime: Optional[float] = None
+
+    def start(self) -> None:
+        """Run the purge in a daemon thread"""
+        threading.Thread(target=self._run, name='redis-purge', daemon=True).start()
+
+    def _run(self) -> None:
+        try:
+            self.run()
+        except Exception as e:
+            log.error(f'Purge of redis keys {self.pattern} failed after {self.removed} keys ({e})')
+
+    def run(self) -> None:
+        self.startTime = time.perf_counter()
+        remove = self._unlink
+        lastReport = self.startTime
+        cursor = 0
+        while True:
+            cursor, keys = self.redis.scan(cursor, match=self.pattern, count=SCAN_COUNT)
+            self.scanned += len(keys)
+            keys = [key for key in keys if key not in self.keep]
+            if keys:
+                try:
+                    self.removed += remove(*keys)
+                except redis.exceptions.ResponseError:
+                    # UNLINK needs redis 4.0
+                    remove = self.redis.delete
+                    self.removed += remove(*keys)
+
+            if cursor == 0:
+                break
+
+            now = time.perf_counter()
+            if now - lastReport >= REPORT_INTERVAL:
+                lastReport = now
+                log.info(f'Purging redis keys {self.pattern}: {self.removed} removed so far '
+                         f'({self.removed / (now - self.startTime):.0f} keys/s)')
+            time.sleep(BATCH_DELAY)
+
+        self.endTime = time.perf_counter()
+        log.info(f'Purged {self.removed} redis keys {self.pattern} in {self.endTime - self.startTime:.2f}s')
+
+    def _unlink(self, *keys: bytes) -> int:
+        # redis-py 2.10 has no unlink()
+        return self.redis.execute_command('UNLINK', *keys)
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        elapsed = ((self.endTime or time.perf_counter()) - self.startTime) if self.startTime else 0
+        return {
+            'done': self.endTime is not None,
+            'scanned': self.scanned,
+            'removed': self.removed,
+            'elapsed_s': round(elapsed, 2),
+        }
@@ -0,0 +1,197 @@
+"""
+Durable replay storage for score submission.
+
+Replays are written to a local spool directory before the score is
+acknowledged, then uploaded to the FTP server in the background by a few
+workers, each with its own connection. Uploaded replays are removed from
+the spool; anything left in it after a crash is uploaded again on startup.
+"""
+import ftplib
+import os
+import queue
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from common.log import logUtils as log
+
+SPOOL_PATH = '.data/replay_spool'
+FALLBACK_PATH = '.data/replays' # replays we gave up uploading
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 5 # seconds, doubled on every attempt
+
+
+def spoolPath(taskID: Optional[int]) -> str:
+    """Spool directory of a process (`glob.taskID`)"""
+    return os.path.join(SPOOL_PATH, str(taskID or 0))
+
+
+def adoptSpools(processes: int) -> None:
+    """
+    Move replays spooled by processes that won't be started
+    (eg. after lowering server.processes) to the first one's spool
+
+    :param processes: number of processes that will be started
+    """
+    os.makedirs(spoolPath(0), 0o770, exist_ok=True)
+    for name in os.listdir(SPOOL_PATH):
+        path = os.path.join(SPOOL_PATH, name)
+        if os.path.isfile(path):
+            # spooled before spools were per process
+            os.replace(path, os.path.join(spoolPath(0), name))
+            continue
+
+        if not name.isdigit() or int(name) < processes:
+            continue
+
+        for fileName in os.listdir(path):
+            if not fileName.endswith('.tmp'):
+                os.replace(os.path.join(path, fileName), os.path.join(spoolPath(0), fileName))
+
+
+class ReplaySpool:
+    """Replay spool directory and its FTP upload workers."""
+
+    def __init__(self, host: str, username: str, password: str, connections: int = 4,
+                 taskID: Optional[int] = None) -> None:
+        self.host = host
+        self.username = username
+        self.password = password
+        self.connections = connections
+        # Each process has its own spool, they'd upload each other's replays otherwise
+        self.path = spoolPath(taskID)
+        os.makedirs(self.path, 0o770, exist_ok=True)
+        self._queue: 'queue.Queue[Tuple[int, int]]' = queue.Queue()
+        self._lock = threading.Lock()
+
+        self.pending = 0 # replays in the spool, queued or waiting for a retry
+        self.uploading = 0
+        self.uploaded = 0
+        self.uploadedBytes = 0
+        self.uploadTime = 0.0 # seconds spent uploading, in total
+        self.retries = 0
+        self.givenUp = 0
+
+    def _spoolFile(self, scoreID: int) -> str:
+        return os.path.join(self.path, f'replay_{scoreID}.osr')
+
+    def connect(self) -> ftplib.FTP:
+        return ftplib.FTP(host=self.host, user=self.username, passwd=self.password, timeout=30)
+
+    def start(self) -> None:
+        """Start the upload workers. Raises if the FTP server can't be reached."""
+        for i in range(self.connections):
+            ftp = self.connect()
+            threading.Thread(
+                target=self._worker, args=(ftp,), name=f'replay-upload-{i}', daemon=True
+            ).start()
+
+    def add(self, scoreID: int, rawReplay: bytes) -> None:
+        """
+        Save a replay in the spool and queue its upload.
+        Returns once the replay is safely on disk.
+
+        :param scoreID: score id
+        :param rawReplay: replay file content
+        """
+        fileName = self._spoolFile(scoreID)
+        with open(f'{fileName}.tmp', 'wb') as f:
+            f.write(rawReplay)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f'{fileName}.tmp', fileName)
+
+        with self._lock:
+            self.pending += 1
+        self._queue.put((scoreID, 1))
+
+    def recover(self) -> int:
+        """
+        Queue the replays left in the spool (eg. after a crash)
+
+        :return: number of replays queued
+        """
+        scoreIDs: List[int] = []
+        for fileName in os.listdir(self.path):
+            if fileName.endswith('.tmp'):
+                # never acknowledged, the client will submit it again
+                os.remove(os.path.join(self.path, fileName))
+            elif fileName.startswith('replay_') and fileName.endswith('.osr'):
+                scoreIDs.append(int(fileName[len('replay_'):-len('.osr')]))
+
+        with self._lock:
+            self.pending += len(scoreIDs)
+        for scoreID in sorted(scoreIDs):
+            self._queue.put((scoreID, 1))
+        return len(scoreIDs)
+
+    def _worker(self, ftp: ftplib.FTP) -> None:
+        while True:
+            scoreID, attempt = self._queue.get()
+            fileName = self._spoolFile(scoreID)
+
+            with self._lock:
+                self.uploading += 1
+            t0 = time.perf_counter()
+            try:
+                if ftp is None:
+                    ftp = self.connect()
+                with open(fileName, 'rb') as f:
+                    ftp.storbinary(f'STOR /replays/replay_{scoreID}.osr', f)
+                size = os.path.getsize(fileName)
+                os.remove(fileName)
+            except Exception as e:
+                log.warning(f'Replay upload failed for score {scoreID}, attempt {attempt} ({e})')
+                # the connection may be dead, get a new one next time
+                try:
+                    if ftp is not None:
+                        ftp.close()
+                except Exception:
+                    pass
+                ftp = None
+                self._retry(scoreID, attempt)
+            else:
+                uploadTime = time.perf_counter() - t0
+                if uploadTime > 2:
+                    log.warning(f'FTP replay submission took {uploadTime:.2f}s!')
+                with self._lock:
+                    self.pending -= 1
+                    self.uploaded += 1
+                    self.uploadedBytes += size
+                    self.uploadTime += uploadTime
+            finally:
+                with self._lock:
+                    self.uploading -= 1
+
+    def _retry(self, scoreID: int, attempt: int) -> None:
+        if attempt >= MAX_ATTEMPTS:
+            # keep it on disk where replays used to end up when ftp failed
+            log.error(f'Giving up uploading replay for score {scoreID}, moving it to {FALLBACK_PATH}')
+            try:
+                os.replace(self._spoolFile(scoreID), os.path.join(FALLBACK_PATH, f'replay_{scoreID}.osr'))
+            except OSError as e:
+                log.error(f'Could not move replay for score {scoreID} ({e})')
+            with self._lock:
+                self.pending -= 1
+                self.givenUp += 1
+            return
+
+        with self._lock:
+            self.retries += 1
+        timer = threading.Timer(RETRY_DELAY * 2 ** (attempt - 1), self._queue.put, ((scoreID, attempt + 1),))
+        timer.daemon = True
+        timer.start()
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                'depth': self.pending,
+                'uploading': self.uploading,
+                'uploaded': self.uploaded,
+                'uploaded_bytes': self.uploadedBytes,
+                'retries': self.retries,
+                'given_up': self.givenUp,
+                'avg_upload_ms': round(self.uploadTime / self.uploaded * 1000, 2) if self.uploaded else 0,
+                'bytes_per_second': round(self.uploadedBytes / self.uploadTime) if self.uploadTime else 0,
+            }
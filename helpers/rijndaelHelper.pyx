@@ -0,0 +1,234 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+Compiled Rijndael-256 (32 byte blocks) CBC decryption for score submission.
+
+Drop-in replacement for `aeshelper.decryptRinjdael`, working on bytes and
+caching the expanded key schedule for each key (one per osu! version).
+Lookup tables are borrowed from the pure python implementation in aeshelper.
+
+NOTE: aeshelper's zeropad.unpad never looks at the first byte of the last
+block, so it asserts on payloads with len % 32 == 1. We don't, every other
+output is identical.
+"""
+from base64 import b64decode
+
+from libc.stdint cimport uint8_t, uint32_t
+
+from helpers import aeshelper
+
+DEF BLOCK_SIZE = 32
+DEF BC = 8 # 32-bit words per block
+DEF ROUNDS = 14 # rijndael always uses 14 rounds with 256 bit blocks
+
+# osuver comes from the client, don't let it grow the cache forever
+SCHEDULE_CACHE_LIMIT = 64
+
+cdef uint32_t S[256]
+cdef uint32_t Si[256]
+cdef uint32_t T5[256]
+cdef uint32_t T6[256]
+cdef uint32_t T7[256]
+cdef uint32_t T8[256]
+cdef uint32_t U1[256]
+cdef uint32_t U2[256]
+cdef uint32_t U3[256]
+cdef uint32_t U4[256]
+cdef uint32_t rcon[30]
+
+cdef int _i
+for _i in range(256):
+    S[_i] = aeshelper.S[_i]
+    Si[_i] = aeshelper.Si[_i]
+    T5[_i] = aeshelper.T5[_i]
+    T6[_i] = aeshelper.T6[_i]
+    T7[_i] = aeshelper.T7[_i]
+    T8[_i] = aeshelper.T8[_i]
+    U1[_i] = aeshelper.U1[_i]
+    U2[_i] = aeshelper.U2[_i]
+    U3[_i] = aeshelper.U3[_i]
+    U4[_i] = aeshelper.U4[_i]
+for _i in range(30):
+    rcon[_i] = aeshelper.rcon[_i]
+
+
+cdef class KeySchedule:
+    """Expanded decryption round keys for a single key."""
+
+    cdef uint32_t Kd[ROUNDS + 1][BC]
+
+    def __cinit__(self, bytes key):
+        cdef int KC = len(key) // 4
+        cdef int ROUND_KEY_COUNT = (ROUNDS + 1) * BC
+        cdef uint32_t tk[8]
+        cdef uint32_t tt
+        cdef const uint8_t* k
+        cdef int i, j, t, r, rconpointer
+
+        if len(key) not in (16, 24, 32):
+            raise ValueError(f'Invalid key size: {len(key)}')
+        k = key
+
+        # copy user material bytes into temporary ints
+        for i in range(KC):
+            tk[i] = (<uint32_t>k[i * 4] << 24) | (<uint32_t>k[i * 4 + 1] << 16) | \
+                    (<uint32_t>k[i * 4 + 2] << 8) | <uint32_t>k[i * 4 + 3]
+
+        # copy values into round key arrays
+        t = 0
+        j = 0
+        while j < KC and t < ROUND_KEY_COUNT:
+            self.Kd[ROUNDS - (t // BC)][t % BC] = tk[j]
+            j += 1
+            t += 1
+
+        rconpointer = 0
+        while t < ROUND_KEY_COUNT:
+            # extrapolate using phi (the round key evolution function)
+            tt = tk[KC - 1]
+            tk[0] ^= (S[(tt >> 16) & 0xFF] & 0xFF) << 24 ^ \
+                     (S[(tt >>  8) & 0xFF] & 0xFF) << 16 ^ \
+                     (S[ tt        & 0xFF] & 0xFF) <<  8 ^ \
+                     (S[(tt >> 24) & 0xFF] & 0xFF)       ^ \
+                     (rcon[rconpointer]    & 0xFF) << 24
+            rconpointer += 1
+            if KC != 8:
+                for i in range(1, KC):
+                    tk[i] ^= tk[i - 1]
+            else:
+                for i in range(1, KC // 2):
+                    tk[i] ^= tk[i - 1]
+                tt = tk[KC // 2 - 1]
+                tk[KC // 2] ^= (S[ tt        & 0xFF] & 0xFF)       ^ \
+                               (S[(tt >>  8) & 0xFF] & 0xFF) <<  8 ^ \
+                               (S[(tt >> 16) & 0xFF] & 0xFF) << 16 ^ \
+                               (S[(tt >> 24) & 0xFF] & 0xFF) << 24
+                for i in range(KC // 2 + 1, KC):
+                    tk[i] ^= tk[i - 1]
+            # copy values into round key arrays
+            j = 0
+            while j < KC and t < ROUND_KEY_COUNT:
+                self.Kd[ROUNDS - (t // BC)][t % BC] = tk[j]
+                j += 1
+                t += 1
+
+        # inverse MixColumn where needed
+        for r in range(1, ROUNDS):
+            for j in range(BC):
+                tt = self.Kd[r][j]
+                self.Kd[r][j] = U1[(tt >> 24) & 0xFF] ^ \
+                                U2[(tt >> 16) & 0xFF] ^ \
+                                U3[(tt >>  8) & 0xFF] ^ \
+                                U4[ tt        & 0xFF]
+
+    cdef void decrypt_block(self, const uint8_t* ct, const uint8_t* v, uint8_t* out):
+        """Decrypt one block from `ct` into `out`, xoring it with `v` (CBC)."""
+        cdef uint32_t t[BC]
+        cdef uint32_t a[BC]
+        cdef uint32_t tt
+        cdef int i, r
+
+        # ciphertext to ints + key
+        for i in range(BC):
+            t[i] = ((<uint32_t>ct[i * 4] << 24) | (<uint32_t>ct[i * 4 + 1] << 16) |
+                    (<uint32_t>ct[i * 4 + 2] << 8) | <uint32_t>ct[i * 4 + 3]) ^ self.Kd[0][i]
+
+        # apply round transforms (shifts for 256 bit blocks are 7, 5, 4)
+        for r in range(1, ROUNDS):
+            for i in range(BC):
+                a[i] = (T5[(t[ i          ] >> 24) & 0xFF] ^
+                        T6[(t[(i + 7) % BC] >> 16) & 0xFF] ^
+                        T7[(t[(i + 5) % BC] >>  8) & 0xFF] ^
+                        T8[ t[(i + 4) % BC]        & 0xFF]) ^ self.Kd[r][i]
+            for i in range(BC):
+                t[i] = a[i]
+
+        # last round is special
+        for i in range(BC):
+            tt = self.Kd[ROUNDS][i]
+            out[i * 4    ] = ((Si[(t[ i          ] >> 24) & 0xFF] ^ (tt >> 24)) & 0xFF) ^ v[i * 4]
+            out[i * 4 + 1] = ((Si[(t[(i + 7) % BC] >> 16) & 0xFF] ^ (tt >> 16)) & 0xFF) ^ v[i * 4 + 1]
+            out[i * 4 + 2] = ((Si[(t[(i + 5) % BC] >>  8) & 0xFF] ^ (tt >>  8)) & 0xFF) ^ v[i * 4 + 2]
+            out[i * 4 + 3] = ((Si[ t[(i + 4) % BC]        & 0xFF] ^  tt       ) & 0xFF) ^ v[i * 4 + 3]
+
+
+cdef dict _schedules = {}
+
+cpdef KeySchedule getKeySchedule(bytes key):
+    """
+    Return the (cached) key schedule for `key`
+
+    key -- AES key (bytes)
+    """
+    cdef KeySchedule schedule = _schedules.get(key)
+    if schedule is None:
+        schedule = KeySchedule(key)
+        if len(_schedules) >= SCHEDULE_CACHE_LIMIT:
+            _schedules.clear()
+        _schedules[key] = schedule
+    return schedule
+
+
+cpdef bytes decrypt(bytes key, bytes iv, bytes data):
+    """
+    Decrypt zero padded rijndael-256 CBC data
+
+    key -- AES key (bytes)
+    iv -- IV (bytes, 32 long)
+    data -- data to decrypt (bytes)
+    return -- decrypted data without zero padding
+    """
+    cdef KeySchedule schedule = getKeySchedule(key)
+    cdef Py_ssize_t length = len(data)
+    cdef Py_ssize_t offset, end
+    cdef bytearray result
+    cdef uint8_t* out
+    cdef const uint8_t* ct
+    cdef const uint8_t* v
+
+    if len(iv) != BLOCK_SIZE:
+        raise ValueError(f'Invalid IV size: {len(iv)}')
+    if length % BLOCK_SIZE:
+        raise ValueError(f'Data length {length} is not a multiple of {BLOCK_SIZE}')
+    if length == 0:
+        return b''
+
+    result = bytearray(length)
+    out = result
+    ct = data
+    v = iv
+
+    offset = 0
+    while offset < length:
+        schedule.decrypt_block(ct + offset, v, out + offset)
+        v = ct + offset
+        offset += BLOCK_SIZE
+
+    # zero padding, only the last block can contain it
+    end = length
+    while end > length - BLOCK_SIZE and out[end - 1] == 0:
+        end -= 1
+
+    if end == length - BLOCK_SIZE:
+        raise ValueError('Invalid zero padding')
+
+    return bytes(result[:end])
+
+
+def decryptRinjdael(key, iv, data, areBase64 = False):
+    """
+    Same as `aeshelper.decryptRinjdael`, but compiled
+
+    key -- AES key (string)
+    IV -- IV thing (string)
+    data -- data to decrypt (string)
+    areBase64 -- if True, iv and data are passed in base64
+    return -- decrypted data (string)
+    """
+    if areBase64:
+        iv = b64decode(iv)
+        data = b64decode(data)
+    else:
+        iv = iv.encode('latin_1')
+        data = data.encode('latin_1')
+
+    return decrypt(key.encode('latin_1'), iv, data).decode('latin_1')
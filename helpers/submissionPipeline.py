@@ -0,0 +1,117 @@
+"""
+Bounded executors for the slow stages of score submission.
+
+Request handlers run on `glob.pool`, shared by every endpoint. Stages that
+can take long (pp calculation, bancho announcements) run on their own small
+pools instead, so a slow bancho or a burst of pp calculations can't take
+every thread in `glob.pool` with it. Replays have their own spool
+(`helpers.replaySpool`).
+"""
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict
+
+from common.log import logUtils as log
+
+
+class Stage:
+    """A submission stage, with its own executor and queue/latency stats."""
+
+    def __init__(self, name: str, workers: int) -> None:
+        self.name = name
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix=f'submit-{name}')
+        self._lock = threading.Lock()
+
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.waitTime = 0.0 # seconds spent in the queue, in total
+        self.runTime = 0.0 # seconds spent running, in total
+        self.maxRunTime = 0.0
+
+    def submit(self, func: Callable, *args, **kwargs) -> Future:
+        """
+        Queue `func(*args, **kwargs)` on this stage
+
+        :return: future of its result
+        """
+        enqueued = time.perf_counter()
+        with self._lock:
+            self.queued += 1
+
+        def job():
+            started = time.perf_counter()
+            with self._lock:
+                self.queued -= 1
+                self.running += 1
+                self.waitTime += started - enqueued
+
+            failed = False
+            try:
+                return func(*args, **kwargs)
+            except:
+                failed = True
+                raise
+            finally:
+                runTime = time.perf_counter() - started
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+                    self.failed += failed
+                    self.runTime += runTime
+                    self.maxRunTime = max(self.maxRunTime, runTime)
+
+        return self.executor.submit(job)
+
+    def run(self, func: Callable, *args, **kwargs):
+        """
+        Run `func(*args, **kwargs)` on this stage and wait for it.
+        Exceptions are raised in the caller.
+        """
+        return self.submit(func, *args, **kwargs).result()
+
+    def background(self, func: Callable, *args, **kwargs) -> None:
+        """Run `func(*args, **kwargs)` on this stage without waiting for it, logging errors."""
+        def logErrors(future: Future) -> None:
+            e = future.exception()
+            if e is not None:
+                log.error(f'Submission stage {self.name} failed ({e})\n\n'
+                          f'{"".join(traceback.format_exception(type(e), e, e.__traceback__))}')
+
+        self.submit(func, *args, **kwargs).add_done_callback(logErrors)
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            completed = self.completed or 1
+            return {
+                'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'failed': self.failed,
+                'avg_wait_ms': round(self.waitTime / completed * 1000, 2),
+                'avg_run_ms': round(self.runTime / completed * 1000, 2),
+                'max_run_ms': round(self.maxRunTime * 1000, 2),
+            }
+
+
+# pp calculation, CPU bound
+ppCalc = Stage('pp', os.cpu_count() or 4)
+# #announce messages through bancho
+announcements = Stage('announcements', 2)
+
+stages = (ppCalc, announcements)
+
+
+def stats() -> Dict[str, Dict[str, float]]:
+    return {stage.name: stage.stats for stage in stages}
+
+
+def shutdown() -> None:
+    """Wait for every queued job to be done"""
+    for stage in stages:
+        stage.executor.shutdown(wait=True)
@@ -1,16 +1,20 @@
 #!/usr/bin/env python3.8
 
-import ftplib
 # General imports
 import os
+from contextlib import closing
 from multiprocessing.pool import ThreadPool
 from os import chdir, makedirs, path
 
+import MySQLdb.cursors
 import redis
 import tornado.gen
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
+from tornado.httpclient import AsyncHTTPClient
 from raven.contrib.tornado import AsyncSentryClient
 
 from common import agpl, generalUtils
@@ -29,9 +33,17 @@ from handlers import (apiCacheBeatmapHandler, apiPPHandler, apiStatusHandler,
                       osuMapsHandler, osuSearchHandler, osuSearchSetHandler,
                       osuSeasonal, rateHandler, redirectHandler,
                       submitModularHandler, uploadScreenshotHandler)
-from helpers import config, consoleHelper
+from helpers import (checksumFilter, config, consoleHelper, dbHelper,
+                     osuapiHelper, redisHelper, replaySpool,
+                     submissionPipeline)
+from helpers.cache import PB_RECORDS_CHANNEL, PB_RECORDS_NUKE_CHANNEL
 from objects import glob
-from pubSubHandlers import beatmapUpdateHandler
+from pubSubHandlers import (beatmapInvalidateHandler, beatmapUpdateHandler,
+                            lbCacheInvalidateHandler, pbRecordInvalidateHandler,
+                            pbRecordNukeHandler, scoreChecksumHandler)
+
+IGNORED_MAPS_SAVE_INTERVAL = 5 * 60 * 1000 # ms
+PURGE_PENDING_KEY = 'lets:purge_pending' # set at startup, taken by whichever process purges
 
 
 def make_app():
@@ -73,6 +85,77 @@ def make_app():
     ], default_handler_class=defaultHandler.handler)
 
 
+def connectRedis() -> None:
+    try:
+        consoleHelper.printNoNl('> Connecting to redis...')
+        glob.redis = redis.Redis(
+            glob.conf.config['redis']['host'],
+            glob.conf.config['redis']['port'],
+            glob.conf.config['redis']['database'],
+            glob.conf.config['redis']['password']
+        )
+        glob.redis.ping()
+        consoleHelper.printNoNl(' ')
+        consoleHelper.printDone()
+    except:
+        # Exception while connecting to db
+        consoleHelper.printError()
+        consoleHelper.printColored('[!] Error while connecting to redis. Please check your config.ini and run the server again', bcolors.RED)
+        raise
+
+def runStartupTasks() -> None:
+    """Startup side effects, run once whatever the number of processes"""
+    # Empty redis cache, in the background once we're listening
+    glob.redis.set(PURGE_PENDING_KEY, 1)
+
+    # Save lets version in redis
+    glob.redis.set('lets:version', glob.VERSION)
+
+    # Set achievements version
+    glob.redis.set('lets:achievements_version', glob.ACHIEVEMENTS_VERSION)
+    consoleHelper.printColored(f'Achievements version is {glob.ACHIEVEMENTS_VERSION}', bcolors.YELLOW)
+
+def createChecksumFilter(shared: bool = False) -> None:
+    """
+    Create the score checksum filters, if enabled
+
+    :param shared: if True, fill them right away in shared memory (before forking),
+                   from a connection of their own. Otherwise in the background, from glob.db.
+    """
+    if not generalUtils.stringToBool(glob.conf.config['cache'].get('checksumfilter', 'True')):
+        return
+
+    try:
+        consoleHelper.printNoNl('> Creating score checksum filters...')
+        glob.checksums = checksumFilter.ChecksumFilter(
+            int(glob.conf.config['cache'].get('checksumcapacity', '0')),
+            float(glob.conf.config['cache'].get('checksumerrorrate', '0.01'))
+        )
+        if not shared:
+            glob.checksums.start()
+        else:
+            connection = MySQLdb.connect(
+                host=glob.conf.config['db']['host'],
+                user=glob.conf.config['db']['username'],
+                passwd=glob.conf.config['db']['password'],
+                db=glob.conf.config['db']['database'],
+                cursorclass=MySQLdb.cursors.DictCursor
+            )
+            try:
+                def fetchAll(query, params):
+                    with closing(connection.cursor()) as cursor:
+                        cursor.execute(query, params)
+                        return cursor.fetchall()
+
+                glob.checksums.start(fetchAll)
+            finally:
+                connection.close()
+        consoleHelper.printDone()
+    except:
+        # Duplicate checks will just keep using the db
+        consoleHelper.printError()
+        glob.checksums = None
+
 def main() -> int:
     try:
         agpl.check_license('ripple', 'LETS')
@@ -113,6 +196,7 @@ def main() -> int:
         for i in (
             '.data',
             '.data/replays',
+            replaySpool.SPOOL_PATH,
             '.data/screenshots',
             '.data/oppai',
             '.data/catch_the_pp',
@@ -125,16 +209,60 @@ def main() -> int:
                 makedirs(i, 0o770)
         consoleHelper.printDone()
 
+        # Server port
+        try:
+            serverPort = int(glob.conf.config['server']['port'])
+        except:
+            consoleHelper.printColored('[!] Invalid server port! Please check your config.ini and run the server again', bcolors.RED)
+            return 1
+
+        # Run startup side effects once, then fork if we need more than one
+        # process. Everything after this (db, redis, pubsub, threads) is per process.
+        processes = int(glob.conf.config['server'].get('processes', '1')) # 0 = one per CPU
+        connectRedis()
+        runStartupTasks()
+
+        processes = processes or tornado.process.cpu_count()
+
+        # Replays spooled by processes we won't start again
+        replaySpool.adoptSpools(processes)
+
+        sockets = None
+        if processes != 1:
+            # Scanned once and kept in memory once, for every process
+            createChecksumFilter(shared=True)
+
+            sockets = tornado.netutil.bind_sockets(serverPort, address=glob.conf.config['server']['host'])
+
+            # Don't share the parent's redis connections with the children
+            glob.redis.connection_pool.disconnect()
+            glob.redis = None
+
+            consoleHelper.printColored(f'> Forking {processes} processes...', bcolors.YELLOW)
+            # Only returns in the children, the parent restarts them if they die
+            glob.taskID = tornado.process.fork_processes(processes)
+
+        # Load maps getscores already knows it can ignore
+        consoleHelper.printNoNl('> Loading ignored maps...')
+        try:
+            ignoredMaps = glob.ignoreMapsCache.load()
+            consoleHelper.printDone()
+            consoleHelper.printColored(f'Loaded {ignoredMaps} ignored maps', bcolors.YELLOW)
+        except:
+            # Not worth refusing to start for, they'll be looked up again
+            consoleHelper.printError()
+
         # Connect to db
         try:
             consoleHelper.printNoNl('> Connecting to MySQL database...')
-            glob.db = dbConnector.db(
+            # Batching lets score submission write in a single transaction
+            glob.db = dbHelper.BatchingDb(dbConnector.db(
                 glob.conf.config['db']['host'],
                 glob.conf.config['db']['username'],
                 glob.conf.config['db']['password'],
                 glob.conf.config['db']['database'],
                 int(glob.conf.config['db']['workers'])
-            )
+            ))
             consoleHelper.printNoNl(" ")
             consoleHelper.printDone()
         except:
@@ -148,45 +276,38 @@ def main() -> int:
             try:
                 consoleHelper.printNoNl('> Connecting to backup (ftp) server...')
 
-                glob.ftp = ftplib.FTP(
+                glob.replaySpool = replaySpool.ReplaySpool(
                     host = glob.conf.config['ftp']['host'],
-                    user = glob.conf.config['ftp']['username'],
-                    passwd = glob.conf.config['ftp']['password']
+                    username = glob.conf.config['ftp']['username'],
+                    password = glob.conf.config['ftp']['password'],
+                    connections = int(glob.conf.config['ftp'].get('connections', '4')),
+                    taskID = glob.taskID
                 )
+                glob.replaySpool.start()
                 consoleHelper.printNoNl(' ')
                 consoleHelper.printDone()
+
+                # Upload whatever was left in the spool last time
+                spooled = glob.replaySpool.recover()
+                if spooled:
+                    consoleHelper.printColored(f'Uploading {spooled} spooled replays', bcolors.YELLOW)
             except:
                 consoleHelper.printError()
                 consoleHelper.printColored('[!] Error while connecting to FTP. Please check your config.ini and run the server again', bcolors.RED)
                 raise
 
         # Connect to redis
-        try:
-            consoleHelper.printNoNl('> Connecting to redis...')
-            glob.redis = redis.Redis(
-                glob.conf.config['redis']['host'],
-                glob.conf.config['redis']['port'],
-                glob.conf.config['redis']['database'],
-                glob.conf.config['redis']['password']
-            )
-            glob.redis.ping()
-            consoleHelper.printNoNl(' ')
-            consoleHelper.printDone()
-        except:
-            # Exception while connecting to db
-            consoleHelper.printError()
-            consoleHelper.printColored('[!] Error while connecting to redis. Please check your config.ini and run the server again', bcolors.RED)
-            raise
+        if glob.redis is None:
+            connectRedis()
 
-        # Empty redis cache
-        try:
-            glob.redis.eval("return redis.call('del', unpack(redis.call('keys', ARGV[1])))", 0, 'lets:*')
-        except redis.exceptions.ResponseError:
-            # Script returns error if there are no keys starting with peppy:*
-            pass
+        # Share leaderboard cache with the other LETS processes
+        if generalUtils.stringToBool(glob.conf.config['cache'].get('shared', 'False')):
+            glob.lb_cache.redis = glob.redis
 
-        # Save lets version in redis
-        glob.redis.set('lets:version', glob.VERSION)
+        # Duplicate score checks without asking the db, once loaded
+        # (forked processes got theirs from the parent)
+        if processes == 1:
+            createChecksumFilter()
 
         # Create threads pool
         try:
@@ -208,10 +329,6 @@ def main() -> int:
                     'Set beatmapcacheexpire to 0 to disable beatmap latest update check and fix that issue.'
                 ]), bcolors.YELLOW)
 
-        # Set achievements version
-        glob.redis.set('lets:achievements_version', glob.ACHIEVEMENTS_VERSION)
-        consoleHelper.printColored(f'Achievements version is {glob.ACHIEVEMENTS_VERSION}', bcolors.YELLOW)
-
         # Discord
         if generalUtils.stringToBool(glob.conf.config['discord']['enable']):
             glob.schiavo = schiavo.schiavo(glob.conf.config['discord']['boturl'], '**lets**')
@@ -223,16 +340,21 @@ def main() -> int:
         if glob.debug:
             consoleHelper.printColored('[!] Warning! Server running in debug mode!', bcolors.YELLOW)
 
-        # Server port
-        try:
-            serverPort = int(glob.conf.config['server']['port'])
-        except:
-            consoleHelper.printColored('[!] Invalid server port! Please check your config.ini and run the server again', bcolors.RED)
-            return 1
-
         # Make app
         glob.application = make_app()
 
+        # osu!api client, keeping connections alive if pycurl is available
+        if generalUtils.stringToBool(glob.conf.config['osuapi']['enable']):
+            try:
+                AsyncHTTPClient.configure('tornado.curl_httpclient.CurlAsyncHTTPClient')
+            except ImportError:
+                consoleHelper.printColored('[!] pycurl not installed, osu!api connections won\'t be reused', bcolors.YELLOW)
+
+            glob.osuapi = osuapiHelper.OsuApiClient(
+                glob.conf.config['osuapi']['apikeys'].split(','),
+                int(glob.conf.config['osuapi'].get('ratelimit', osuapiHelper.DEFAULT_RATE_LIMIT))
+            )
+
         # Set up sentry
         try:
             glob.sentry = generalUtils.stringToBool(glob.conf.config['sentry']['enable'])
@@ -257,18 +379,46 @@ def main() -> int:
         # Connect to pubsub channels
         pubSub.listener(glob.redis, {
             'lets:beatmap_updates': beatmapUpdateHandler.handler(),
+            beatmapUpdateHandler.INVALIDATE_CHANNEL: beatmapInvalidateHandler.handler(),
+            'lets:lb_cache_invalidate': lbCacheInvalidateHandler.handler(),
+            checksumFilter.CHANNEL: scoreChecksumHandler.handler(),
+            PB_RECORDS_CHANNEL: pbRecordInvalidateHandler.handler(),
+            PB_RECORDS_NUKE_CHANNEL: pbRecordNukeHandler.handler(),
         }).start()
 
         # Server start message and console output
-        consoleHelper.printColored(f'> L.E.T.S. is listening for clients on {glob.conf.config["server"]["host"]}:{serverPort}...', bcolors.GREEN)
+        worker = f' (process {glob.taskID})' if glob.taskID is not None else ''
+        consoleHelper.printColored(f'> L.E.T.S.{worker} is listening for clients on {glob.conf.config["server"]["host"]}:{serverPort}...', bcolors.GREEN)
+
+        # Write beatmap playcounts every few seconds
+        glob.playcounts.start()
+
+        # Save ignored maps every few minutes, in case we don't shut down cleanly
+        tornado.ioloop.PeriodicCallback(glob.ignoreMapsCache.save, IGNORED_MAPS_SAVE_INTERVAL).start()
 
         # Start Tornado
-        glob.application.listen(serverPort, address=glob.conf.config['server']['host'])
+        if sockets is not None:
+            server = tornado.httpserver.HTTPServer(glob.application)
+            server.add_sockets(sockets)
+        else:
+            glob.application.listen(serverPort, address=glob.conf.config['server']['host'])
+
+        # Empty redis cache, from a single process
+        if glob.redis.delete(PURGE_PENDING_KEY):
+            glob.keyPurge = redisHelper.KeyPurge(
+                glob.redis, 'lets:*', keep=('lets:version', 'lets:achievements_version')
+            )
+            glob.keyPurge.start()
+
         tornado.ioloop.IOLoop.instance().start()
     finally:
         # Perform some clean up
         print('> Disposing server...')
+        submissionPipeline.shutdown()
         glob.fileBuffers.flushAll()
+        if glob.db is not None:
+            glob.playcounts.flush()
+        glob.ignoreMapsCache.save()
         consoleHelper.printColored('Goodbye!', bcolors.GREEN)
 
     return 0
@@ -5,7 +5,7 @@ from typing import Optional
 import orjson
 from common.log import logUtils as log
 from constants import rankedStatuses
-from helpers import osuapiHelper
+from helpers import dbHelper, osuapiHelper
 from objects import glob
 
 MAPFILE_RGX = re.compile(
@@ -13,6 +13,17 @@ MAPFILE_RGX = re.compile(
     r"\[(?P<version>.+)\]\.osu$"  # ver can technically be 0 chars?
 )
 
+INSERT_BEATMAP_QUERY = (
+    "INSERT INTO `beatmaps` ("
+    "`id`, `beatmap_id`, `beatmapset_id`, "
+    "`beatmap_md5`, `song_name`, `ar`, `od`, `mode`, "
+    "`difficulty_mania`, `max_combo`, `hit_length`, "
+    "`bpm`, `ranked`, `latest_update`, "
+    "`ranked_status_freezed`, `rankedby`"
+    ") VALUES (NULL, %s, %s, %s, %s, %s, %s, "
+    "%s, %s, %s, %s, %s, %s, %s, %s, %s)"
+)
+
 
 class beatmap:
     __slots__ = (
@@ -76,6 +87,7 @@ class beatmap:
 
         # Statistics for ranking panel
         self.playcount = 0
+        self.passcount = 0
 
         # Force refresh from osu api
         self.refresh = refresh
@@ -110,6 +122,7 @@ class beatmap:
                 self.rankedStatus = bdata["ranked"]
 
             log.debug(f'Deleting old beatmap data ({bdata["id"]})')
+            glob.beatmap_cache.remove(self.fileMD5, self.beatmapID)
             glob.db.execute("DELETE FROM beatmaps WHERE id = %s LIMIT 1", [bdata["id"]])
         else:
             frozen = 0  # Unfreeze beatmap status
@@ -118,34 +131,34 @@ class beatmap:
         # Add new beatmap data
         log.debug("Saving beatmap data in db...")
 
-        glob.db.execute(
-            "INSERT INTO `beatmaps` ("
-            "`id`, `beatmap_id`, `beatmapset_id`, "
-            "`beatmap_md5`, `song_name`, `ar`, `od`, `mode`, "
-            "`difficulty_mania`, `max_combo`, `hit_length`, "
-            "`bpm`, `ranked`, `latest_update`, "
-            "`ranked_status_freezed`, `rankedby`"
-            ") VALUES (NULL, %s, %s, %s, %s, %s, %s, "
-            "%s, %s, %s, %s, %s, %s, %s, %s, %s)",
-            [
-                self.beatmapID,
-                self.beatmapSetID,
-                self.fileMD5,
-                self.songName.encode("utf-8", "ignore").decode("utf-8"),
-                self.AR,
-                self.OD,
-                self.gameMode,
-                self.starsMania,  # only need mania
-                self.maxCombo,
-                self.hitLength,
-                self.bpm if self.bpm <= 0x7FFFFFFF else 0,
-                self.rankedStatus,
-                # self.rankedStatus if frozen == 0 else 2,
-                int(time.time()),
-                frozen,
-                rankedby,
-            ],
-        )
+        glob.db.execute(INSERT_BEATMAP_QUERY, self.getDBRow(frozen, rankedby))
+
+    def getDBRow(self, frozen, rankedby):
+        """
+        Return this beatmap's values for INSERT_BEATMAP_QUERY
+
+        frozen -- ranked_status_freezed
+        rankedby -- rankedby
+        return -- list of values
+        """
+        return [
+            self.beatmapID,
+            self.beatmapSetID,
+            self.fileMD5,
+            self.songName.encode("utf-8", "ignore").decode("utf-8"),
+            self.AR,
+            self.OD,
+            self.gameMode,
+            self.starsMania,  # only need mania
+            self.maxCombo,
+            self.hitLength,
+            self.bpm if self.bpm <= 0x7FFFFFFF else 0,
+            self.rankedStatus,
+            # self.rankedStatus if frozen == 0 else 2,
+            int(time.time()),
+            frozen,
+            rankedby,
+        ]
 
     def setDataFromDB(self, md5):
         """
@@ -155,9 +168,7 @@ class beatmap:
         return -- True if set, False if not set
         """
         # Get data from DB
-        data = glob.db.fetch(
-            "SELECT * FROM beatmaps WHERE beatmap_md5 = %s LIMIT 1", [md5]
-        )
+        data = getBeatmapRow(md5)
         # Make sure the query returned something
         if data is None:
             return False
@@ -225,8 +236,6 @@ class beatmap:
         """
         # Check if osuapi is enabled
 
-        # TODO: set caching with setid
-
         # h = map md5, a = include converts, m = gamemode
         api_data = osuapiHelper.osuApiRequest("get_beatmaps", f"h={md5}&a=1")
         if isinstance(api_data, str):
@@ -241,8 +250,51 @@ class beatmap:
             return True
 
         # save new values from osu!api
-        self.songName = "{artist} - {title} [{version}]".format(**api_data)
+        self.setDataFromOsuApiData(api_data)
         self.fileMD5 = md5
+        return True
+
+    def setDataFromOsuApiSet(self, md5, beatmapSetID):
+        """
+        Set this object's beatmap data from osu!api, saving every
+        difficulty of its set in db at once, so the other ones
+        are served from db.
+
+        md5 -- beatmap md5
+        beatmapSetID -- beatmap set ID
+        return -- True if set, False if the map is not in that set
+        """
+        # s = set id, every difficulty in one request
+        api_data = osuapiHelper.osuApiRequest("get_beatmaps", f"s={beatmapSetID}", False)
+        if not api_data:
+            return False
+
+        difficulties = []
+        for diff_data in api_data:
+            diff = beatmap()
+            diff.setDataFromOsuApiData(diff_data)
+            difficulties.append(diff)
+
+        addBeatmapsToDB(difficulties)
+
+        for diff in difficulties:
+            if diff.fileMD5 == md5:
+                for attr in self.__slots__:
+                    if attr != "refresh":
+                        setattr(self, attr, getattr(diff, attr))
+                return True
+
+        # the client's copy is probably outdated
+        return False
+
+    def setDataFromOsuApiData(self, api_data):
+        """
+        Set this object's beatmap data from a get_beatmaps entry.
+
+        api_data -- osu!api beatmap dictionary
+        """
+        self.songName = "{artist} - {title} [{version}]".format(**api_data)
+        self.fileMD5 = api_data["file_md5"]
         self.rankedStatus = convertRankedStatus(int(api_data["approved"]))
 
         self.beatmapID = int(api_data["beatmap_id"])
@@ -260,7 +312,6 @@ class beatmap:
             self.bpm = int(float(api_data["bpm"]))
         else:
             self.bpm = -1
-        return True
 
     def setData(self, md5: str, beatmapSetID: int, fileName: str) -> None:
         """
@@ -278,11 +329,15 @@ class beatmap:
         if dbResult and self.refresh:
             dbResult = False
 
+        if not dbResult and beatmapSetID > 0 and not self.refresh:
+            # get the whole set from the osu!api (getscores gives
+            # us the setid when the client has it) and save it in db
+            dbResult = self.setDataFromOsuApiSet(md5, beatmapSetID)
+            if dbResult:
+                log.debug("Beatmap set saved in db")
+
         if not dbResult:
             # get from the osu!api
-            # TODO: optimize by getting all maps at once using
-            # the setid (provided in getscores when client has it)
-
             apiResult = self.setDataFromOsuApiMD5(md5)
 
             if not apiResult:
@@ -382,6 +437,11 @@ class beatmap:
     def is_rankable(self):
         return self.rankedStatus >= rankedStatuses.RANKED
 
+    @property
+    def sort_by_pp(self):
+        """Whether this beatmap's leaderboards are sorted by pp (rather than score)"""
+        return self.rankedStatus in (rankedStatuses.RANKED, rankedStatuses.APPROVED)
+
 
 api2getscores_dict = {
     -2: rankedStatuses.PENDING,
@@ -402,6 +462,96 @@ def convertRankedStatus(approvedStatus):
         return rankedStatuses.UNKNOWN
 
 
+def getBeatmapRow(md5):
+    """
+    Get a beatmap's row from the beatmaps table, cached
+
+    md5 -- beatmap md5
+    return -- row dictionary, None if not in db
+    """
+    data = glob.beatmap_cache.get(md5)
+    if data is None:
+        data = glob.db.fetch(
+            "SELECT * FROM beatmaps WHERE beatmap_md5 = %s LIMIT 1", [md5]
+        )
+        if data is not None:
+            glob.beatmap_cache.add(data)
+    return data
+
+
+def getBeatmapRowByID(beatmapID):
+    """
+    Get a beatmap's row from the beatmaps table by beatmap id, cached
+
+    beatmapID -- beatmap id
+    return -- row dictionary, None if not in db
+    """
+    data = glob.beatmap_cache.get_by_id(beatmapID)
+    if data is None:
+        data = glob.db.fetch(
+            "SELECT * FROM beatmaps WHERE beatmap_id = %s LIMIT 1", [beatmapID]
+        )
+        if data is not None:
+            glob.beatmap_cache.add(data)
+    return data
+
+
+def addBeatmapsToDB(beatmaps):
+    """
+    Add (or replace) several beatmaps in db, in a single transaction.
+    Frozen ranked statuses are kept, like in `beatmap.addBeatmapToDB`.
+
+    beatmaps -- list of beatmap objects
+    """
+    beatmaps = [
+        b for b in beatmaps
+        if b.rankedStatus not in (rankedStatuses.NOT_SUBMITTED, rankedStatuses.NEED_UPDATE)
+    ]
+    if not beatmaps:
+        return
+
+    md5s = [b.fileMD5 for b in beatmaps]
+    ids = [b.beatmapID for b in beatmaps]
+
+    log.debug(f"Saving {len(beatmaps)} beatmaps in db...")
+    with dbHelper.transaction() as cursor:
+        cursor.execute(
+            "SELECT id, beatmap_md5, beatmap_id, ranked_status_freezed, ranked, rankedby "
+            f"FROM beatmaps WHERE beatmap_md5 IN ({dbHelper.placeholders(len(md5s))}) "
+            f"OR beatmap_id IN ({dbHelper.placeholders(len(ids))}) FOR UPDATE",
+            md5s + ids,
+        )
+        old_rows = cursor.fetchall()
+        by_md5 = {row["beatmap_md5"]: row for row in old_rows}
+        by_id = {row["beatmap_id"]: row for row in old_rows}
+
+        values = []
+        for b in beatmaps:
+            bdata = by_md5.get(b.fileMD5) or by_id.get(b.beatmapID)
+            if bdata:
+                # Get current frozen status
+                frozen = bdata["ranked_status_freezed"]
+                rankedby = bdata["rankedby"]
+                if frozen:
+                    b.rankedStatus = bdata["ranked"]
+                    b.rankedStatusFrozen = frozen
+            else:
+                frozen = 0  # Unfreeze beatmap status
+                rankedby = 0
+            values.append(b.getDBRow(frozen, rankedby))
+
+        if old_rows:
+            old_ids = [row["id"] for row in old_rows]
+            cursor.execute(
+                f"DELETE FROM beatmaps WHERE id IN ({dbHelper.placeholders(len(old_ids))})",
+                old_ids,
+            )
+        cursor.executemany(INSERT_BEATMAP_QUERY, values)
+
+    for b in beatmaps:
+        glob.beatmap_cache.remove(b.fileMD5, b.beatmapID)
+
+
 def incrementPlaycount(md5, passed):
     """
     Increment playcount (and passcount) for a beatmap
@@ -409,7 +559,6 @@ def incrementPlaycount(md5, passed):
     md5 -- beatmap md5
     passed -- if True, increment passcount too
     """
-    updates = "SET playcount = playcount + 1"
-    if passed:
-        updates += ", passcount = passcount + 1"
-    glob.db.execute(f"UPDATE beatmaps {updates} WHERE beatmap_md5 = %s", [md5])
+    # Written to db within a few seconds, along with the other plays
+    glob.playcounts.add(md5, passed)
+    glob.beatmap_cache.increment_playcount(md5, passed)
@@ -1,24 +1,31 @@
-import threading
+from collections import Counter
 from typing import TYPE_CHECKING
 
 from common.ddog import datadogClient
 from common.files import fileBuffer, fileLocks
 from common.web import schiavo
-from helpers.cache import LeaderboardCache, PersonalBestCache
+from helpers.cache import (BeatmapCache, IgnoredMapsCache, LeaderboardCache,
+                           ParsedBeatmapCache, PersonalBestCache,
+                           PersonalBestRecordCache)
+from helpers.playcountBuffer import PlaycountBuffer
 from personalBestCache import personalBestCache
 from userStatsCache import userStatsCache
 
 if TYPE_CHECKING:
     from multiprocessing.pool import ThreadPool
     from typing import TYPE_CHECKING
-    from typing import Optional
+    from typing import Optional, Union
 
-    from ftplib import FTP
     from redis import Redis
     from tornado.web import Application
 
     from common.db import dbConnector
     from helpers import config
+    from helpers.checksumFilter import ChecksumFilter
+    from helpers.dbHelper import BatchingDb
+    from helpers.osuapiHelper import OsuApiClient
+    from helpers.redisHelper import KeyPurge
+    from helpers.replaySpool import ReplaySpool
 
 try:
     with open("version") as f:
@@ -31,16 +38,21 @@ DATADOG_PREFIX = "lets"
 BOT_NAME = "Aika"
 BEATMAPS_START_INDEX = 0x3fffffff
 BEATMAPS_PATH = '.data/akatsuki_beatmaps'
-db: 'dbConnector.db' = None
+IGNORED_MAPS_PATH = '.data/ignored_maps.json'
+db: 'Union[dbConnector.db, BatchingDb]' = None
 
-ftp: 'Optional[FTP]' = None
-ftp_lock = threading.Lock()
+replaySpool: 'Optional[ReplaySpool]' = None # None if ftp is disabled
+keyPurge: 'Optional[KeyPurge]' = None # startup purge of lets:* keys, if this process ran it
+checksums: 'Optional[ChecksumFilter]' = None # None if cache.checksumfilter is disabled
 
 redis: 'Redis' = None
 conf: 'config' = None
 application: 'Application' = None
+osuapi: 'Optional[OsuApiClient]' = None # set once the IOLoop is up
 pool: 'ThreadPool' = None
 
+taskID: 'Optional[int]' = None # process number, None if running a single process
+
 busyThreads = 0
 debug = False
 sentry = False
@@ -50,11 +62,15 @@ fLocks = fileLocks.fileLocks()
 userStatsCache = userStatsCache()
 personalBestCache = personalBestCache()
 fileBuffers = fileBuffer.buffersList()
+playcounts = PlaycountBuffer() # beatmap playcount/passcount, written behind
 dog = datadogClient.datadogClient()
 schiavo = schiavo.schiavo()
 achievementClasses = {}
 
-ignoreMapsCache = {} # getscores optimization
+ignoreMapsCache = IgnoredMapsCache(IGNORED_MAPS_PATH) # getscores optimization
+
+# Submission path counters (scores, beatmap lookups, pp calculations)
+submissionStats = Counter()
 
 bcrypt_cache = {}
 topPlays = {'relax': 9999, 'vanilla': 9999}
@@ -65,3 +81,12 @@ last_inserted_map_id: int = 0
 # TODO: Experiment with these, which yields the best perf
 pb_cache = PersonalBestCache()
 lb_cache = LeaderboardCache()
+
+# personal best scores rows, for score submission
+pb_records = PersonalBestRecordCache()
+
+# beatmaps table rows, by md5 and beatmap id
+beatmap_cache = BeatmapCache()
+
+# .osu files and pp calculator objects, shared by all pp calculators
+parsed_bmap_cache = ParsedBeatmapCache()
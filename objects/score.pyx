@@ -124,17 +124,18 @@ class score:
         if data:
             self.setDataFromDict(data, rank)
 
-    def setDataFromDict(self, data, rank: Optional[Any] = None) -> None:
+    def setDataFromDict(self, data, rank: Optional[Any] = None, username: Optional[str] = None) -> None:
         """
         Set this object's score data from dictionary.
         Doesn't set playerUserID
 
         data -- score dictionarty
         rank -- rank in scoreboard. Optional.
+        username -- player's username. Optional, fetched from db if not passed.
         """
 
         self.scoreID = data["id"]
-        self.playerName = userUtils.getUsername(data["userid"]) # note: it passes username but no need to use.
+        self.playerName = username if username is not None else userUtils.getUsername(data["userid"]) # note: it passes username but no need to use.
         self.playerUserID = data["userid"]
         self.score = data["score"]
         self.maxCombo = data["max_combo"]
@@ -159,11 +160,15 @@ class score:
         self.pp: float = data["pp"]
         self.calculateAccuracy()
 
-    def setDataFromScoreData(self, scoreData) -> None:
+    def setDataFromScoreData(self, scoreData, b = None) -> Optional[Exception]:
         """
-        Set this object's score data from scoreData list (submit modular).
+        Set this object's score data from scoreData list (submit modular),
+        then calculate its pp and completed status.
 
         scoreData -- scoreData list
+        b -- beatmap object for this score. Optional, fetched if not passed.
+        return -- exception raised by the pp calculator, if any. The score is
+                  still set (with 0 pp) so it can be saved before re-raising it.
         """
 
         # Note: len(scoreData) >= 16 must be ensured before calling
@@ -193,9 +198,22 @@ class score:
         self.calculateAccuracy()
         #osuVersion: str = scoreData[17]
 
-        self.calculatePP()
+        # Create beatmap object, shared by pp calculation and completed status
+        if b is None:
+            b = beatmap.beatmap(self.fileMd5, 0)
+            glob.submissionStats['beatmap_lookups'] += 1
+
+        ppCalcException = None
+        try:
+            self.calculatePP(b)
+        except Exception as e:
+            self.pp = 0
+            ppCalcException = e
+        glob.submissionStats['pp_calculations'] += 1
+
         # Set completed status
-        self.setCompletedStatus()
+        self.setCompletedStatus(b)
+        return ppCalcException
 
     def getScoreData(self) -> None:
         api_request = requests.get(f"http://localhost:4242/score_sub?id={self.scoreID}&pass={int(self.passed)}&table={self.scores_table}&checksum={self.checksum}")
@@ -232,6 +250,21 @@ class score:
             self.date
         )
 
+    def getLeaderboardRow(self, country: str, sortByPP: bool) -> tuple:
+        """
+        Return this score as a getscores leaderboard (cache) row
+
+        country -- player's country
+        sortByPP -- if True, the leaderboard is sorted by pp, otherwise by score
+        """
+        relax = self.scores_table == 'scores_relax'
+        return (
+            self.scoreID, self.pp if relax else self.score, self.maxCombo,
+            self.c50, self.c100, self.c300, self.cMiss, self.cKatu, self.cGeki,
+            int(self.fullCombo), self.mods, self.playDateTime, self.playerName,
+            self.playerUserID, self.pp, country, self.pp if sortByPP else self.score
+        )
+
     def setCompletedStatus(self, b = None) -> None:
         """
         Set this score completed status and rankedScoreIncrease.
@@ -246,26 +279,27 @@ class score:
         if not scoreUtils.isRankable(self.mods, b.maxCombo) or not self.passed:
             return
 
-        userID = userUtils.getID(self.playerName)
-
         # Make sure we don't have another score identical to this one
-        duplicate = glob.db.fetch(
-            f'SELECT 1 FROM {self.scores_table} '
-            'WHERE checksum = %s',
-            [self.checksum])
+        def findDuplicate():
+            return glob.db.fetch(
+                f'SELECT 1 FROM {self.scores_table} '
+                'WHERE checksum = %s',
+                [self.checksum]) is not None
+
+        if glob.checksums is not None:
+            # Only asks the db if the checksum filter can't tell it's new
+            duplicate = glob.checksums.exists(self.scores_table, self.checksum, findDuplicate)
+        else:
+            duplicate = findDuplicate()
 
-        if duplicate is not None:
+        if duplicate:
             # Found same score in db. Don't save this score.
             self.completed = -1
             return
 
         # No duplicates found.
         # Get right "completed" value
-        personalBest = glob.db.fetch(
-            f"SELECT id, pp, score FROM {self.scores_table} "
-            "WHERE userid = %s AND beatmap_md5 = %s AND play_mode = %s "
-            f"AND completed = 3 LIMIT 1",
-            [userID, self.fileMd5, self.gameMode])
+        personalBest = self.getPersonalBest()
 
         if personalBest is None:
             # This is our first score on this map, so it's our best score
@@ -296,6 +330,45 @@ class score:
                     self.rankedScoreIncrease = 0
                     self.oldPersonalBest = 0
 
+    def getPersonalBest(self) -> Optional[dict]:
+        """
+        Get this score's player's personal best on its beatmap and mode,
+        from the personal best records cache or db.
+        Once this score is saved as their new personal best, that's this score.
+
+        return -- personal best scores row, None if they don't have one
+        """
+
+        if not self.playerUserID:
+            self.playerUserID = userUtils.getID(self.playerName)
+
+        relax = self.scores_table == 'scores_relax'
+        personalBest = glob.pb_records.get(self.playerUserID, self.fileMd5, self.gameMode, relax)
+        if personalBest is None:
+            personalBest = glob.db.fetch(
+                f"SELECT * FROM {self.scores_table} "
+                "WHERE userid = %s AND beatmap_md5 = %s AND play_mode = %s "
+                "AND completed = 3 LIMIT 1",
+                [self.playerUserID, self.fileMd5, self.gameMode])
+            glob.pb_records.set(self.playerUserID, self.fileMd5, self.gameMode, relax, personalBest)
+
+        return personalBest or None
+
+    def getRecord(self) -> dict:
+        """
+        Return this score as a scores table row (once saved)
+        """
+
+        return {
+            "id": self.scoreID, "beatmap_md5": self.fileMd5, "userid": self.playerUserID,
+            "score": self.score, "max_combo": self.maxCombo, "full_combo": int(self.fullCombo),
+            "mods": self.mods, "300_count": self.c300, "100_count": self.c100,
+            "50_count": self.c50, "katus_count": self.cKatu, "gekis_count": self.cGeki,
+            "misses_count": self.cMiss, "time": self.playDateTime, "play_mode": self.gameMode,
+            "completed": self.completed, "accuracy": self.accuracy * 100, "pp": self.pp,
+            "checksum": self.checksum
+        }
+
     def saveScoreInDB(self) -> None:
         """
         Save this score in DB (if passed and mods are valid).
@@ -309,11 +382,16 @@ class score:
                 "300_count, 100_count, 50_count, katus_count, gekis_count, "
                 "misses_count, time, play_mode, completed, accuracy, pp, checksum) "
                 "VALUES (NULL, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", [
-                    self.fileMd5, userUtils.getID(self.playerName), self.score, self.maxCombo,
+                    self.fileMd5, self.playerUserID or userUtils.getID(self.playerName), self.score, self.maxCombo,
                     int(self.fullCombo), self.mods, self.c300, self.c100, self.c50, self.cKatu,
                     self.cGeki, self.cMiss, self.playDateTime, self.gameMode, self.completed,
                     self.accuracy * 100, self.pp, self.checksum]))
 
+            # Added before the submission's transaction is committed. If it's rolled
+            # back, the checksum only costs a false positive (one more db check).
+            if glob.checksums is not None:
+                glob.checksums.add(self.scores_table, self.checksum)
+
     def calculatePP(self, b = None) -> None:
         # Create beatmap object
         if b is None:
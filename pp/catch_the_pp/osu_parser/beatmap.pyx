@@ -1,3 +1,5 @@
+import io
+
 from . import mathhelper
 from .hitobject import HitObject
 
@@ -15,9 +17,10 @@ cdef class Beatmap(object):
     cdef public list hitobjects
     cdef public int max_combo
 
-    def __init__(self, file_name):
+    def __init__(self, file_name, data=None):
         """
         file_name -- Directory for beatmap file (.osu)
+        data      -- Content of the beatmap file, if already read (file_name isn't read then)
         """
         self.file_name = file_name
         self.version = -1   #Unknown by default
@@ -32,17 +35,23 @@ cdef class Beatmap(object):
         self.slider_point_distance = 1  #Changes after [Difficulty] is fully parsed
         self.hitobjects = []
         self.max_combo = 0
-        self.parse_beatmap()
+        self.parse_beatmap(data)
 
         if "ApproachRate" not in self.difficulty.keys():    #Fix old osu version
             self.difficulty["ApproachRate"] = self.difficulty["OverallDifficulty"]
     
-    cpdef parse_beatmap(self):
+    cpdef parse_beatmap(self, bytes data=None):
         """
         Parses beatmap file line by line by passing each line into parse_line.
+
+        data -- Content of the beatmap file, read from file_name if None
         """
         cdef str line
-        with open(self.file_name, encoding="utf8") as file_stream:
+        if data is None:
+            file_stream = open(self.file_name, encoding="utf8")
+        else:
+            file_stream = io.StringIO(data.decode("utf8"), newline=None)
+        with file_stream:
             ver_line = ""
             while len(ver_line) < 2: #Find the line where beatmap version is spesified (normaly first line)
                 ver_line = file_stream.readline()
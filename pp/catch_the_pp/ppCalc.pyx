@@ -1,6 +1,6 @@
 from math import log10
 
-cpdef calculate_pp(diff, accuracy, combo, miss):
+cpdef calculate_pp(diff, accuracy, combo, miss, mods=None):
     """
     Calculate pp for gameplay
 
@@ -8,8 +8,12 @@ cpdef calculate_pp(diff, accuracy, combo, miss):
     accuracy    -- Accuracy of the play             (Float 0-1)
     combo       -- MaxCombo achived during the play (Int)
     miss        -- Amount of misses during the play (Int)
+    mods        -- Mods of the play, if diff was calculated with only some of them
     return      -- Total pp for gameplay
     """
+    if mods is None:
+        mods = diff.mods
+
     cdef float pp = (((5 * diff.star_rating / 0.0049) - 4) ** 2) / 100000
     cdef float length_bonus = 0.95 + 0.4 * min(1, combo / 3000)
     if combo > 3000:
@@ -24,18 +28,18 @@ cpdef calculate_pp(diff, accuracy, combo, miss):
     if diff.beatmap.difficulty["ApproachRate"] < 8:
         pp *= 1 + 0.025 * (8 - diff.beatmap.difficulty["ApproachRate"])
 
-    if diff.mods & 1 << 3 > 0:    #HD
+    if mods & 1 << 3 > 0:    #HD
         pp *= 1.05 + 0.075 * (10 - min(10, diff.beatmap.difficulty["ApproachRate"]))
 
-    if diff.mods & 1 << 10 > 0:    #FL
+    if mods & 1 << 10 > 0:    #FL
         pp *= 1.35 * length_bonus
 
     pp *= (accuracy ** 5.5)
 
-    if diff.mods & 1 << 0 > 0:    #NF
+    if mods & 1 << 0 > 0:    #NF
         pp *= 0.9
 
-    if diff.mods & 1 << 12 > 0:    #SO
+    if mods & 1 << 12 > 0:    #SO
         pp *= 0.95
 
     return pp
@@ -1,4 +1,4 @@
-from common.constants import gameModes
+from common.constants import gameModes, mods
 from common.log import logUtils as log
 from constants import exceptions
 from helpers import mapsHelper
@@ -6,6 +6,10 @@ from pp.catch_the_pp import ppCalc
 from pp.catch_the_pp.osu.ctb.difficulty import Difficulty
 from pp.catch_the_pp.osu_parser.beatmap import Beatmap as CalcBeatmap
 
+# Mods that change the star rating (and the AR the pp depend on). A Difficulty
+# is bound to one combination of these, every other mod is just applied to the pp.
+DIFFICULTY_MODS = mods.EASY | mods.HARDROCK | mods.DOUBLETIME | mods.NIGHTCORE | mods.HALFTIME
+
 
 class Cicciobello:
     def __init__(self, _beatmap, _score=None, accuracy=0, mods=0, combo=-1, misses=0, tillerino=False):
@@ -39,7 +43,7 @@ class Cicciobello:
         try:
             # Cache beatmap
             mapFile = mapsHelper.cachedMapPath(self.beatmap.beatmapID)
-            mapsHelper.cacheMap(mapFile, self.beatmap)
+            parsedMap = mapsHelper.getParsedMap(mapFile, self.beatmap)
 
             # TODO: Sanizite mods
 
@@ -51,22 +55,25 @@ class Cicciobello:
             if self.accuracy > 1:
                 raise ValueError("Accuracy must be between 0 and 1")
 
-            # Calculate difficulty
-            calcBeatmap = CalcBeatmap(mapFile)
-            difficulty = Difficulty(beatmap=calcBeatmap, mods=self.mods)
-            print("ciccio structure", difficulty.__dict__)
+            # Calculate difficulty. Difficulty scales the parsed beatmap's
+            # AR/CS for the given mods, so each mods combination gets its own.
+            difficultyMods = self.mods & DIFFICULTY_MODS
+            difficulty = mapsHelper.getParsed(
+                parsedMap, ("ctb", difficultyMods),
+                lambda: Difficulty(beatmap=CalcBeatmap(mapFile, parsedMap.data), mods=difficultyMods)
+            )
 
             # Calculate pp
             if self.tillerino:
                 results = []
                 for acc in (1.00, 0.99, 0.98, 0.95):
                     results.append(ppCalc.calculate_pp(
-                        diff=difficulty, accuracy=acc, combo=self.combo, miss=self.misses
+                        diff=difficulty, accuracy=acc, combo=self.combo, miss=self.misses, mods=self.mods
                     ))
                 self.pp = results
             else:
                 self.pp = ppCalc.calculate_pp(
-                    diff=difficulty, accuracy=self.accuracy, combo=self.combo, miss=self.misses
+                    diff=difficulty, accuracy=self.accuracy, combo=self.combo, miss=self.misses, mods=self.mods
                 )
         except exceptions.osuApiFailException:
             log.error("cicciobello ~> osu!api error!")
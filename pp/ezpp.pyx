@@ -0,0 +1,116 @@
+# distutils: define_macros=OPPAI_IMPLEMENTATION
+# distutils: libraries=m
+"""
+In-process oppai-ng binding for LETS
+
+Each `Calculator` owns an oppai-ng context with a beatmap already parsed and
+its difficulty calculated for a set of difficulty-changing mods, so computing
+pp for a score is just the (cheap) pp formula, without spawning oppai.
+Calculators are kept in `glob.parsed_bmap_cache` by rippoppai.
+"""
+cdef extern from "oppai-ng/oppai.c":
+    cdef struct ezpp:
+        int nmiss
+
+    ctypedef ezpp* ezpp_t
+
+    int MODS_TD
+    int MODS_MAP_CHANGING
+
+    ezpp_t ezpp_new()
+    void ezpp_free(ezpp_t ez)
+    int ezpp_data(ezpp_t ez, char* data, int data_size)
+    float ezpp_pp(ezpp_t ez)
+    float ezpp_stars(ezpp_t ez)
+    void ezpp_set_mode_override(ezpp_t ez, int mode_override)
+    void ezpp_set_mods(ezpp_t ez, int mods)
+    void ezpp_set_combo(ezpp_t ez, int combo)
+    void ezpp_set_accuracy_percent(ezpp_t ez, float accuracy_percent)
+    void ezpp_set_accuracy(ezpp_t ez, int n100, int n50)
+    char* errstr(int err)
+
+    # not part of the public api, recalculates with the current
+    # parameters without re-parsing the map (autocalc does the same)
+    int calc(ezpp_t ez)
+
+# Mods that change the star rating. A calculator is bound to one combination
+# of these, every other mod is just applied to the pp formula.
+DIFFICULTY_MODS = MODS_MAP_CHANGING | MODS_TD
+
+MODE_TAIKO = 1
+
+
+class EzppError(Exception):
+    pass
+
+
+cdef class Calculator:
+    """oppai-ng context for a single beatmap, mode and difficulty mods"""
+
+    cdef ezpp_t ez
+    cdef bytes data
+    cdef public int mods
+
+    def __cinit__(self, bytes data, bint taiko = False, int mods = 0):
+        """
+        Parse a beatmap and calculate its difficulty
+
+        data -- .osu file content
+        taiko -- if True, calculate taiko pp (converts std maps)
+        mods -- mods to calculate difficulty with, only DIFFICULTY_MODS are used
+        """
+        cdef int res
+
+        self.ez = ezpp_new()
+        if self.ez is NULL:
+            raise MemoryError()
+
+        # oppai-ng keeps a pointer to the map data, so we hold a reference to it
+        self.data = data
+        self.mods = mods & DIFFICULTY_MODS
+
+        if taiko:
+            ezpp_set_mode_override(self.ez, MODE_TAIKO)
+        ezpp_set_mods(self.ez, self.mods)
+
+        res = ezpp_data(self.ez, self.data, len(self.data))
+        if res < 0:
+            raise EzppError(errstr(res).decode())
+
+    def __dealloc__(self):
+        if self.ez is not NULL:
+            ezpp_free(self.ez)
+
+    cpdef tuple calculate(self, int mods = 0, float acc = -1, int combo = -1, int misses = 0):
+        """
+        Calculate pp for a score on this beatmap.
+        Runs entirely in C while holding the GIL, so it's safe to share
+        a calculator between threads.
+
+        mods -- score mods. Difficulty mods must match the calculator's ones
+        acc -- accuracy percentage (0-100). If < 0, assume no 100s/50s
+        combo -- max combo. If < 0, full combo (minus misses)
+        misses -- number of misses
+        return -- (pp, stars)
+        """
+        cdef int res
+
+        if mods & DIFFICULTY_MODS != self.mods:
+            raise EzppError(f'Calculator was built for mods {self.mods}, got {mods}')
+
+        # ezpp_set_nmiss would force a full re-parse, and we know it isn't needed
+        self.ez.nmiss = misses
+
+        ezpp_set_mods(self.ez, mods)
+        ezpp_set_combo(self.ez, combo)
+        if acc >= 0:
+            ezpp_set_accuracy_percent(self.ez, acc)
+        else:
+            ezpp_set_accuracy(self.ez, 0, 0)
+
+        res = calc(self.ez)
+        if res < 0:
+            raise EzppError(errstr(res).decode())
+
+        return ezpp_pp(self.ez), ezpp_stars(self.ez)
+
@@ -2,15 +2,12 @@
 oppai interface for ripple 2 / LETS
 """
 from os import name
-from subprocess import PIPE, run
 
-import orjson
 from common.constants import gameModes
 from common.log import logUtils as log
-from common.ripple import scoreUtils
 from constants import exceptions
 from helpers import mapsHelper
-from objects import glob
+from pp import ezpp
 
 # constants
 MODULE_NAME = "rippoppai"
@@ -91,25 +88,35 @@ class oppai:
         log.debug("oppai ~> Initialized oppai diffcalc")
         self.calculatePP()
 
-    @staticmethod
-    def _runOppaiProcess(command):
-        log.debug(f"oppai ~> running {command}")
-        process = run(f"{command} -ojson", shell=True, stdout=PIPE, stderr=PIPE)
+    def _getCalculator(self, mapFile, mods):
+        """
+        Get a calculator for this beatmap, parsing it only if it's not cached
+
+        mapFile -- .osu file path
+        mods -- mods used for the calculation
+        return -- ezpp.Calculator
+        """
+        taiko = self.gameMode == gameModes.TAIKO
+        parsedMap = mapsHelper.getParsedMap(mapFile, self.beatmap)
+
+        def parse():
+            try:
+                return ezpp.Calculator(parsedMap.data, taiko, mods)
+            except ezpp.EzppError as e:
+                raise OppaiError(e)
+
+        return mapsHelper.getParsed(parsedMap, ("oppai", taiko, mods & ezpp.DIFFICULTY_MODS), parse)
+
+    def _runOppai(self, calculator, mods, acc):
+        log.debug(f"oppai ~> running with mods {mods}, acc {acc}, combo {self.combo}, misses {self.misses}")
         try:
-            output = orjson.loads(process.stdout.decode("utf-8", errors="ignore"))
-            if "code" not in output or "errstr" not in output:
-                raise OppaiError("No code in json output")
-            if output["code"] != 200:
-                raise OppaiError(f"oppai error {output['code']}: {output['errstr']}")
-            if "pp" not in output or "stars" not in output:
-                raise OppaiError("No pp/stars entry in oppai json output")
-            pp = output["pp"]
-            stars = output["stars"]
-
-            log.debug(f"oppai ~> full output: {output}")
-            log.debug(f"oppai ~> pp: {pp}, stars: {stars}")
-        except (orjson.JSONDecodeError, IndexError, OppaiError) as e:
+            pp, stars = calculator.calculate(
+                mods, round(acc, 2) if acc > 0 else -1, self.combo if self.combo else -1, self.misses
+            )
+        except ezpp.EzppError as e:
             raise OppaiError(e)
+
+        log.debug(f"oppai ~> pp: {pp}, stars: {stars}")
         return pp, stars
 
     def calculatePP(self):
@@ -124,8 +131,6 @@ class oppai:
             # Build .osu map file path
             mapFile = mapsHelper.cachedMapPath(self.beatmap.beatmapID)
             log.debug(f"oppai ~> Map file: {mapFile}")
-            if self.beatmap.beatmapID < glob.BEATMAPS_START_INDEX:
-                mapsHelper.cacheMap(mapFile, self.beatmap)
 
             # Use only mods supported by oppai
             modsFixed = self.mods & 6111  # 5983
@@ -134,24 +139,11 @@ class oppai:
             if self.gameMode not in (gameModes.STD, gameModes.TAIKO):
                 raise exceptions.unsupportedGameModeException()
 
-            command = [f"./pp/oppai-ng/oppai {mapFile}"]
-            if not self.tillerino:
-                # force acc only for non-tillerino calculation
-                # acc is set for each subprocess if calculating tillerino-like pp sets
-                if self.acc > 0:
-                    command.append(f"{self.acc:.2f}%")
-            if self.mods:
-                command.append(f"+{scoreUtils.readableMods(modsFixed)}")
-            if self.combo:
-                command.append(f"{self.combo}x")
-            if self.misses:
-                command.append(f"{self.misses}m")
-            if self.gameMode == gameModes.TAIKO:
-                command.append("-taiko")
+            calculator = self._getCalculator(mapFile, modsFixed)
 
             # Calculate pp
             if not self.tillerino:
-                temp_pp, self.stars = self._runOppaiProcess(" ".join(command))
+                temp_pp, self.stars = self._runOppai(calculator, modsFixed, self.acc)
                 if self.stars > 50 or (
                     self.gameMode == gameModes.TAIKO
                     and self.beatmap.gameMode == gameModes.STD
@@ -164,8 +156,7 @@ class oppai:
             else:
                 pp_list = []
                 for acc in (100, 99, 98, 95):
-                    command.append(f"{acc:.2f}%")
-                    pp, self.stars = self._runOppaiProcess(" ".join(command))
+                    pp, self.stars = self._runOppai(calculator, modsFixed, acc)
 
                     # If this is a broken converted, set all pp to 0 and break the loop
                     if (
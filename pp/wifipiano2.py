@@ -37,8 +37,8 @@ class piano:
                 beatmap_md5 = self.beatmap.fileMD5
 
                 # get mania star rating from osuapi
-                stars = float(osuapiHelper.osuApiMapRequest(
-                    request='get_beatmaps', params=f'h={beatmap_md5}&a=1&m=3'
+                stars = float(osuapiHelper.osuApiRequest(
+                    'get_beatmaps', f'h={beatmap_md5}&a=1&m=3'
                 )['difficultyrating'])
 
                 # cache in sql for future use
@@ -55,7 +55,7 @@ class piano:
                 stars = self.beatmap.starsMania
 
             # Cache beatmap for cono
-            mapsHelper.cacheMap(mapsHelper.cachedMapPath(self.beatmap.beatmapID), self.beatmap)
+            mapsHelper.getParsedMap(mapsHelper.cachedMapPath(self.beatmap.beatmapID), self.beatmap)
 
             od = self.beatmap.OD
             objects = (self.score.c50 + self.score.c100 + self.score.c300 +
@@ -0,0 +1,23 @@
+from common.redis import generalPubSubHandler
+from pubSubHandlers.beatmapUpdateHandler import dropCachedBeatmap
+
+
+class handler(generalPubSubHandler.generalPubSubHandler):
+    """
+    Drops the cached copies of beatmaps updated by a LETS process
+    (this one included), they'll be fetched again from db.
+    """
+    def __init__(self):
+        super().__init__()
+        self.structure = {
+            "beatmaps": [], # {"md5": str, "id": int}
+        }
+        self.strict = False
+
+    def handle(self, data):
+        data = super().parseData(data)
+        if data is None:
+            return
+
+        for b in data["beatmaps"]:
+            dropCachedBeatmap(b["md5"], b["id"])
@@ -1,23 +1,46 @@
+import orjson
+
 from common.redis import generalPubSubHandler
 from helpers import osuapiHelper
 from objects import beatmap, glob
 
+# Every LETS process gets the update request, the first one to take
+# its key updates the set. The others ignore that same request for a while.
+UPDATE_LOCK_KEY = "lets:beatmap_update_lock:{}"
+UPDATE_LOCK_TTL = 60 # seconds
+INVALIDATE_CHANNEL = "lets:beatmap_invalidate"
+
 
 def updateSet(beatmapSetID):
     apiResponse = osuapiHelper.osuApiRequest("get_beatmaps", f"s={beatmapSetID}", False)
     if len(apiResponse) == 0:
         return
+
+    # Save every difficulty at once
+    difficulties = []
     for i in apiResponse:
-        beatmap.beatmap(i["file_md5"], int(i["beatmapset_id"]), refresh=True)
+        diff = beatmap.beatmap()
+        diff.setDataFromOsuApiData(i)
+        difficulties.append(diff)
+    beatmap.addBeatmapsToDB(difficulties)
+
+    # Every process (this one too) drops its cached copies
+    glob.redis.publish(INVALIDATE_CHANNEL, orjson.dumps({
+        "beatmaps": [{"md5": diff.fileMD5, "id": diff.beatmapID} for diff in difficulties]
+    }))
+
 
-        for mode in (0, 1, 2, 3):
-            lb_cache_vn = glob.lb_cache.get_lb_cache(mode, False)
-            lb_cache_rx = glob.lb_cache.get_lb_cache(mode, True)
-            glob.lb_cache.clear_lb_cache(lb_cache_vn, i["file_md5"])
-            glob.lb_cache.clear_lb_cache(lb_cache_rx, i["file_md5"])
+def dropCachedBeatmap(md5, beatmapID):
+    glob.beatmap_cache.remove(md5, beatmapID)
+    glob.ignoreMapsCache.remove_cache(md5)
+    glob.pb_records.nuke_bmap(md5)
 
-            glob.pb_cache.nuke_bmap_pbs(mode, i["file_md5"], False)
-            glob.pb_cache.nuke_bmap_pbs(mode, i["file_md5"], True)
+    for mode in (0, 1, 2, 3):
+        glob.lb_cache.clear_bmap(mode, False, md5)
+        glob.pb_cache.nuke_bmap_pbs(mode, md5, False)
+        if mode != 3: # RX has no mania
+            glob.lb_cache.clear_bmap(mode, True, md5)
+            glob.pb_cache.nuke_bmap_pbs(mode, md5, True)
 
 
 class handler(generalPubSubHandler.generalPubSubHandler):
@@ -31,8 +54,12 @@ class handler(generalPubSubHandler.generalPubSubHandler):
         if data is None:
             return
         if "id" in data:
+            if not glob.redis.set(UPDATE_LOCK_KEY.format(f"b{data['id']}"), 1, ex=UPDATE_LOCK_TTL, nx=True):
+                return
             beatmapData = osuapiHelper.osuApiRequest("get_beatmaps", f"b={data['id']}")
             if beatmapData and "beatmapset_id" in beatmapData:
                 updateSet(beatmapData["beatmapset_id"])
         elif "set_id" in data:
+            if not glob.redis.set(UPDATE_LOCK_KEY.format(f"s{data['set_id']}"), 1, ex=UPDATE_LOCK_TTL, nx=True):
+                return
             updateSet(data["set_id"])
@@ -0,0 +1,29 @@
+from common.redis import generalPubSubHandler
+from objects import glob
+
+
+class handler(generalPubSubHandler.generalPubSubHandler):
+    """
+    Drops leaderboards (and the user's personal best) patched by another
+    LETS process, they'll be fetched again from the shared cache. Rank
+    indexes are patched in place.
+    """
+    def __init__(self):
+        super().__init__()
+        self.structure = {
+            "origin": "",
+            "md5": "",
+            "mode": 0,
+            "rx": False,
+            "user_id": 0,
+            "sort": 0.0, # pp or score
+        }
+        self.strict = False
+
+    def handle(self, data):
+        data = super().parseData(data)
+        if data is None:
+            return
+
+        if glob.lb_cache.handle_invalidation(data):
+            glob.pb_cache.del_user_pb(data["mode"], data["user_id"], data["md5"], data["rx"])
@@ -0,0 +1,28 @@
+import os
+
+from common.redis import generalPubSubHandler
+from objects import glob
+
+
+class handler(generalPubSubHandler.generalPubSubHandler):
+    """
+    Drops personal best records replaced by a score submitted
+    to another LETS process, they'll be fetched again from db.
+    """
+    def __init__(self):
+        super().__init__()
+        self.structure = {
+            "origin": 0, # pid
+            "user_id": 0,
+            "md5": "",
+            "mode": 0,
+            "rx": False,
+        }
+        self.strict = False
+
+    def handle(self, data):
+        data = super().parseData(data)
+        if data is None or data["origin"] == os.getpid():
+            return
+
+        glob.pb_records.remove(data["user_id"], data["md5"], data["mode"], data["rx"])
@@ -0,0 +1,23 @@
+from common.redis import generalPubSubHandler
+from objects import glob
+
+
+class handler(generalPubSubHandler.generalPubSubHandler):
+    """
+    Drops personal best records of scores changed outside of LETS
+    (eg. by tomejerry), a beatmap's or all of them.
+    """
+    def __init__(self):
+        super().__init__()
+        self.structure = {}
+        self.strict = False
+
+    def handle(self, data):
+        data = super().parseData(data)
+        if data is None:
+            return
+
+        if data.get("md5"):
+            glob.pb_records.nuke_bmap(data["md5"])
+        else:
+            glob.pb_records.nuke()
@@ -0,0 +1,22 @@
+from common.redis import generalPubSubHandler
+from objects import glob
+
+
+class handler(generalPubSubHandler.generalPubSubHandler):
+    """
+    Adds checksums of scores inserted by any LETS process (this one
+    included, it doesn't matter) to our checksum filter.
+    """
+    def __init__(self):
+        super().__init__()
+        self.structure = {
+            "table": "",
+            "checksum": "",
+        }
+
+    def handle(self, data):
+        data = super().parseData(data)
+        if data is None or glob.checksums is None:
+            return
+
+        glob.checksums.add(data["table"], data["checksum"], publish=False)
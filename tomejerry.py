@@ -6,22 +6,26 @@ import sys
 import threading
 import time
 import traceback
-import warnings
 from abc import ABC, abstractmethod
-from collections import namedtuple
+from collections import OrderedDict, deque, namedtuple
 from enum import IntEnum
-from typing import Any, Dict, Iterable, List, Optional, Union
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
 
 import MySQLdb.cursors
 import progressbar
+import redis
 
 from common.db import dbConnector
-from helpers import config
+from helpers import config, dbHelper
+from helpers.cache import PB_RECORDS_NUKE_CHANNEL
 from objects import beatmap, glob, score
 
 MAX_WORKERS = 32
 UNIX = os.name == "posix"
 FAILED_SCORES_LOGGER = None
+SCORES_BATCH_SIZE = 1000 # score rows fetched per query
+SAVE_BATCH_SIZE = 5000 # recalculated scores updated per transaction, by default
+PP_TEMP_TABLE = "tomejerry_pp"
 
 
 RecalculatorQuery = namedtuple("RecalculatorQuery", "query parameters")
@@ -113,7 +117,7 @@ class SimpleRecalculator(Recalculator):
             raise TypeError("`conditions` must be either a `str`, `tuple` or `list`")
         q = "SELECT {} FROM scores JOIN beatmaps USING(beatmap_md5) WHERE {} ORDER BY scores.id DESC"
         super(SimpleRecalculator, self).__init__(
-            ids_query=RecalculatorQuery(q.format("scores.id AS id", conditions_str), parameters),
+            ids_query=RecalculatorQuery(q.format("scores.id AS id, scores.beatmap_md5 AS beatmap_md5", conditions_str), parameters),
             count_query=RecalculatorQuery(q.format("COUNT(*) AS c", conditions_str), parameters)
         )
 
@@ -123,7 +127,7 @@ class SimpleRecalculator(Recalculator):
 
 class ScoreIdsPool:
     """
-    Pool of score ids that needs to be recalculated.
+    Pool of score ids that needs to be recalculated, grouped by beatmap md5.
     """
     logger = logging.getLogger("score_ids_pool")
 
@@ -132,7 +136,8 @@ class ScoreIdsPool:
         Initializes a new pool
         """
         self._lock = threading.RLock()
-        self.scores = []
+        self.maps: "OrderedDict[str, List[int]]" = OrderedDict()
+        self.size = 0
 
     def load(self, recalculator: Recalculator):
         """
@@ -143,21 +148,38 @@ class ScoreIdsPool:
         """
         with self._lock:
             query_result = glob.db.fetchAll(recalculator.ids_query.query, recalculator.ids_query.parameters)
-            self.scores += [LwScore(x["id"], 0) for x in query_result]
-        self.logger.debug(f"Loaded {len(self.scores)} scores")
+            for x in query_result:
+                self.maps.setdefault(x["beatmap_md5"], []).append(x["id"])
+            self.size += len(query_result)
+        self.logger.debug(f"Loaded {self.size} scores on {len(self.maps)} beatmaps")
 
-    def chunk(self, chunk_size: int) -> List[int]:
+    def chunk(self, chunk_size: int) -> Dict[str, List[int]]:
         """
         Returns a chunk of score ids of the specified size, and removes the chunk from the pool.
+        Scores on the same beatmap are kept together, unless there are more than `chunk_size` of them.
 
         :param chunk_size: size of the chunk
-        :return: score ids list
+        :return: dict of beatmap md5: score ids list
         """
+        chunked_maps = {}
+        chunked_scores = 0
         with self._lock:
-            chunked_scores = self.scores[:chunk_size]
-            self.scores = self.scores[chunk_size:]
-        self.logger.debug(f"Chunked {chunk_size} scores. Current scores in pool: {len(self.scores)}")
-        return chunked_scores
+            while self.maps and chunked_scores < chunk_size:
+                md5, score_ids = self.maps.popitem(last=False)
+                left = chunk_size - chunked_scores
+                if len(score_ids) > left:
+                    # Leave the rest of this beatmap's scores for the next chunk
+                    self.maps[md5] = score_ids[left:]
+                    self.maps.move_to_end(md5, last=False)
+                    score_ids = score_ids[:left]
+                chunked_maps[md5] = score_ids
+                chunked_scores += len(score_ids)
+            self.size -= chunked_scores
+        self.logger.debug(f"Chunked {chunked_scores} scores. Current scores in pool: {self.size}")
+        return chunked_maps
+
+    def __len__(self) -> int:
+        return self.size
 
     @property
     def is_empty(self):
@@ -166,7 +188,7 @@ class ScoreIdsPool:
 
         :return: `True` if the pool is empty else `False`
         """
-        return not bool(self.scores)
+        return not bool(self.maps)
 
 
 class Worker:
@@ -175,14 +197,14 @@ class Worker:
     """
     score_ids_pool = ScoreIdsPool()
 
-    def __init__(self, chunk_size: int, worker_id: int=-1, start: bool=True):
+    def __init__(self, chunk_size: int, worker_id: int=-1, start: bool=True, batch_size: int=SAVE_BATCH_SIZE):
         """
         Initializes a new worker.
 
         :param chunk_size: Number of scores to process
         :param worker_id: This worker's id. Optional. Default: -1.
         :param start: Whether to start the worker immediately or not
-        :param
+        :param batch_size: Number of scores updated in the database per transaction
         """
         self.worker_id: int = worker_id
         self.thread: threading.Thread = None
@@ -190,7 +212,9 @@ class Worker:
         self.recalculated_scores_count: int = 0
         self.saved_scores_count: int = 0
         self.chunk_size: int = chunk_size
-        self.scores: List[LwScore] = self.score_ids_pool.chunk(self.chunk_size)
+        self.batch_size: int = batch_size
+        self.maps: Dict[str, List[int]] = self.score_ids_pool.chunk(self.chunk_size)
+        self.scores: List[LwScore] = []
         self.status: WorkerStatus = WorkerStatus.NOT_STARTED
         self.failed_scores: int = 0
         if start:
@@ -208,32 +232,60 @@ class Worker:
         del self.thread
         self.thread = None
         self.status = WorkerStatus.NOT_STARTED
-        self.scores = self.score_ids_pool.chunk(self.chunk_size)
+        self.maps = self.score_ids_pool.chunk(self.chunk_size)
+        self.scores = []
         self.logger.debug(f"Recycled with {self.chunk_size} new scores")
         if start:
             self.threaded_work()
 
-    def recalc_score(self, score_data: Dict) -> score:
+    def recalc_score(self, score_data: Dict, b: beatmap.beatmap) -> score:
         """
         Recalculates pp for a score
 
-        :param score_data: dict containing score and beatmap information about a score.
+        :param score_data: dict containing score information about a score.
+        :param b: beatmap object of the score's beatmap, shared by all the scores on it
         :return: new `score` object, with `pp` attribute set to the new value
         """
-        # Create score object and set its data
+        # Create score object and set its data. The username isn't needed to calculate pp.
         s: score.score = score.score()
-        s.setDataFromDict(score_data)
+        s.setDataFromDict(score_data, username="")
         s.passed = True
 
-        # Create beatmap object and set its data
-        b: beatmap.beatmap = beatmap.beatmap()
-        b.setDataFromDict(score_data)
-
         # Calculate score pp
         s.calculatePP(b)
-        del b
         return s
 
+    @staticmethod
+    def fetch_beatmap(cursor: MySQLdb.cursors.DictCursor, md5: str) -> Optional[beatmap.beatmap]:
+        """
+        Fetches a beatmap from the database
+
+        :param cursor: cursor that will be used to run the query
+        :param md5: beatmap md5
+        :return: `beatmap` object, or `None` if it's not in the database
+        """
+        cursor.execute("SELECT * FROM beatmaps WHERE beatmap_md5 = %s LIMIT 1", (md5,))
+        beatmap_data = cursor.fetchone()
+        if beatmap_data is None:
+            return None
+        b: beatmap.beatmap = beatmap.beatmap()
+        b.setDataFromDict(beatmap_data)
+        return b
+
+    @staticmethod
+    def fetch_scores(cursor: MySQLdb.cursors.DictCursor, score_ids: List[int]) -> Iterator[Dict[str, Any]]:
+        """
+        Fetches scores from the database, `SCORES_BATCH_SIZE` at a time
+
+        :param cursor: cursor that will be used to run the queries
+        :param score_ids: ids of the scores
+        :return: score dicts, as they're fetched
+        """
+        for i in range(0, len(score_ids), SCORES_BATCH_SIZE):
+            batch = score_ids[i:i + SCORES_BATCH_SIZE]
+            cursor.execute(f"SELECT * FROM scores WHERE id IN ({dbHelper.placeholders(len(batch))})", batch)
+            yield from cursor.fetchall()
+
     def _work(self):
         """
         Run worker's work. Fetches scores, recalculates pp and saves the results in the database.
@@ -267,14 +319,12 @@ class Worker:
         # 600 seconds in MariaDB's default configuration. This means that we have to recalculate
         # PPs for all scores in no more than 600 seconds, or we'll get a 'MySQL server has
         # gone away error'. Fetching every score (joined with the respective beatmap)
-        # directly would take up too much RAM, so we fetch all the score_ids at the
-        # beginning with one query, store them in memory and fetch the data for
-        # each score, one by one, using the same connection (to avoid pool overhead)
+        # directly would take up too much RAM, so we fetch all the score_ids (and their
+        # beatmap md5) at the beginning with one query, store them in memory grouped by
+        # beatmap and fetch the data for each beatmap, then its scores in batches, using
+        # the same connection (to avoid pool overhead). Each beatmap is read and parsed
+        # by the pp calculators once, and its scores only go through the pp formula.
         self.status = WorkerStatus.RECALCULATING
-        # self.recalculated_scores_count = 0
-
-        # Fetch all score_ids
-        # self.scores = [LwScore(x["id"], 0) for x in glob.db.fetchAll(self.ids_query.query, self.ids_query.parameters)]
 
         # Get a db worker
         cursor = None
@@ -286,34 +336,37 @@ class Worker:
         try:
             # Get a cursor (normal DictCursor)
             cursor = db_worker.connection.cursor(MySQLdb.cursors.DictCursor)
-            for i, lw_score in enumerate(self.scores):
-                if i % self.log_every == 0:
-                    self.logger.debug(f"Processed {i}/{self.chunk_size} scores")
-
-                # Fetch score and beatmap data for this id
-                cursor.execute(
-                    "SELECT * FROM scores JOIN beatmaps USING(beatmap_md5) WHERE scores.id = %s LIMIT 1",
-                    (lw_score.score_id,)
-                )
-                score_ = cursor.fetchone()
-                try:
-                    # Recalculate pp
-                    recalculated_score = self.recalc_score(score_)
-
-                    if recalculated_score is not None:
-                        # New score returned, store new pp in memory
-                        self.scores[i].pp = recalculated_score.pp
+            processed = 0
+            for md5, score_ids in self.maps.items():
+                # Fetch beatmap data once for all its scores
+                b = self.fetch_beatmap(cursor, md5)
+                if b is None:
+                    for score_id in score_ids:
+                        self.log_failed_score({"id": score_id}, f"beatmap {md5} not found")
+                    processed += len(score_ids)
+                    self.recalculated_scores_count += len(score_ids)
+                    continue
+
+                for score_ in self.fetch_scores(cursor, score_ids):
+                    if processed % self.log_every == 0:
+                        self.logger.debug(f"Processed {processed}/{self.chunk_size} scores")
+
+                    try:
+                        # Recalculate pp and store it in memory
+                        recalculated_score = self.recalc_score(score_, b)
+                        self.scores.append(LwScore(score_["id"], recalculated_score.pp))
                         if recalculated_score.pp == 0:
                             # PP calculator error
                             self.log_failed_score(score_, "0 pp")
 
-                    # Mark for garbage collection
-                    del score_
-                    del recalculated_score
-                except Exception as e:
-                    self.log_failed_score(score_, str(e), traceback_=True)
-                finally:
-                    self.recalculated_scores_count += 1
+                        # Mark for garbage collection
+                        del recalculated_score
+                    except Exception as e:
+                        self.log_failed_score(score_, str(e), traceback_=True)
+                    finally:
+                        processed += 1
+                        self.recalculated_scores_count += 1
+                del b
         finally:
             # Close cursor and connection
             if cursor is not None:
@@ -324,7 +377,8 @@ class Worker:
 
     def save_recalculations(self):
         """
-        Saves the recalculated performance points in the database
+        Saves the recalculated performance points in the database, `batch_size` scores per transaction.
+        Each batch is inserted in a temporary table, then the scores table is updated joined with it.
 
         :return:
         """
@@ -338,11 +392,23 @@ class Worker:
 
         # Update db
         self.logger.debug("Updating scores in database")
-        for i, lw_score in enumerate(self.scores):
-            if i % self.log_every == 0:
-                self.logger.debug(f"Updated {i}/{self.chunk_size} scores")
-            glob.db.execute("UPDATE scores SET pp = %s WHERE id = %s LIMIT 1", (lw_score.pp, lw_score.score_id))
-            self.saved_scores_count += 1
+        for i in range(0, len(self.scores), self.batch_size):
+            batch = self.scores[i:i + self.batch_size]
+            with dbHelper.transaction() as cursor:
+                # Temporary tables belong to a connection, and we may get a different one from the pool
+                # every time. It may also still have the previous batch of this connection.
+                cursor.execute(
+                    f"CREATE TEMPORARY TABLE IF NOT EXISTS {PP_TEMP_TABLE} "
+                    "(id INT NOT NULL PRIMARY KEY, pp DOUBLE NOT NULL) ENGINE=MEMORY"
+                )
+                cursor.execute(f"DELETE FROM {PP_TEMP_TABLE}")
+                cursor.executemany(
+                    f"INSERT INTO {PP_TEMP_TABLE} (id, pp) VALUES (%s, %s)",
+                    [(lw_score.score_id, lw_score.pp) for lw_score in batch]
+                )
+                cursor.execute(f"UPDATE scores JOIN {PP_TEMP_TABLE} USING(id) SET scores.pp = {PP_TEMP_TABLE}.pp")
+            self.saved_scores_count += len(batch)
+            self.logger.debug(f"Updated {i + len(batch)}/{len(self.scores)} scores")
 
         self.logger.debug("Scores updated")
 
@@ -382,12 +448,19 @@ class Worker:
         self.failed_scores += 1
 
 
-def mass_recalc(recalculator: Recalculator, workers_number: int=MAX_WORKERS, chunk_size: Optional[int]=None):
+def mass_recalc(
+    recalculator: Recalculator,
+    workers_number: int=MAX_WORKERS,
+    chunk_size: Optional[int]=None,
+    batch_size: int=SAVE_BATCH_SIZE
+):
     """
     Recalculate performance points for a set of scores, using multiple workers
 
     :param recalculator: the recalculator that will be used
     :param workers_number: the number of workers to spawn
+    :param chunk_size: the number of scores recalculated by a worker before being recycled
+    :param batch_size: the number of scores updated in the database per transaction
     :return:
     """
     start_time = time.time()
@@ -428,9 +501,10 @@ def mass_recalc(recalculator: Recalculator, workers_number: int=MAX_WORKERS, chu
             Worker(
                 chunk_size=chunk_size
                 if chunk_size is not None
-                else len(Worker.score_ids_pool.scores) // workers_number // 3,
+                else len(Worker.score_ids_pool) // workers_number // 3,
                 worker_id=i,
-                start=True
+                start=True,
+                batch_size=batch_size
             )
         )
 
@@ -443,7 +517,7 @@ def mass_recalc(recalculator: Recalculator, workers_number: int=MAX_WORKERS, chu
     recycles = 0
     widgets = [
         "[ ", "Starting", " ]",
-        "w_pp:<>", "w_db:<>", "w_done:<>", "rec:0",
+        "w_pp:<>", "w_db:<>", "w_done:<>", "rec:0", "db:0/s",
         progressbar.FormatLabel(" %(value)s/%(max)s "),
         progressbar.Bar(marker="#", left="[", right="]", fill="."),
         progressbar.Percentage(),
@@ -455,6 +529,8 @@ def mass_recalc(recalculator: Recalculator, workers_number: int=MAX_WORKERS, chu
         redirect_stdout=True,
         redirect_stderr=True
     ) as bar:
+        # (time, saved scores) over the last 5 seconds, for the db rows/s
+        saved_samples = deque(maxlen=10)
         while True:
             lowest_status = min([x.status for x in workers])
 
@@ -480,6 +556,9 @@ def mass_recalc(recalculator: Recalculator, workers_number: int=MAX_WORKERS, chu
             widgets[4] = f" w_db:<{len([x for x in workers if x.status == WorkerStatus.SAVING])}/{len(workers)}>"
             widgets[5] = f" w_done:<{len(workers_done)}/{len(workers)}>"
             widgets[6] = f" rec:{recycles}"
+            saved_samples.append((time.time(), sum([x.saved_scores_count for x in workers])))
+            elapsed = saved_samples[-1][0] - saved_samples[0][0]
+            widgets[7] = f" db:{(saved_samples[-1][1] - saved_samples[0][1]) / elapsed if elapsed else 0:.0f}/s"
             bar.update(total_progress_value)
 
             # Exit from the loop if every worker has finished its work
@@ -500,6 +579,13 @@ def mass_recalc(recalculator: Recalculator, workers_number: int=MAX_WORKERS, chu
         f":: Took\t{end_time - start_time:.2f} seconds"
     )
 
+    # LETS caches personal bests (and their pp) for a while, drop them
+    if glob.redis is not None:
+        try:
+            glob.redis.publish(PB_RECORDS_NUKE_CHANNEL, "{}")
+        except redis.RedisError as e:
+            logging.warning(f"Could not tell LETS to drop its cached personal bests ({e})")
+
 
 def main():
     # CLI stuff
@@ -517,6 +603,7 @@ def main():
 
     parser.add_argument("-w",  "--workers",   help=f"number of workers. {MAX_WORKERS // 2} by default. Max {MAX_WORKERS}", required=False)
     parser.add_argument("-cs", "--chunksize", help="score chunks size",  required=False)
+    parser.add_argument("-bs", "--batchsize", help=f"scores updated in the db per transaction. {SAVE_BATCH_SIZE} by default", required=False)
     parser.add_argument("-v",  "--verbose",   help="verbose/debug mode", required=False, action="store_true")
     args = parser.parse_args()
 
@@ -539,9 +626,10 @@ def main():
     if args.chunksize is not None:
         chunk_size = int(args.chunksize)
 
-    # Disable MySQL db warnings (it spams 'Unsafe statement written to the binary log using statement...'
-    # because we use UPDATE with LIMIT 1 when updating performance points after recalculation
-    warnings.filterwarnings("ignore", category=MySQLdb.Warning)
+    # Get batch size from arguments if set
+    batch_size = SAVE_BATCH_SIZE
+    if args.batchsize is not None:
+        batch_size = int(args.batchsize)
 
     # Connect to MySQL
     logging.info("Connecting to MySQL db")
@@ -553,6 +641,15 @@ def main():
         max(workers_number, MAX_WORKERS)
     )
 
+    # Connect to redis
+    logging.info("Connecting to redis")
+    glob.redis = redis.Redis(
+        glob.conf.config["redis"]["host"],
+        glob.conf.config["redis"]["port"],
+        glob.conf.config["redis"]["database"],
+        glob.conf.config["redis"]["password"]
+    )
+
     # Set verbose
     glob.debug = args.verbose
 
@@ -577,7 +674,7 @@ def main():
 
     # Execute mass recalc
     if recalculator is not None:
-        mass_recalc(recalculator, workers_number, chunk_size)
+        mass_recalc(recalculator, workers_number, chunk_size, batch_size)
     else:
         logging.warning("No recalc option specified")
         parser.print_help()
@@ -27,13 +27,14 @@ class userStatsCache:
         retData = orjson.loads(data.decode("utf-8"))
         return retData
 
-    def update(self, userID: int, gameMode: int, relax: bool, data = None):
+    def update(self, userID: int, gameMode: int, relax: bool, data = None, pipe = None):
         """
         Update cached user stats in redis with new values
 
         :param userID: userID
         :param gameMode: game mode number
         :param data: data to cache. Optional. If not passed, will get from db
+        :param pipe: redis pipeline to queue the write on. Optional. If not passed, sent right away
         :return:
         """
         if data is None:
@@ -42,4 +43,4 @@ class userStatsCache:
             data = userUtils.getUserStats(userID, gameMode, relax)
         log.debug(f"userStatsCache set {data}")
 
-        glob.redis.set(f'lets:users_stats_cache:{gameMode}:{int(relax)}:{userID}', orjson.dumps(data), 1800)
+        (pipe if pipe is not None else glob.redis).set(f'lets:users_stats_cache:{gameMode}:{int(relax)}:{userID}', orjson.dumps(data), 1800)